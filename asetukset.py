@@ -4,16 +4,13 @@ import sqlite3
 import datetime
 from pathlib import Path
 from flask import Flask, Blueprint, render_template, request, redirect, url_for, flash, abort, g, jsonify
+from tietokanta import get_db
+from saldot import get_account_balances
+from viitetiedot import get_reference_data, bump_version
 
 # Create a Blueprint for settings routes
 asetukset_bp = Blueprint('asetukset', __name__, template_folder='templates')
 
-def get_db_connection(db_path):
-    """Create a connection to the specified database file"""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row  # Allows accessing columns by name
-    return conn
-
 @asetukset_bp.route('/db/<filename>/settings')
 def settings_main(filename):
     """Main settings page"""
@@ -26,13 +23,12 @@ def settings_main(filename):
     # Get client name
     client_name = ""
     try:
-        conn = get_db_connection(db_path)
+        conn = get_db(filename)
         cursor = conn.cursor()
         cursor.execute("SELECT arvo FROM Asetus WHERE avain='Nimi'")
         result = cursor.fetchone()
         if result:
             client_name = result[0]
-        conn.close()
     except:
         pass
     
@@ -49,43 +45,25 @@ def chart_of_accounts(filename):
         flash("Database file not found", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
-    # Get all accounts
-    cursor.execute("""
-        SELECT numero, tyyppi, json FROM Tili
-        ORDER BY numero
-    """)
-    
+    # Get all accounts from the shared reference data
     accounts = []
-    for row in cursor.fetchall():
-        json_data = json.loads(row['json']) if row['json'] else {}
+    for row in get_reference_data(conn, filename).accounts:
         account = {
             'numero': row['numero'],
-            'nimi': json_data.get('nimi', f"Account {row['numero']}"),
+            'nimi': row['nimi'] or f"Account {row['numero']}",
             'tyyppi': row['tyyppi'],
             'tyyppi_nimi': get_account_type_name(row['tyyppi']),
-            'alv': json_data.get('alvprosentti', ''),
-            'alvkoodi': json_data.get('alvkoodi', ''),
+            'alv': row['alvprosentti'],
+            'alvkoodi': row['alvkoodi'],
             'balance': 0  # Will be calculated below
         }
         accounts.append(account)
     
-    # Calculate balance for each account
-    cursor.execute("""
-        SELECT tili, SUM(debetsnt) as total_debit, SUM(kreditsnt) as total_credit 
-        FROM Vienti 
-        GROUP BY tili
-    """)
-    
-    balances = {}
-    for row in cursor.fetchall():
-        account_number = row['tili']
-        debit = row['total_debit'] or 0
-        credit = row['total_credit'] or 0
-        balance_cents = debit - credit
-        balances[account_number] = balance_cents
+    # Balance for each account from the maintained monthly balances
+    balances = get_account_balances(conn)
     
     # Update account balances
     for account in accounts:
@@ -124,8 +102,6 @@ def chart_of_accounts(filename):
     # Get VAT codes for reference
     vat_codes = get_vat_codes()
     
-    conn.close()
-    
     return render_template('settings/tililuettelo.html', 
                           grouped_accounts=grouped_accounts,
                           filename=filename,
@@ -141,7 +117,7 @@ def edit_account(filename, account_number):
         flash("Database file not found", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
     if request.method == 'POST':
@@ -179,6 +155,7 @@ def edit_account(filename, account_number):
                     WHERE numero = ?
                 """, (account_type, json.dumps(json_data), account_number))
                 
+                bump_version(conn)
                 conn.commit()
                 flash(f"Account {account_number} updated successfully", "success")
             else:
@@ -194,7 +171,6 @@ def edit_account(filename, account_number):
     account = cursor.fetchone()
     
     if not account:
-        conn.close()
         flash(f"Account {account_number} not found", "error")
         return redirect(url_for('asetukset.chart_of_accounts', filename=filename))
     
@@ -208,18 +184,13 @@ def edit_account(filename, account_number):
         'alvkoodi': json_data.get('alvkoodi', '')
     }
     
-    conn.close()
-    
     # Get client name
     client_name = ""
     try:
-        conn = get_db_connection(db_path)
-        cursor = conn.cursor()
         cursor.execute("SELECT arvo FROM Asetus WHERE avain='Nimi'")
         result = cursor.fetchone()
         if result:
             client_name = result[0]
-        conn.close()
     except:
         pass
     
@@ -242,7 +213,7 @@ def new_account(filename):
         flash("Database file not found", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
     if request.method == 'POST':
@@ -273,6 +244,7 @@ def new_account(filename):
                 VALUES (?, ?, ?)
             """, (int(number), account_type, json.dumps(json_data)))
             
+            bump_version(conn)
             conn.commit()
             flash(f"Account {number} created successfully", "success")
             return redirect(url_for('asetukset.chart_of_accounts', filename=filename))
@@ -280,18 +252,13 @@ def new_account(filename):
             conn.rollback()
             flash(f"Error creating account: {str(e)}", "error")
     
-    conn.close()
-    
     # Get client name
     client_name = ""
     try:
-        conn = get_db_connection(db_path)
-        cursor = conn.cursor()
         cursor.execute("SELECT arvo FROM Asetus WHERE avain='Nimi'")
         result = cursor.fetchone()
         if result:
             client_name = result[0]
-        conn.close()
     except:
         pass
     
@@ -301,13 +268,10 @@ def new_account(filename):
     # Suggest next available account number
     next_account = 1000
     try:
-        conn = get_db_connection(db_path)
-        cursor = conn.cursor()
         cursor.execute("SELECT MAX(numero) FROM Tili")
         result = cursor.fetchone()
         if result and result[0]:
             next_account = result[0] + 10
-        conn.close()
     except:
         pass
     
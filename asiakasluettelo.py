@@ -0,0 +1,157 @@
+import os
+import sqlite3
+import datetime
+import threading
+from tietokanta import DATABASE_DIR
+import migraatiot
+
+# Metadata index of the client databases, kept next to them
+CATALOG_FILE = '.asiakasluettelo.sqlite'
+
+class ClientCatalog:
+    """
+    Persistent index of client database metadata.
+    A client file is opened only when its inode, size or mtime has changed
+    since it was last indexed, so listing clients does not open every database.
+    """
+
+    def __init__(self, directory=DATABASE_DIR, catalog_file=CATALOG_FILE):
+        self.directory = directory
+        self.catalog_path = os.path.join(directory, catalog_file)
+        self._lock = threading.Lock()
+        self._entries = None  # filename -> metadata dict, loaded on first use
+
+    def _connect(self):
+        os.makedirs(self.directory, exist_ok=True)
+        conn = sqlite3.connect(self.catalog_path)
+        conn.row_factory = sqlite3.Row
+        # Catalogs written before the schema version was indexed are rebuilt
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(Asiakas)")}
+        if columns and 'skeemaversio' not in columns:
+            conn.execute("DROP TABLE Asiakas")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS Asiakas (
+            tiedosto TEXT PRIMARY KEY NOT NULL,
+            nimi TEXT,
+            koko INTEGER,
+            luotu REAL,
+            muokattu_ns INTEGER,
+            inode INTEGER,
+            skeemaversio INTEGER
+        )
+        ''')
+        return conn
+
+    def _load(self, conn):
+        entries = {}
+        for row in conn.execute("SELECT * FROM Asiakas"):
+            entries[row['tiedosto']] = dict(row)
+        return entries
+
+    def _modified_ns(self, path, stat):
+        """Last modification of a database, including commits still in its write-ahead log"""
+        try:
+            wal = os.stat(path + '-wal')
+        except FileNotFoundError:
+            return stat.st_mtime_ns
+        # Readers create an empty log; only one with frames holds changes
+        return max(stat.st_mtime_ns, wal.st_mtime_ns) if wal.st_size else stat.st_mtime_ns
+
+    def _read_client(self, path, filename, stat, modified_ns):
+        """Read the indexed fields from a client database"""
+        # Fall back to a name derived from the filename
+        name = filename.split('_')[0].replace('_', ' ').title()
+        version = None
+
+        try:
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                row = conn.execute("SELECT arvo FROM Asetus WHERE avain = 'Nimi'").fetchone()
+                if row and row[0]:
+                    name = row[0]
+                # The migration runner's schema version; 0 if never migrated
+                version = migraatiot.get_version(conn)
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass
+
+        return {
+            'tiedosto': filename,
+            'nimi': name,
+            'koko': stat.st_size,
+            'luotu': stat.st_ctime,
+            'muokattu_ns': modified_ns,
+            'inode': stat.st_ino,
+            'skeemaversio': version
+        }
+
+    def refresh(self):
+        """Bring the index up to date with the database directory"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                if self._entries is None:
+                    self._entries = self._load(conn)
+
+                seen = set()
+                changed = []
+
+                if os.path.isdir(self.directory):
+                    with os.scandir(self.directory) as it:
+                        for entry in it:
+                            if not entry.name.endswith('.db') or not entry.is_file():
+                                continue
+
+                            stat = entry.stat()
+                            modified_ns = self._modified_ns(entry.path, stat)
+                            seen.add(entry.name)
+                            cached = self._entries.get(entry.name)
+
+                            if (cached and cached['muokattu_ns'] == modified_ns
+                                    and cached['inode'] == stat.st_ino and cached['koko'] == stat.st_size):
+                                continue
+
+                            changed.append(self._read_client(entry.path, entry.name, stat, modified_ns))
+
+                removed = [filename for filename in self._entries if filename not in seen]
+
+                if changed or removed:
+                    conn.executemany("""
+                        INSERT OR REPLACE INTO Asiakas (tiedosto, nimi, koko, luotu, muokattu_ns, inode, skeemaversio)
+                        VALUES (:tiedosto, :nimi, :koko, :luotu, :muokattu_ns, :inode, :skeemaversio)
+                    """, changed)
+                    conn.executemany("DELETE FROM Asiakas WHERE tiedosto = ?", [(f,) for f in removed])
+                    conn.commit()
+
+                    for entry in changed:
+                        self._entries[entry['tiedosto']] = entry
+                    for filename in removed:
+                        del self._entries[filename]
+
+                return list(self._entries.values())
+            finally:
+                conn.close()
+
+    def list_clients(self):
+        """
+        Return the client databases formatted for display, sorted by name.
+        Databases whose schema is behind the latest migration are flagged
+        as outdated; they are migrated when next opened.
+        """
+        clients = []
+        for entry in self.refresh():
+            version = entry['skeemaversio']
+            clients.append({
+                'filename': entry['tiedosto'],
+                'name': entry['nimi'],
+                'created': datetime.datetime.fromtimestamp(entry['luotu']).strftime('%Y-%m-%d %H:%M'),
+                'size': f"{entry['koko'] / 1024:.1f} KB",
+                'schema_version': version,
+                'outdated': version is not None and version < migraatiot.LATEST_VERSION
+            })
+
+        clients.sort(key=lambda client: (client['name'] or '').lower())
+        return clients
+
+catalog = ClientCatalog()
@@ -0,0 +1,100 @@
+import os
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from tietokanta import get_db
+from saldot import get_fiscal_periods, get_monthly_totals
+from viitetiedot import get_reference_data
+from tili import format_cents
+
+# Create a Blueprint for budget routes
+budjetti_bp = Blueprint('budjetti', __name__, template_folder='templates')
+
+def budget_comparison(conn, reference, period):
+    """
+    Compare the budget (Budjetti) of a fiscal period with the actual figures.
+    The actual figures are read from the monthly KohdennusSaldo rows of the
+    period's months, so a period is taken to start and end on month boundaries.
+
+    Amounts are in cents with the natural sign of the account type: debits
+    for assets and expenses, credits for the others.
+
+    Returns:
+        list: Row dicts with tili, nimi, kohdennus, kohdennus_nimi, budjetti,
+              toteutunut, erotus and prosentti (of the budget, None without one),
+              for every budgeted account and every income or expense account
+              with movements
+    """
+    actual = {}
+    for tili, kohdennus, kausi, debit, credit, rivit in get_monthly_totals(
+            conn, period['alkaa'][:7], period['loppuu'][:7]):
+        actual[(tili, kohdennus)] = actual.get((tili, kohdennus), 0) + debit - credit
+
+    budget = {}
+    for tili, kohdennus, cents in conn.execute(
+            "SELECT tili, kohdennus, sentti FROM Budjetti WHERE tilikausi = ?", (period['alkaa'],)):
+        budget[(tili, kohdennus or 0)] = budget.get((tili, kohdennus or 0), 0) + (cents or 0)
+
+    types = {account['numero']: account['tyyppi'] for account in reference.accounts}
+    keys = set(budget) | {key for key in actual if types.get(key[0]) in ('D', 'E')}
+
+    rows = []
+    for tili, kohdennus in sorted(keys):
+        sign = 1 if types.get(tili) in ('A', 'E') else -1
+        actual_cents = sign * actual.get((tili, kohdennus), 0)
+        budget_cents = budget.get((tili, kohdennus), 0)
+        rows.append({
+            'tili': tili,
+            'nimi': reference.account_names.get(tili) or f"Tili {tili}",
+            'kohdennus': kohdennus,
+            'kohdennus_nimi': reference.allocation_names.get(kohdennus) or f"Kohdennus {kohdennus}",
+            'budjetti': budget_cents,
+            'toteutunut': actual_cents,
+            'erotus': actual_cents - budget_cents,
+            'prosentti': round(100 * actual_cents / budget_cents, 1) if budget_cents else None
+        })
+    return rows
+
+@budjetti_bp.route('/db/<filename>/budget')
+def budget_report(filename):
+    """Budget vs. actual for a fiscal period, as a page or as JSON with ?format=json"""
+    db_path = os.path.join('databases', filename)
+
+    if not os.path.exists(db_path):
+        if request.args.get('format') == 'json':
+            return jsonify({"error": "Database file not found"}), 404
+        flash("Database file not found", "error")
+        return redirect(url_for('index'))
+
+    conn = get_db(filename)
+    periods = get_fiscal_periods(conn)
+
+    # The requested fiscal period, or the latest one
+    period = next((p for p in periods if p['alkaa'] == request.args.get('tilikausi')), None)
+    if period is None and periods:
+        period = periods[0]
+
+    rows = budget_comparison(conn, get_reference_data(conn, filename), period) if period else []
+
+    if request.args.get('format') == 'json':
+        return jsonify({"tilikausi": period, "rivit": rows})
+
+    for row in rows:
+        row['budjetti_formatted'] = format_cents(row['budjetti'])
+        row['toteutunut_formatted'] = format_cents(row['toteutunut'])
+        row['erotus_formatted'] = ('-' if row['erotus'] < 0 else '') + format_cents(row['erotus'])
+
+    # Get client name
+    client_name = ""
+    row = conn.execute("SELECT arvo FROM Asetus WHERE avain='Nimi'").fetchone()
+    if row:
+        client_name = row[0]
+
+    return render_template('accounts/budget.html',
+                           filename=filename,
+                           client_name=client_name,
+                           periods=periods,
+                           period=period,
+                           rows=rows)
+
+def register_blueprint(app):
+    """Register the blueprint with the main Flask app"""
+    app.register_blueprint(budjetti_bp)
@@ -0,0 +1,42 @@
+"""pytest configuration: the application modules live in the repository root"""
+import os
+import sqlite3
+import pytest
+from user_database import AccountingDatabaseCreator, app
+from tietokanta import connect
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """
+    Filename of a new client database with the basic chart of accounts and
+    the fiscal period 2024, created in the databases directory of a
+    temporary working directory, where the application looks for it.
+    """
+    monkeypatch.chdir(tmp_path)
+    path = AccountingDatabaseCreator().create_database({
+        'name': 'Test Client',
+        'chart_scope': 'basic',
+        'fiscal_period': {'name': '2024', 'start_date': '2024-01-01', 'end_date': '2024-12-31'}
+    })
+    return os.path.basename(path)
+
+@pytest.fixture
+def open_connection(database):
+    """Open connections to the test database, closed after the test"""
+    connections = []
+
+    def open_connection():
+        conn = connect(os.path.join('databases', database), timeout=5, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        connections.append(conn)
+        return conn
+
+    yield open_connection
+    for conn in connections:
+        conn.close()
+
+@pytest.fixture
+def client(database):
+    """Flask test client of the application, serving the test database"""
+    app.config['TESTING'] = True
+    return app.test_client()
@@ -0,0 +1,108 @@
+import os
+import re
+import html
+from flask import Blueprint, request, jsonify, url_for
+from tietokanta import get_db
+
+# Create a Blueprint for search routes
+haku_bp = Blueprint('haku', __name__, template_folder='templates')
+
+# Vouchers returned by a search
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+# Words of context around the matches in a snippet
+SNIPPET_TOKENS = 12
+
+# Markers placed around matches by snippet(), replaced after escaping the text
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+def build_match_query(text):
+    """
+    Turn free text into an FTS5 query: every word must match, as a prefix.
+    Returns None if the text has no searchable words.
+    """
+    words = WORD_PATTERN.findall(text or '')
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+def voucher_match_condition(column='id'):
+    """SQL condition limiting vouchers to those matching a build_match_query() parameter"""
+    return f"""{column} IN (
+        SELECT rowid FROM TositeHaku WHERE TositeHaku MATCH ?
+        UNION
+        SELECT tosite FROM VientiHaku WHERE VientiHaku MATCH ?
+    )"""
+
+def format_snippet(snippet):
+    """Escape a snippet for HTML and highlight the matches with <mark>"""
+    escaped = html.escape(snippet or '')
+    return escaped.replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+def search_vouchers(conn, text, limit=SEARCH_LIMIT):
+    """
+    Ranked full-text search over voucher titles, partner names and line descriptions.
+
+    Returns:
+        list: Voucher dicts with id, pvm, tyyppi, otsikko and an HTML snippet
+              of the best matching field, best matches first
+    """
+    query = build_match_query(text)
+    if query is None:
+        return []
+
+    rows = conn.execute(f"""
+        WITH osumat AS (
+            SELECT rowid AS tosite, rank,
+                   snippet(TositeHaku, -1, '{MATCH_START}', '{MATCH_END}', '…', {SNIPPET_TOKENS}) AS katkelma
+            FROM TositeHaku
+            WHERE TositeHaku MATCH :haku
+            UNION ALL
+            SELECT tosite, rank,
+                   snippet(VientiHaku, 0, '{MATCH_START}', '{MATCH_END}', '…', {SNIPPET_TOKENS})
+            FROM VientiHaku
+            WHERE VientiHaku MATCH :haku
+        )
+        SELECT t.id, t.pvm, t.tyyppi, t.otsikko, o.katkelma, MIN(o.rank) AS rank
+        FROM osumat o
+        JOIN Tosite t ON t.id = o.tosite
+        GROUP BY t.id
+        ORDER BY rank, t.pvm DESC
+        LIMIT :raja
+    """, {'haku': query, 'raja': limit})
+
+    return [{
+        'id': row['id'],
+        'pvm': row['pvm'],
+        'tyyppi': row['tyyppi'],
+        'otsikko': row['otsikko'],
+        'snippet': format_snippet(row['katkelma'])
+    } for row in rows]
+
+@haku_bp.route('/db/<filename>/search')
+def search(filename):
+    """Search vouchers, returning ranked JSON results with highlighted snippets"""
+    db_path = os.path.join('databases', filename)
+
+    if not os.path.exists(db_path):
+        return jsonify({"error": "Database file not found"}), 404
+
+    limit = request.args.get('limit', SEARCH_LIMIT, type=int)
+    limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+
+    results = search_vouchers(get_db(filename), request.args.get('q', ''), limit)
+    for result in results:
+        if result['tyyppi'] == 1:  # Sales invoices have their own view
+            result['url'] = url_for('lasku.view_invoice', filename=filename, invoice_id=result['id'])
+        else:
+            result['url'] = url_for('tosite.view_voucher', filename=filename, voucher_id=result['id'])
+
+    return jsonify({"results": results})
+
+def register_blueprint(app):
+    """Register the blueprint with the main Flask app"""
+    app.register_blueprint(haku_bp)
@@ -0,0 +1,78 @@
+import os
+from flask import Blueprint, request, jsonify
+from tietokanta import get_db
+
+# Create a Blueprint for partner routes
+kumppani_bp = Blueprint('kumppani', __name__, template_folder='templates')
+
+# Partners returned by a search
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+# Shortest query the trigram index can answer; shorter ones are name prefixes
+TRIGRAM_LENGTH = 3
+
+def _prefix_range(query):
+    """Bounds of the names starting with query, for an index range scan"""
+    return query, query + chr(0x10FFFF)
+
+def _match_expression(query):
+    """FTS5 query matching the text anywhere in the name, VAT id or IBANs"""
+    expression = '"' + query.replace('"', '""') + '"'
+    compact = query.replace(' ', '')
+    if compact != query and len(compact) >= TRIGRAM_LENGTH:
+        # IBANs are indexed without spaces
+        expression += ' OR iban : "' + compact.replace('"', '""') + '"'
+    return expression
+
+def search_partners(conn, query, limit=SEARCH_LIMIT):
+    """
+    Search partners by name, VAT id (alvtunnus) or IBAN.
+
+    Queries of three or more characters use the KumppaniHaku trigram index
+    and match anywhere in the text, names starting with the query first.
+    Shorter queries match the beginning of the name.
+
+    Returns:
+        list: Partner dicts with id, nimi and alvtunnus
+    """
+    query = (query or '').strip()
+    low, high = _prefix_range(query)
+
+    if len(query) >= TRIGRAM_LENGTH:
+        rows = conn.execute("""
+            SELECT k.id, k.nimi, k.alvtunnus
+            FROM KumppaniHaku h
+            JOIN Kumppani k ON k.id = h.rowid
+            WHERE KumppaniHaku MATCH ?
+            ORDER BY (k.nimi COLLATE NOCASE >= ? AND k.nimi COLLATE NOCASE < ?) DESC, h.rank, k.nimi
+            LIMIT ?
+        """, (_match_expression(query), low, high, limit))
+    else:
+        rows = conn.execute("""
+            SELECT id, nimi, alvtunnus
+            FROM Kumppani
+            WHERE nimi COLLATE NOCASE >= ? AND nimi COLLATE NOCASE < ?
+            ORDER BY nimi COLLATE NOCASE
+            LIMIT ?
+        """, (low, high, limit))
+
+    return [{'id': row['id'], 'nimi': row['nimi'], 'alvtunnus': row['alvtunnus']} for row in rows]
+
+@kumppani_bp.route('/db/<filename>/partners/search')
+def partner_search(filename):
+    """Typeahead search for partners, returning JSON"""
+    db_path = os.path.join('databases', filename)
+
+    if not os.path.exists(db_path):
+        return jsonify({"error": "Database file not found"}), 404
+
+    limit = request.args.get('limit', SEARCH_LIMIT, type=int)
+    limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+
+    partners = search_partners(get_db(filename), request.args.get('q', ''), limit)
+    return jsonify({"partners": partners})
+
+def register_blueprint(app):
+    """Register the blueprint with the main Flask app"""
+    app.register_blueprint(kumppani_bp)
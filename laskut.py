@@ -6,6 +6,12 @@ import hashlib
 from pathlib import Path
 from flask import Flask, Blueprint, render_template, request, redirect, url_for, flash, abort, g, jsonify, send_file, Response
 from werkzeug.utils import secure_filename
+from tietokanta import get_db, fetch_page, parse_page_key
+import liitteet
+from viitetiedot import get_reference_data
+from viennit import build_invoice_lines, insert_lines, parse_cents, INVOICE_RECEIVABLE_ACCOUNT
+from reskontra import get_outstanding, get_settlements
+from tili import format_cents
 
 # Create a Blueprint for invoice routes
 lasku_bp = Blueprint('lasku', __name__, template_folder='templates')
@@ -48,56 +54,18 @@ PAYMENT_METHODS = {
 ALLOWED_EXTENSIONS = {'pdf', 'jpg', 'jpeg', 'png', 'csv', 'txt', 'xls', 'xlsx', 'doc', 'docx'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 
-def get_db_connection(db_path):
-    """Create a connection to the specified database file"""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row  # Allows accessing columns by name
-    return conn
+# Asetus key holding the next invoice number; other series append '/<sarja>'
+INVOICE_SEQUENCE_KEY = 'LaskuSeuraavaId'
 
-def get_accounts(db_path):
+def get_accounts(filename):
     """Get all accounts from database"""
-    conn = get_db_connection(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT numero, json FROM Tili
-        ORDER BY numero
-    """)
-    
-    accounts = []
-    for row in cursor.fetchall():
-        json_data = json.loads(row['json']) if row['json'] else {}
-        accounts.append({
-            'numero': row['numero'],
-            'nimi': json_data.get('nimi', f"Tili {row['numero']}")
-        })
-    
-    conn.close()
-    return accounts
-
-def get_partners(db_path):
-    """Get all partners from database"""
-    conn = get_db_connection(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, nimi FROM Kumppani
-        ORDER BY nimi
-    """)
-    
-    partners = []
-    for row in cursor.fetchall():
-        partners.append({
-            'id': row['id'],
-            'nimi': row['nimi']
-        })
-    
-    conn.close()
-    return partners
+    reference = get_reference_data(get_db(filename), filename)
+    return [{'numero': account['numero'], 'nimi': account['nimi'] or f"Tili {account['numero']}"}
+            for account in reference.accounts]
 
-def get_partner_details(db_path, partner_id):
+def get_partner_details(filename, partner_id):
     """Get detailed information about a partner"""
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -112,140 +80,144 @@ def get_partner_details(db_path, partner_id):
     else:
         partner_json = {}
     
-    conn.close()
-    
     return partner, partner_json
 
-def get_allocations(db_path):
+def get_allocations(filename):
     """Get all allocations from database"""
-    conn = get_db_connection(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, json FROM Kohdennus
-        ORDER BY id
-    """)
-    
-    allocations = []
-    for row in cursor.fetchall():
-        json_data = json.loads(row['json']) if row['json'] else {}
-        name = json_data.get('nimi', {}).get('fi', f"Kohdennus {row['id']}")
-        allocations.append({
-            'id': row['id'],
-            'nimi': name
-        })
-    
-    conn.close()
-    return allocations
+    reference = get_reference_data(get_db(filename), filename)
+    return [{'id': allocation['id'], 'nimi': allocation['nimi'] or f"Kohdennus {allocation['id']}"}
+            for allocation in reference.allocations]
 
-def generate_invoice_number(db_path):
-    """Generate a sequential invoice number"""
-    conn = get_db_connection(db_path)
-    cursor = conn.cursor()
-    
-    # Get the highest invoice number
-    cursor.execute("""
-        SELECT MAX(tunniste) FROM Tosite 
-        WHERE tyyppi=1
-    """)
-    
-    result = cursor.fetchone()
-    highest_number = result[0] if result[0] else 0
-    
-    conn.close()
-    
-    # Return the next number
-    return highest_number + 1
+def allocate_invoice_number(conn, series=None):
+    """
+    Take the next invoice number of a series from its Asetus sequence.
+    Must be called inside the invoice's BEGIN IMMEDIATE transaction, so
+    concurrent invoices are numbered one after another and a rolled back
+    invoice gives its number back.
+    """
+    key = INVOICE_SEQUENCE_KEY if not series else f"{INVOICE_SEQUENCE_KEY}/{series}"
+    
+    # A series used for the first time continues from its highest number
+    conn.execute("""
+        INSERT INTO Asetus (avain, arvo)
+        SELECT ?, COALESCE(MAX(tunniste), 0) + 1 FROM Tosite
+        WHERE tyyppi = 1 AND sarja IS ?
+        ON CONFLICT (avain) DO NOTHING
+    """, (key, series))
+    
+    row = conn.execute("""
+        UPDATE Asetus SET arvo = CAST(arvo AS INTEGER) + 1, muokattu = CURRENT_TIMESTAMP
+        WHERE avain = ?
+        RETURNING CAST(arvo AS INTEGER) - 1
+    """, (key,)).fetchone()
+    
+    return row[0]
+
+def format_invoice_number(invoice):
+    """Invoice number for display, prefixed with its series"""
+    number = invoice['tunniste'] or invoice['id']  # Use tunniste if available, otherwise id
+    return f"{invoice['sarja']}-{number}" if invoice['sarja'] else number
 
 def allowed_file(filename):
     """Check if a file has an allowed extension"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def generate_file_hash(file_data):
-    """Generate SHA-256 hash for a file"""
-    return hashlib.sha256(file_data).hexdigest()
-
 @lasku_bp.route('/db/<filename>/invoices')
 def list_invoices(filename):
-    """List all invoices in a database"""
+    """List invoices in a database, one page at a time"""
     db_path = os.path.join('databases', filename)
     
     if not os.path.exists(db_path):
         flash("Tietokantaa ei löydy", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
-    # Get all invoices (vouchers with type 1 = Myyntilasku)
-    cursor.execute("""
-        SELECT id, pvm, tunniste, tila, otsikko, erapvm, kumppani, json FROM Tosite
-        WHERE tyyppi = 1
-        ORDER BY pvm DESC, id DESC
-    """)
+    # Read filters from the query string
+    filters = {
+        'tila': request.args.get('tila', type=int),
+        'erapvm_alkaen': request.args.get('erapvm_alkaen', '').strip(),
+        'erapvm_asti': request.args.get('erapvm_asti', '').strip(),
+        'eraantyneet': request.args.get('eraantyneet') == '1'
+    }
+    
+    # Only invoices (vouchers with type 1 = Myyntilasku)
+    conditions = ["t.tyyppi = 1"]
+    params = []
+    if filters['tila'] is not None:
+        conditions.append("t.tila = ?")
+        params.append(filters['tila'])
+    if filters['erapvm_alkaen']:
+        conditions.append("t.erapvm >= ?")
+        params.append(filters['erapvm_alkaen'])
+    if filters['erapvm_asti']:
+        conditions.append("t.erapvm <= ?")
+        params.append(filters['erapvm_asti'])
+    if filters['eraantyneet']:
+        # Past due and not settled (paid, credited or voided)
+        conditions.append("t.erapvm < ? AND t.tila NOT IN (4, 5, 6)")
+        params.append(datetime.date.today().isoformat())
+    
+    # Partner name, total and JSON fields come with the invoice row itself
+    rows, next_key, prev_key = fetch_page(
+        conn,
+        """
+        SELECT t.id, t.pvm, t.tunniste, t.sarja, t.tila, t.otsikko, t.erapvm,
+               k.nimi AS kumppani_nimi,
+               (SELECT SUM(v.kreditsnt) FROM Vienti v WHERE v.tosite = t.id) AS total_credit,
+               CASE WHEN json_valid(t.json) THEN json_extract(t.json, '$.maksuehto') END AS maksuehto,
+               CASE WHEN json_valid(t.json) THEN json_extract(t.json, '$.viitenumero') END AS viitenumero
+        FROM Tosite t
+        LEFT JOIN Kumppani k ON k.id = t.kumppani
+        """,
+        conditions, params,
+        after=parse_page_key(request.args.get('after')),
+        before=parse_page_key(request.args.get('before')),
+        order=('t.pvm', 't.id')
+    )
     
     invoices = []
-    for row in cursor.fetchall():
-        # Get the status
-        status = INVOICE_STATUSES.get(row['tila'], "Tuntematon")
-        
-        # Get partner name
-        partner_name = "Tuntematon"
-        if row['kumppani']:
-            cursor.execute("SELECT nimi FROM Kumppani WHERE id = ?", (row['kumppani'],))
-            partner = cursor.fetchone()
-            if partner:
-                partner_name = partner['nimi']
-        
-        # Get total amount from transactions
-        cursor.execute("""
-            SELECT SUM(kreditsnt) as total_credit FROM Vienti
-            WHERE tosite = ?
-        """, (row['id'],))
-        
-        total = cursor.fetchone()
-        total_amount = float(total['total_credit'] / 100) if total['total_credit'] else 0
-        
-        # Get JSON data
-        json_data = {}
-        if row['json']:
-            try:
-                json_data = json.loads(row['json'])
-            except:
-                pass
+    for row in rows:
+        total_amount = row['total_credit'] / 100 if row['total_credit'] else 0
         
         invoices.append({
             'id': row['id'],
-            'number': row['tunniste'] or row['id'],  # Use tunniste if available, otherwise id
+            'number': format_invoice_number(row),
             'pvm': row['pvm'],
-            'tila': status,
+            'tila': INVOICE_STATUSES.get(row['tila'], "Tuntematon"),
             'otsikko': row['otsikko'] or "Ei otsikkoa",
             'erapvm': row['erapvm'],
-            'kumppani': partner_name,
+            'kumppani': row['kumppani_nimi'] or "Tuntematon",
             'summa': f"{total_amount:.2f} €",
-            'maksuehto': json_data.get('maksuehto', ""),
-            'viitenumero': json_data.get('viitenumero', "")
+            'maksuehto': row['maksuehto'] or "",
+            'viitenumero': row['viitenumero'] or ""
         })
     
-    conn.close()
-    
     # Get client name
     client_name = ""
     try:
-        conn = get_db_connection(db_path)
-        cursor = conn.cursor()
         cursor.execute("SELECT arvo FROM Asetus WHERE avain='Nimi'")
         result = cursor.fetchone()
         if result:
             client_name = result[0]
-        conn.close()
     except:
         pass
     
+    # Keep the active filters in the paging links
+    filter_args = {key: value for key, value in filters.items() if value not in ('', None) and key != 'eraantyneet'}
+    if filters['eraantyneet']:
+        filter_args['eraantyneet'] = 1
+    
     return render_template('invoices/list.html', 
                           invoices=invoices, 
                           filename=filename, 
-                          client_name=client_name)
+                          client_name=client_name,
+                          filters=filters,
+                          filter_args=filter_args,
+                          next_key=next_key,
+                          prev_key=prev_key,
+                          invoice_statuses=INVOICE_STATUSES)
 
 @lasku_bp.route('/db/<filename>/invoices/new', methods=['GET', 'POST'])
 def new_invoice(filename):
@@ -285,8 +257,8 @@ def new_invoice(filename):
                 due_date = (datetime.datetime.strptime(invoice_date, '%Y-%m-%d') + 
                            datetime.timedelta(days=14)).strftime('%Y-%m-%d')
         
-        # Generate invoice number
-        invoice_number = generate_invoice_number(db_path)
+        # Invoice number series, None for the default series
+        series = request.form.get('sarja', '').strip() or None
         
         # JSON data for additional fields
         json_data = {
@@ -301,91 +273,29 @@ def new_invoice(filename):
             json_data['kommentti'] = comments
         
         # Create voucher (invoice) in database
-        conn = get_db_connection(db_path)
+        conn = get_db(filename)
         cursor = conn.cursor()
         
         try:
-            # Begin transaction
-            conn.execute('BEGIN')
+            # Validate every line before writing anything
+            lines, total_cents = build_invoice_lines(request.form, invoice_date)
+            
+            # Begin transaction, taking the write lock before the number is allocated
+            conn.execute('BEGIN IMMEDIATE')
+            
+            invoice_number = allocate_invoice_number(conn, series)
             
             # Insert voucher with type 1 (Myyntilasku)
             cursor.execute("""
-                INSERT INTO Tosite (pvm, tyyppi, tila, otsikko, kumppani, tunniste, erapvm, viite, json)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (invoice_date, 1, status, title, partner_id, invoice_number, due_date, 
+                INSERT INTO Tosite (pvm, tyyppi, tila, otsikko, kumppani, tunniste, sarja, erapvm, viite, json)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (invoice_date, 1, status, title, partner_id, invoice_number, series, due_date, 
                   reference, json.dumps(json_data) if json_data else None))
             
             invoice_id = cursor.lastrowid
             
-            # Process line items
-            row_index = 1
-            total_amount = 0
-            for i in range(50):  # Arbitrary limit for form input fields
-                product_key = f'tuote_{i}'
-                if product_key not in request.form or not request.form.get(product_key):
-                    continue  # Skip if no product provided
-                
-                product = request.form.get(product_key)
-                quantity = float(request.form.get(f'maara_{i}', 1))
-                price = float(request.form.get(f'hinta_{i}', 0))
-                discount = float(request.form.get(f'alennus_{i}', 0))
-                vat_percent = float(request.form.get(f'alv_percent_{i}', 24))
-                account = int(request.form.get(f'tili_{i}', 3000))  # Default to sales account
-                
-                # Calculate line amount
-                amount = quantity * price
-                
-                # Apply discount
-                if discount > 0:
-                    amount = amount * (1 - discount / 100)
-                
-                # Calculate VAT
-                vat_amount = amount * (vat_percent / 100)
-                total_line_amount = amount + vat_amount
-                total_amount += total_line_amount
-                
-                # Convert to cents
-                amount_cents = int(amount * 100)
-                vat_amount_cents = int(vat_amount * 100)
-                
-                # Get allocation if provided
-                allocation = request.form.get(f'kohdennus_{i}')
-                if allocation and allocation.strip():
-                    allocation = int(allocation)
-                else:
-                    allocation = 0  # Default allocation
-                
-                # Description for transaction
-                description = f"{product} {quantity} x {price:.2f}€"
-                if discount > 0:
-                    description += f" (Alennus: {discount}%)"
-                
-                # Insert transaction for the amount excluding VAT
-                cursor.execute("""
-                    INSERT INTO Vienti (rivi, tosite, pvm, tili, kohdennus, selite, 
-                                      kreditsnt, alvprosentti)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (row_index, invoice_id, invoice_date, account, allocation, description,
-                      amount_cents, vat_percent))
-                
-                row_index += 1
-                
-                # Insert transaction for VAT
-                if vat_percent > 0:
-                    cursor.execute("""
-                        INSERT INTO Vienti (rivi, tosite, pvm, tili, kohdennus, selite, 
-                                         kreditsnt, alvprosentti)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (row_index, invoice_id, invoice_date, 2940, allocation, f"ALV {vat_percent}%: {description}",
-                         vat_amount_cents, 0))
-                    
-                    row_index += 1
-            
-            # Transaction for accounts receivable
-            cursor.execute("""
-                INSERT INTO Vienti (rivi, tosite, pvm, tili, selite, debetsnt)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (row_index, invoice_id, invoice_date, 1700, "Myyntisaamiset", int(total_amount * 100)))
+            # Insert all transactions at once
+            insert_lines(cursor, invoice_id, lines)
             
             # Handle file attachments
             if 'attachment' in request.files:
@@ -394,43 +304,35 @@ def new_invoice(filename):
                 for i, file in enumerate(files):
                     if file and file.filename and allowed_file(file.filename):
                         filename_secure = secure_filename(file.filename)
-                        file_data = file.read()
                         
-                        # Check file size
-                        if len(file_data) > MAX_FILE_SIZE:
+                        # Stream the upload to disk, hashing and checking its size on the way
+                        try:
+                            staged = liitteet.store.stage(filename, file.stream, MAX_FILE_SIZE)
+                        except liitteet.FileTooLarge:
                             flash(f"Tiedosto {filename_secure} on liian suuri (max 10MB sallittu)", "error")
                             continue
                         
                         # Determine file type
                         file_type = file.content_type or 'application/octet-stream'
                         
-                        # Generate hash
-                        file_hash = generate_file_hash(file_data)
-                        
                         # Role name - 'original' for first attachment, numbered for others
                         role_name = "original" if i == 0 else f"attachment{i}"
                         
-                        # Store in database
-                        cursor.execute("""
-                            INSERT INTO Liite (tosite, nimi, roolinimi, tyyppi, sha, data)
-                            VALUES (?, ?, ?, ?, ?, ?)
-                        """, (invoice_id, filename_secure, role_name, file_type, file_hash, file_data))
+                        # Store metadata in database and the content in the attachment store
+                        liitteet.store.add(cursor, filename, invoice_id, filename_secure, role_name, file_type, staged)
             
             # Commit transaction
             conn.commit()
-            flash(f"Lasku luotu onnistuneesti numerolla: {invoice_number}", "success")
+            flash(f"Lasku luotu onnistuneesti numerolla: {format_invoice_number({'id': invoice_id, 'tunniste': invoice_number, 'sarja': series})}", "success")
             return redirect(url_for('lasku.view_invoice', filename=filename, invoice_id=invoice_id))
         
         except Exception as e:
             conn.rollback()
             flash(f"Virhe laskun luonnissa: {str(e)}", "error")
-        finally:
-            conn.close()
     
     # Get data for form fields
-    accounts = get_accounts(db_path)
-    partners = get_partners(db_path)
-    allocations = get_allocations(db_path)
+    accounts = get_accounts(filename)
+    allocations = get_allocations(filename)
     
     # Get default sales accounts
     default_accounts = []
@@ -447,7 +349,6 @@ def new_invoice(filename):
                           payment_methods=PAYMENT_METHODS,
                           accounts=accounts,
                           default_accounts=default_accounts,
-                          partners=partners,
                           allocations=allocations,
                           today=datetime.date.today().isoformat())
 
@@ -460,12 +361,12 @@ def view_invoice(filename, invoice_id):
         flash("Tietokantaa ei löydy", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
     # Get invoice details (as a voucher with type 1 = Myyntilasku)
     cursor.execute("""
-        SELECT id, pvm, tunniste, tila, otsikko, kumppani, laskupvm, erapvm, viite, json
+        SELECT id, pvm, tunniste, sarja, tila, otsikko, kumppani, laskupvm, erapvm, viite, json
         FROM Tosite
         WHERE id = ? AND tyyppi = 1
     """, (invoice_id,))
@@ -473,7 +374,6 @@ def view_invoice(filename, invoice_id):
     invoice = cursor.fetchone()
     
     if not invoice:
-        conn.close()
         flash("Laskua ei löydy", "error")
         return redirect(url_for('lasku.list_invoices', filename=filename))
     
@@ -492,7 +392,7 @@ def view_invoice(filename, invoice_id):
     partner = None
     partner_json = {}
     if invoice['kumppani']:
-        partner, partner_json = get_partner_details(db_path, invoice['kumppani'])
+        partner, partner_json = get_partner_details(filename, invoice['kumppani'])
     
     # Get transactions
     cursor.execute("""
@@ -507,20 +407,16 @@ def view_invoice(filename, invoice_id):
     total_amount = 0
     total_vat = 0
     
-    for row in cursor.fetchall():
+    rows = cursor.fetchall()
+    
+    # Account names from the shared reference data
+    account_names = get_reference_data(conn, filename).account_names
+    
+    for row in rows:
         debit_amount = row['debetsnt'] / 100 if row['debetsnt'] else 0
         credit_amount = row['kreditsnt'] / 100 if row['kreditsnt'] else 0
         
-        # Get account details
-        account_name = ""
-        cursor.execute("SELECT json FROM Tili WHERE numero = ?", (row['tili'],))
-        account_result = cursor.fetchone()
-        if account_result and account_result['json']:
-            try:
-                account_data = json.loads(account_result['json'])
-                account_name = account_data.get('nimi', '')
-            except:
-                pass
+        account_name = account_names.get(row['tili'], "")
         
         # Add to transactions
         transactions.append({
@@ -566,18 +462,21 @@ def view_invoice(filename, invoice_id):
             'tyyppi': row['tyyppi']
         })
     
+    # Payments settling the invoice and the amount still outstanding
+    payments = [{'tosite': tosite, 'pvm': pvm, 'selite': selite, 'summa': (credit - debit) / 100}
+                for tosite, pvm, selite, debit, credit in get_settlements(conn, invoice_id)]
+    outstanding = get_outstanding(conn, invoice_id) / 100
+    
     # Get client information
     client_info = {}
     cursor.execute("SELECT avain, arvo FROM Asetus")
     for row in cursor.fetchall():
         client_info[row['avain']] = row['arvo']
     
-    conn.close()
-    
     return render_template('invoices/view.html',
                           filename=filename,
                           invoice=invoice,
-                          invoice_number=invoice['tunniste'] or invoice['id'],
+                          invoice_number=format_invoice_number(invoice),
                           json_data=json_data,
                           partner=partner,
                           partner_json=partner_json,
@@ -588,6 +487,8 @@ def view_invoice(filename, invoice_id):
                           total_amount=total_amount,
                           total_vat=total_vat,
                           total_with_vat=total_amount+total_vat,
+                          payments=payments,
+                          outstanding=outstanding,
                           client_info=client_info,
                           attachments=attachments)
 
@@ -600,12 +501,12 @@ def view_attachment(filename, invoice_id, attachment_id):
         flash("Tietokantaa ei löydy", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
     # Get attachment details
     cursor.execute("""
-        SELECT nimi, tyyppi, data 
+        SELECT id, nimi, tyyppi, sha, data IS NOT NULL AS tietokannassa
         FROM Liite 
         WHERE id = ? AND tosite = ?
     """, (attachment_id, invoice_id))
@@ -613,22 +514,14 @@ def view_attachment(filename, invoice_id, attachment_id):
     attachment = cursor.fetchone()
     
     if not attachment:
-        conn.close()
         flash("Liitettä ei löydy", "error")
         return redirect(url_for('lasku.view_invoice', filename=filename, invoice_id=invoice_id))
     
-    file_data = attachment['data']
-    file_type = attachment['tyyppi']
-    file_name = attachment['nimi']
-    
-    conn.close()
-    
-    # Send the file to the client
-    return Response(
-        file_data,
-        mimetype=file_type,
-        headers={"Content-Disposition": f"inline; filename={file_name}"}
-    )
+    # Stream the file to the client
+    response = liitteet.send_attachment(filename, attachment)
+    if response is None:
+        abort(404)
+    return response
 
 @lasku_bp.route('/db/<filename>/invoices/<int:invoice_id>/delete', methods=['POST'])
 def delete_invoice(filename, invoice_id):
@@ -639,7 +532,7 @@ def delete_invoice(filename, invoice_id):
         flash("Tietokantaa ei löydy", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     
     try:
         # Verify this is an invoice
@@ -648,61 +541,72 @@ def delete_invoice(filename, invoice_id):
         result = cursor.fetchone()
         
         if not result or result['tyyppi'] != 1:
-            conn.close()
             flash("Laskua ei löydy", "error")
             return redirect(url_for('lasku.list_invoices', filename=filename))
         
-        # Delete invoice - transactions will be deleted automatically due to CASCADE constraint
+        # Delete invoice with its transactions and attachments (ON DELETE CASCADE is not enforced)
+        conn.execute("DELETE FROM Vienti WHERE tosite = ?", (invoice_id,))
+        conn.execute("DELETE FROM Liite WHERE tosite = ?", (invoice_id,))
         conn.execute("DELETE FROM Tosite WHERE id = ?", (invoice_id,))
         conn.commit()
+        
+        # Remove attachment files no other voucher refers to
+        liitteet.store.collect(conn, filename)
         flash("Lasku poistettu onnistuneesti", "success")
     except Exception as e:
         conn.rollback()
         flash(f"Virhe laskun poistamisessa: {str(e)}", "error")
-    finally:
-        conn.close()
     
     return redirect(url_for('lasku.list_invoices', filename=filename))
 
 @lasku_bp.route('/db/<filename>/invoices/<int:invoice_id>/mark-paid', methods=['POST'])
 def mark_invoice_paid(filename, invoice_id):
-    """Mark an invoice as paid"""
+    """Record a payment of an invoice, marking it paid or partially paid"""
     db_path = os.path.join('databases', filename)
     
     if not os.path.exists(db_path):
         flash("Tietokantaa ei löydy", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
     try:
+        # Begin transaction, taking the write lock before the invoice and its
+        # outstanding amount are read, so concurrent payments are serialized
+        conn.execute('BEGIN IMMEDIATE')
+        
         # Verify this is an invoice
         cursor.execute("SELECT tyyppi, tila FROM Tosite WHERE id = ?", (invoice_id,))
         result = cursor.fetchone()
         
         if not result or result['tyyppi'] != 1:
-            conn.close()
+            conn.rollback()
             flash("Laskua ei löydy", "error")
             return redirect(url_for('lasku.list_invoices', filename=filename))
         
         # Check if already paid
         if result['tila'] == 4:
-            conn.close()
+            conn.rollback()
             flash("Lasku on jo merkitty maksetuksi", "warning")
             return redirect(url_for('lasku.view_invoice', filename=filename, invoice_id=invoice_id))
         
-        # Begin transaction
-        conn.execute('BEGIN')
-        
-        # Update invoice status to Paid (4)
-        conn.execute("UPDATE Tosite SET tila = 4 WHERE id = ?", (invoice_id,))
-        
         # Get payment details from form
         payment_date = request.form.get('payment_date', datetime.date.today().isoformat())
         payment_amount = request.form.get('payment_amount')
         payment_account = request.form.get('payment_account', '1910')  # Default bank account
         
+        # Pay the outstanding amount if none is given; a smaller one is a partial payment
+        outstanding = get_outstanding(conn, invoice_id)
+        if payment_amount and payment_amount.strip():
+            payment_cents = parse_cents(payment_amount, 'payment amount')
+        else:
+            payment_cents = outstanding
+        if payment_cents <= 0:
+            raise ValueError("Maksettu summa puuttuu")
+        if payment_cents > outstanding:
+            raise ValueError(f"Maksettu summa on suurempi kuin avoin saldo {format_cents(outstanding)} €")
+        
         # Create payment voucher
         cursor.execute("""
             INSERT INTO Tosite (pvm, tyyppi, tila, otsikko)
@@ -711,31 +615,24 @@ def mark_invoice_paid(filename, invoice_id):
         
         payment_id = cursor.lastrowid
         
-        # Get total amount if not provided
-        if not payment_amount:
-            cursor.execute("""
-                SELECT SUM(debetsnt) as total_debit FROM Vienti
-                WHERE tosite = ? AND tili = 1700
-            """, (invoice_id,))
-            total = cursor.fetchone()
-            payment_amount = total['total_debit'] / 100 if total['total_debit'] else 0
-        else:
-            payment_amount = float(payment_amount)
-        
         # Create transactions for payment voucher
         # Debit bank account
         cursor.execute("""
             INSERT INTO Vienti (rivi, tosite, pvm, tili, selite, debetsnt)
             VALUES (?, ?, ?, ?, ?, ?)
         """, (1, payment_id, payment_date, int(payment_account), 
-              f"Maksusuoritus laskulle #{invoice_id}", int(payment_amount * 100)))
+              f"Maksusuoritus laskulle #{invoice_id}", payment_cents))
         
-        # Credit accounts receivable
+        # Credit accounts receivable, settling the invoice's open item
         cursor.execute("""
             INSERT INTO Vienti (rivi, tosite, pvm, tili, selite, kreditsnt, eraid)
             VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (2, payment_id, payment_date, 1700, 
-              f"Maksusuoritus laskulle #{invoice_id}", int(payment_amount * 100), invoice_id))
+        """, (2, payment_id, payment_date, INVOICE_RECEIVABLE_ACCOUNT, 
+              f"Maksusuoritus laskulle #{invoice_id}", payment_cents, invoice_id))
+        
+        # Paid (4) once nothing is outstanding, otherwise partially paid (3)
+        outstanding = get_outstanding(conn, invoice_id)
+        conn.execute("UPDATE Tosite SET tila = ? WHERE id = ?", (4 if outstanding <= 0 else 3, invoice_id))
         
         # Link the two vouchers
         payment_json = {"linked_invoice": invoice_id}
@@ -763,12 +660,13 @@ def mark_invoice_paid(filename, invoice_id):
         
         # Commit transaction
         conn.commit()
-        flash("Lasku merkitty maksetuksi ja maksusuoritus kirjattu", "success")
+        if outstanding > 0:
+            flash(f"Osasuoritus kirjattu, laskusta avoinna {format_cents(outstanding)} €", "success")
+        else:
+            flash("Lasku merkitty maksetuksi ja maksusuoritus kirjattu", "success")
     except Exception as e:
         conn.rollback()
         flash(f"Virhe laskun maksetuksi merkitsemisessä: {str(e)}", "error")
-    finally:
-        conn.close()
     
     return redirect(url_for('lasku.view_invoice', filename=filename, invoice_id=invoice_id))
 
@@ -781,12 +679,12 @@ def print_invoice(filename, invoice_id):
         flash("Tietokantaa ei löydy", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
     # Get invoice details
     cursor.execute("""
-        SELECT id, pvm, tunniste, tila, otsikko, kumppani, laskupvm, erapvm, viite, json
+        SELECT id, pvm, tunniste, sarja, tila, otsikko, kumppani, laskupvm, erapvm, viite, json
         FROM Tosite
         WHERE id = ? AND tyyppi = 1
     """, (invoice_id,))
@@ -794,7 +692,6 @@ def print_invoice(filename, invoice_id):
     invoice = cursor.fetchone()
     
     if not invoice:
-        conn.close()
         flash("Laskua ei löydy", "error")
         return redirect(url_for('lasku.list_invoices', filename=filename))
     
@@ -810,7 +707,7 @@ def print_invoice(filename, invoice_id):
     partner = None
     partner_json = {}
     if invoice['kumppani']:
-        partner, partner_json = get_partner_details(db_path, invoice['kumppani'])
+        partner, partner_json = get_partner_details(filename, invoice['kumppani'])
     
     # Get transactions (invoice lines)
     cursor.execute("""
@@ -850,13 +747,11 @@ def print_invoice(filename, invoice_id):
     for row in cursor.fetchall():
         client_info[row['avain']] = row['arvo']
     
-    conn.close()
-    
     # Render the invoice template
     return render_template('invoices/print.html',
                           filename=filename,
                           invoice=invoice,
-                          invoice_number=invoice['tunniste'] or invoice['id'],
+                          invoice_number=format_invoice_number(invoice),
                           json_data=json_data,
                           partner=partner,
                           partner_json=partner_json,
@@ -0,0 +1,326 @@
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+from flask import request, send_file, Response
+from werkzeug.wsgi import wrap_file
+from tietokanta import DATABASE_DIR, ensure_schema, connect
+
+# Attachment files of each client database, named by their SHA-256
+ATTACHMENT_DIR = os.path.join(DATABASE_DIR, '.liitteet')
+
+# Bytes read at a time when hashing and copying uploads
+COPY_CHUNK_SIZE = 64 * 1024
+
+# Unfinished uploads older than this are removed by collect_garbage
+STALE_UPLOAD_AGE = 3600
+
+class FileTooLarge(ValueError):
+    """Raised when an upload exceeds the allowed size"""
+
+class StagedFile:
+    """An upload written to a temporary file and hashed, not yet in the store"""
+
+    def __init__(self, sha, size, temp_path):
+        self.sha = sha
+        self.size = size
+        self.temp_path = temp_path
+
+    def discard(self):
+        """Remove the temporary file if it was never linked into the store"""
+        if self.temp_path:
+            try:
+                os.unlink(self.temp_path)
+            except FileNotFoundError:
+                pass
+            self.temp_path = None
+
+class AttachmentStore:
+    """
+    Content-addressed storage for attachment files, one directory per client
+    database. Liite rows keep the metadata and the SHA-256 of the content;
+    identical files are stored once and LiiteTiedosto counts their references.
+    """
+
+    def __init__(self, directory=ATTACHMENT_DIR):
+        self.directory = directory
+
+    def _client_dir(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def path(self, filename, sha):
+        """Path of a stored file"""
+        return os.path.join(self._client_dir(filename), sha[:2], sha)
+
+    def exists(self, filename, sha):
+        return bool(sha) and os.path.exists(self.path(filename, sha))
+
+    def stage(self, filename, stream, max_size=None):
+        """
+        Copy an upload to a temporary file in chunks, hashing it on the way.
+
+        Raises:
+            FileTooLarge: If the upload is larger than max_size bytes
+        """
+        temp_dir = os.path.join(self._client_dir(filename), 'tmp')
+        os.makedirs(temp_dir, exist_ok=True)
+
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = stream.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise FileTooLarge(f"File is larger than {max_size} bytes")
+                    digest.update(chunk)
+                    out.write(chunk)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+        return StagedFile(digest.hexdigest(), size, temp_path)
+
+    def stage_bytes(self, filename, data):
+        """Stage content that is already in memory"""
+        digest = hashlib.sha256(data).hexdigest()
+        temp_dir = os.path.join(self._client_dir(filename), 'tmp')
+        os.makedirs(temp_dir, exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        return StagedFile(digest, len(data), temp_path)
+
+    def link(self, filename, staged):
+        """Move a staged file to its place in the store, or drop it if the content is already there"""
+        target = self.path(filename, staged.sha)
+        if os.path.exists(target):
+            staged.discard()
+            return target
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(staged.temp_path, target)
+        staged.temp_path = None
+        return target
+
+    def add(self, cursor, filename, voucher_id, name, role_name, file_type, staged):
+        """
+        Insert the Liite row for a staged file and link the file into the store.
+        Must be called inside the write transaction, so that collect() cannot
+        remove the file between the insert and the commit.
+
+        Returns:
+            int: The id of the new Liite row
+        """
+        cursor.execute("""
+            INSERT INTO Liite (tosite, nimi, roolinimi, tyyppi, sha, data)
+            VALUES (?, ?, ?, ?, ?, NULL)
+        """, (voucher_id, name, role_name, file_type, staged.sha))
+        attachment_id = cursor.lastrowid
+        self.link(filename, staged)
+        return attachment_id
+
+    def collect(self, conn, filename):
+        """
+        Remove the files no Liite row refers to any more.
+        Runs in a write transaction so a concurrent upload of the same content
+        either links its file after the removal or keeps the reference alive.
+
+        Returns:
+            int: Number of files removed
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            unreferenced = [row[0] for row in conn.execute("SELECT sha FROM LiiteTiedosto WHERE viittaukset <= 0")]
+            for sha in unreferenced:
+                try:
+                    os.unlink(self.path(filename, sha))
+                except FileNotFoundError:
+                    pass
+            conn.executemany("DELETE FROM LiiteTiedosto WHERE sha = ?", [(sha,) for sha in unreferenced])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        return len(unreferenced)
+
+    def collect_garbage(self, conn, filename):
+        """
+        Remove unreferenced files, stored files without a reference row
+        (left behind by rolled back uploads) and stale unfinished uploads.
+
+        Returns:
+            int: Number of files removed
+        """
+        removed = self.collect(conn, filename)
+        client_dir = self._client_dir(filename)
+        if not os.path.isdir(client_dir):
+            return removed
+
+        limit = time.time() - STALE_UPLOAD_AGE
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            referenced = {row[0] for row in conn.execute("SELECT sha FROM LiiteTiedosto")}
+            for root, _, files in os.walk(client_dir):
+                in_tmp = os.path.basename(root) == 'tmp'
+                for name in files:
+                    path = os.path.join(root, name)
+                    if in_tmp:
+                        if os.path.getmtime(path) < limit:
+                            os.unlink(path)
+                            removed += 1
+                    elif name not in referenced:
+                        os.unlink(path)
+                        removed += 1
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        return removed
+
+store = AttachmentStore()
+
+class BlobReader:
+    """
+    File-like reader over a Liite.data BLOB using SQLite incremental BLOB I/O.
+    Has its own read-only connection, as the response is streamed after the
+    request has returned its pooled connection.
+    """
+
+    def __init__(self, filename, attachment_id):
+        path = os.path.abspath(os.path.join(DATABASE_DIR, filename))
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        try:
+            self._blob = self._conn.blobopen('Liite', 'data', attachment_id, readonly=True)
+        except Exception:
+            self._conn.close()
+            raise
+
+    def __len__(self):
+        return len(self._blob)
+
+    def read(self, size=-1):
+        return self._blob.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._blob.seek(offset, whence)
+        return self._blob.tell()
+
+    def tell(self):
+        return self._blob.tell()
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._blob.close()
+        self._conn.close()
+
+def send_attachment(filename, attachment):
+    """
+    Stream an attachment in chunks, with Range requests and conditional GET
+    answered from the ETag (the content SHA-256).
+
+    Args:
+        filename (str): Client database filename
+        attachment: Liite row with id, nimi, tyyppi, sha and tietokannassa
+                    (whether the content is still in Liite.data)
+    """
+    mimetype = attachment['tyyppi'] or 'application/octet-stream'
+
+    if not attachment['tietokannassa']:
+        if not store.exists(filename, attachment['sha']):
+            return None
+        return send_file(os.path.abspath(store.path(filename, attachment['sha'])),
+                         mimetype=mimetype,
+                         download_name=attachment['nimi'],
+                         conditional=True,
+                         etag=attachment['sha'])
+
+    # Content not migrated to the store yet
+    reader = BlobReader(filename, attachment['id'])
+    response = Response(wrap_file(request.environ, reader), mimetype=mimetype, direct_passthrough=True)
+    response.content_length = len(reader)
+    response.headers.set('Content-Disposition', 'inline', filename=attachment['nimi'])
+    if attachment['sha']:
+        response.set_etag(attachment['sha'])
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(reader))
+
+def migrate_attachments(conn, filename, attachment_store=store):
+    """
+    Move attachment content stored in Liite.data into the attachment store.
+    Each row is committed on its own, so the migration can be interrupted
+    and resumed.
+
+    Returns:
+        int: Number of attachments moved
+    """
+    moved = 0
+    row_ids = [row[0] for row in conn.execute("SELECT id FROM Liite WHERE data IS NOT NULL")]
+
+    for attachment_id in row_ids:
+        data = conn.execute("SELECT data FROM Liite WHERE id = ?", (attachment_id,)).fetchone()[0]
+        if data is None:
+            continue
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        staged = attachment_store.stage_bytes(filename, data)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("UPDATE Liite SET sha = ?, data = NULL WHERE id = ?", (staged.sha, attachment_id))
+            attachment_store.link(filename, staged)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            staged.discard()
+            raise
+        moved += 1
+
+    return moved
+
+def main(argv=None):
+    """Move attachments out of client databases, or clean up the attachment store"""
+    parser = argparse.ArgumentParser(description="Manage the attachment store of client databases")
+    parser.add_argument('command', choices=['migrate', 'gc'])
+    parser.add_argument('databases', nargs='*', help="Database filenames (default: all in the database directory)")
+    parser.add_argument('--vacuum', action='store_true', help="VACUUM each database after migrating")
+    parser.add_argument('--directory', default=DATABASE_DIR)
+    args = parser.parse_intermixed_args(argv)
+
+    attachment_store = AttachmentStore(os.path.join(args.directory, '.liitteet'))
+    filenames = args.databases or sorted(name for name in os.listdir(args.directory) if name.endswith('.db'))
+    failed = False
+
+    for filename in filenames:
+        conn = connect(os.path.join(args.directory, filename))
+        try:
+            ensure_schema(conn)
+            if args.command == 'migrate':
+                moved = migrate_attachments(conn, filename, attachment_store)
+                if args.vacuum and moved:
+                    conn.execute("VACUUM")
+                print(f"{filename}: moved {moved} attachments")
+            else:
+                removed = attachment_store.collect_garbage(conn, filename)
+                print(f"{filename}: removed {removed} files")
+        except (sqlite3.Error, OSError) as e:
+            failed = True
+            print(f"{filename}: error: {e}")
+        finally:
+            conn.close()
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,700 @@
+import os
+import sys
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# Directory holding the client database files
+DATABASE_DIR = 'databases'
+
+# Asetus key of the last migration applied to a client database
+VERSION_KEY = 'SkeemaVersio'
+
+# Parallel workers for bulk migrations
+MIGRATION_WORKERS = 4
+
+# Fills Saldo from the ledger when it is empty
+BALANCE_BACKFILL = """
+    INSERT INTO Saldo (tili, kausi, debetsnt, kreditsnt)
+    SELECT tili, COALESCE(substr(pvm, 1, 7), ''), SUM(COALESCE(debetsnt, 0)), SUM(COALESCE(kreditsnt, 0))
+    FROM Vienti
+    WHERE NOT EXISTS (SELECT 1 FROM Saldo)
+    GROUP BY 1, 2
+"""
+
+# Fills KohdennusSaldo from the ledger when it is empty
+ALLOCATION_BALANCE_BACKFILL = """
+    INSERT INTO KohdennusSaldo (tili, kohdennus, kausi, debetsnt, kreditsnt, rivit)
+    SELECT tili, COALESCE(kohdennus, 0), COALESCE(substr(pvm, 1, 7), ''),
+           SUM(COALESCE(debetsnt, 0)), SUM(COALESCE(kreditsnt, 0)), COUNT(*)
+    FROM Vienti
+    WHERE NOT EXISTS (SELECT 1 FROM KohdennusSaldo)
+    GROUP BY 1, 2, 3
+"""
+
+# Reskontra backfill of migration 10, which took every receivable line
+# (tili 1700) as an item; superseded by OPEN_ITEM_BACKFILL in migration 12
+RECEIVABLE_ITEM_BACKFILL = """
+    INSERT INTO Reskontra (eraid, debetsnt, kreditsnt, rivit)
+    SELECT COALESCE(eraid, tosite), SUM(COALESCE(debetsnt, 0)), SUM(COALESCE(kreditsnt, 0)), COUNT(*)
+    FROM Vienti
+    WHERE tili = 1700 AND COALESCE(eraid, tosite) IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM Reskontra)
+    GROUP BY 1
+"""
+
+# Fills Reskontra from the receivable lines (tili 1700) of sales invoices
+# (Tosite.tyyppi 1) when it is empty. An invoice's own receivable line has no
+# eraid, so the item is its voucher; payments refer to the invoice through eraid.
+OPEN_ITEM_BACKFILL = """
+    INSERT INTO Reskontra (eraid, debetsnt, kreditsnt, rivit)
+    SELECT t.id, SUM(COALESCE(v.debetsnt, 0)), SUM(COALESCE(v.kreditsnt, 0)), COUNT(*)
+    FROM Vienti v
+    JOIN Tosite t ON t.id = COALESCE(v.eraid, v.tosite)
+    WHERE v.tili = 1700 AND t.tyyppi = 1
+      AND NOT EXISTS (SELECT 1 FROM Reskontra)
+    GROUP BY 1
+"""
+
+# Schema migrations as (version, description, statements), applied in order.
+# Append new ones at the end; never renumber or edit a released migration.
+# The statements are idempotent, so databases that got them before version
+# tracking existed are brought up to date without changes.
+MIGRATIONS = [
+    (1, "Indexes for voucher lists and account ledgers", [
+        # Voucher lists filtered by type and paged by (pvm, id)
+        "CREATE INDEX IF NOT EXISTS tosite_tyyppi_pvm ON Tosite(tyyppi, pvm, id)",
+
+        # Account ledger pages seek by (tili, pvm, id)
+        "CREATE INDEX IF NOT EXISTS vienti_tili_pvm ON Vienti(tili, pvm, id)",
+    ]),
+
+    (2, "Monthly account balances (Saldo)", [
+        # Account balances per month (kausi = 'YYYY-MM'), kept in step with Vienti by triggers
+        """
+        CREATE TABLE IF NOT EXISTS Saldo (
+            tili INTEGER NOT NULL,
+            kausi VARCHAR(7) NOT NULL,
+            debetsnt BIGINT NOT NULL DEFAULT 0,
+            kreditsnt BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (tili, kausi)
+        )
+        """,
+        BALANCE_BACKFILL,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_saldo_insert AFTER INSERT ON Vienti
+        BEGIN
+            INSERT INTO Saldo (tili, kausi, debetsnt, kreditsnt)
+            VALUES (NEW.tili, COALESCE(substr(NEW.pvm, 1, 7), ''), COALESCE(NEW.debetsnt, 0), COALESCE(NEW.kreditsnt, 0))
+            ON CONFLICT (tili, kausi) DO UPDATE SET
+                debetsnt = debetsnt + excluded.debetsnt,
+                kreditsnt = kreditsnt + excluded.kreditsnt;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_saldo_delete AFTER DELETE ON Vienti
+        BEGIN
+            UPDATE Saldo SET
+                debetsnt = debetsnt - COALESCE(OLD.debetsnt, 0),
+                kreditsnt = kreditsnt - COALESCE(OLD.kreditsnt, 0)
+            WHERE tili = OLD.tili AND kausi = COALESCE(substr(OLD.pvm, 1, 7), '');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_saldo_update AFTER UPDATE OF tili, pvm, debetsnt, kreditsnt ON Vienti
+        BEGIN
+            UPDATE Saldo SET
+                debetsnt = debetsnt - COALESCE(OLD.debetsnt, 0),
+                kreditsnt = kreditsnt - COALESCE(OLD.kreditsnt, 0)
+            WHERE tili = OLD.tili AND kausi = COALESCE(substr(OLD.pvm, 1, 7), '');
+            INSERT INTO Saldo (tili, kausi, debetsnt, kreditsnt)
+            VALUES (NEW.tili, COALESCE(substr(NEW.pvm, 1, 7), ''), COALESCE(NEW.debetsnt, 0), COALESCE(NEW.kreditsnt, 0))
+            ON CONFLICT (tili, kausi) DO UPDATE SET
+                debetsnt = debetsnt + excluded.debetsnt,
+                kreditsnt = kreditsnt + excluded.kreditsnt;
+        END
+        """,
+    ]),
+
+    (3, "Attachment store reference counts (LiiteTiedosto)", [
+        # Attachment files live in the attachment store; LiiteTiedosto counts the
+        # Liite rows referring to each file, kept in step by triggers
+        "CREATE INDEX IF NOT EXISTS liite_sha ON Liite(sha)",
+        """
+        CREATE TABLE IF NOT EXISTS LiiteTiedosto (
+            sha TEXT PRIMARY KEY NOT NULL,
+            viittaukset INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        INSERT INTO LiiteTiedosto (sha, viittaukset)
+        SELECT sha, COUNT(*) FROM Liite
+        WHERE sha IS NOT NULL AND NOT EXISTS (SELECT 1 FROM LiiteTiedosto)
+        GROUP BY sha
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS liite_tiedosto_insert AFTER INSERT ON Liite
+        WHEN NEW.sha IS NOT NULL
+        BEGIN
+            INSERT INTO LiiteTiedosto (sha, viittaukset) VALUES (NEW.sha, 1)
+            ON CONFLICT (sha) DO UPDATE SET viittaukset = viittaukset + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS liite_tiedosto_delete AFTER DELETE ON Liite
+        WHEN OLD.sha IS NOT NULL
+        BEGIN
+            UPDATE LiiteTiedosto SET viittaukset = viittaukset - 1 WHERE sha = OLD.sha;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS liite_tiedosto_update AFTER UPDATE OF sha ON Liite
+        WHEN OLD.sha IS NOT NEW.sha
+        BEGIN
+            UPDATE LiiteTiedosto SET viittaukset = viittaukset - 1 WHERE sha = OLD.sha;
+            INSERT INTO LiiteTiedosto (sha, viittaukset) SELECT NEW.sha, 1 WHERE NEW.sha IS NOT NULL
+            ON CONFLICT (sha) DO UPDATE SET viittaukset = viittaukset + 1;
+        END
+        """,
+    ]),
+
+    (4, "Partner typeahead search (KumppaniHaku)", [
+        # Partner typeahead: case-insensitive prefix scans on the name, and a trigram
+        # index over name, VAT id and IBANs (rowid = Kumppani.id) kept in step by triggers
+        "CREATE INDEX IF NOT EXISTS kumppani_nimi_nocase ON Kumppani(nimi COLLATE NOCASE)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS KumppaniHaku USING fts5(nimi, alvtunnus, iban, tokenize='trigram')",
+        """
+        INSERT INTO KumppaniHaku (rowid, nimi, alvtunnus, iban)
+        SELECT k.id, k.nimi, k.alvtunnus, (SELECT group_concat(iban, ' ') FROM KumppaniIban WHERE kumppani = k.id)
+        FROM Kumppani k
+        WHERE NOT EXISTS (SELECT 1 FROM KumppaniHaku)
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kumppani_haku_insert AFTER INSERT ON Kumppani
+        BEGIN
+            INSERT INTO KumppaniHaku (rowid, nimi, alvtunnus, iban)
+            VALUES (NEW.id, NEW.nimi, NEW.alvtunnus, (SELECT group_concat(iban, ' ') FROM KumppaniIban WHERE kumppani = NEW.id));
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kumppani_haku_update AFTER UPDATE OF nimi, alvtunnus ON Kumppani
+        BEGIN
+            UPDATE KumppaniHaku SET nimi = NEW.nimi, alvtunnus = NEW.alvtunnus WHERE rowid = NEW.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kumppani_haku_delete AFTER DELETE ON Kumppani
+        BEGIN
+            DELETE FROM KumppaniHaku WHERE rowid = OLD.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kumppani_iban_haku_insert AFTER INSERT ON KumppaniIban
+        BEGIN
+            UPDATE KumppaniHaku SET iban = (SELECT group_concat(iban, ' ') FROM KumppaniIban WHERE kumppani = NEW.kumppani)
+            WHERE rowid = NEW.kumppani;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kumppani_iban_haku_delete AFTER DELETE ON KumppaniIban
+        BEGIN
+            UPDATE KumppaniHaku SET iban = (SELECT group_concat(iban, ' ') FROM KumppaniIban WHERE kumppani = OLD.kumppani)
+            WHERE rowid = OLD.kumppani;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kumppani_iban_haku_update AFTER UPDATE ON KumppaniIban
+        BEGIN
+            UPDATE KumppaniHaku SET iban = (SELECT group_concat(iban, ' ') FROM KumppaniIban WHERE kumppani = OLD.kumppani)
+            WHERE rowid = OLD.kumppani;
+            UPDATE KumppaniHaku SET iban = (SELECT group_concat(iban, ' ') FROM KumppaniIban WHERE kumppani = NEW.kumppani)
+            WHERE rowid = NEW.kumppani;
+        END
+        """,
+    ]),
+
+    (5, "Voucher full-text search (TositeHaku, VientiHaku)", [
+        # Full-text search: voucher titles and partner names (rowid = Tosite.id), and
+        # line descriptions (rowid = Vienti.id), kept in step with the ledger by triggers
+        "CREATE VIRTUAL TABLE IF NOT EXISTS TositeHaku USING fts5(otsikko, kumppani, prefix='2 3')",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS VientiHaku USING fts5(selite, tosite UNINDEXED, prefix='2 3')",
+        """
+        INSERT INTO TositeHaku (rowid, otsikko, kumppani)
+        SELECT t.id, t.otsikko, k.nimi
+        FROM Tosite t
+        LEFT JOIN Kumppani k ON k.id = t.kumppani
+        WHERE NOT EXISTS (SELECT 1 FROM TositeHaku)
+        """,
+        """
+        INSERT INTO VientiHaku (rowid, selite, tosite)
+        SELECT id, selite, tosite FROM Vienti
+        WHERE selite IS NOT NULL AND selite != '' AND NOT EXISTS (SELECT 1 FROM VientiHaku)
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS tosite_haku_insert AFTER INSERT ON Tosite
+        BEGIN
+            INSERT INTO TositeHaku (rowid, otsikko, kumppani)
+            VALUES (NEW.id, NEW.otsikko, (SELECT nimi FROM Kumppani WHERE id = NEW.kumppani));
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS tosite_haku_update AFTER UPDATE OF otsikko, kumppani ON Tosite
+        BEGIN
+            UPDATE TositeHaku SET otsikko = NEW.otsikko, kumppani = (SELECT nimi FROM Kumppani WHERE id = NEW.kumppani)
+            WHERE rowid = NEW.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS tosite_haku_delete AFTER DELETE ON Tosite
+        BEGIN
+            DELETE FROM TositeHaku WHERE rowid = OLD.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_haku_insert AFTER INSERT ON Vienti
+        WHEN NEW.selite IS NOT NULL AND NEW.selite != ''
+        BEGIN
+            INSERT INTO VientiHaku (rowid, selite, tosite) VALUES (NEW.id, NEW.selite, NEW.tosite);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_haku_update AFTER UPDATE OF selite, tosite ON Vienti
+        BEGIN
+            DELETE FROM VientiHaku WHERE rowid = OLD.id;
+            INSERT INTO VientiHaku (rowid, selite, tosite)
+            SELECT NEW.id, NEW.selite, NEW.tosite WHERE NEW.selite IS NOT NULL AND NEW.selite != '';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_haku_delete AFTER DELETE ON Vienti
+        BEGIN
+            DELETE FROM VientiHaku WHERE rowid = OLD.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kumppani_tosite_haku_update AFTER UPDATE OF nimi ON Kumppani
+        BEGIN
+            UPDATE TositeHaku SET kumppani = NEW.nimi
+            WHERE rowid IN (SELECT id FROM Tosite WHERE kumppani = NEW.id);
+        END
+        """,
+    ]),
+
+    (6, "Invoice number sequence", [
+        # Invoice numbers come from the LaskuSeuraavaId sequence in Asetus; make sure
+        # it is past every number given out before the sequence was used
+        "CREATE INDEX IF NOT EXISTS tosite_sarja_tunniste ON Tosite(tyyppi, sarja, tunniste)",
+        """
+        INSERT INTO Asetus (avain, arvo)
+        SELECT 'LaskuSeuraavaId', COALESCE(MAX(tunniste), 0) + 1 FROM Tosite
+        WHERE tyyppi = 1 AND sarja IS NULL
+        ON CONFLICT (avain) DO UPDATE SET arvo = MAX(CAST(arvo AS INTEGER), excluded.arvo)
+        """,
+    ]),
+
+    (7, "Covering indexes for voucher lists, account ledgers and voucher lines", [
+        # Voucher list pages, with and without a type filter, read from the index alone
+        "CREATE INDEX IF NOT EXISTS tosite_tyyppi_lista ON Tosite(tyyppi, pvm, id, tila, otsikko)",
+        "CREATE INDEX IF NOT EXISTS tosite_pvm_lista ON Tosite(pvm, id, tyyppi, tila, otsikko)",
+
+        # Account ledger pages and the balance before a page key
+        "CREATE INDEX IF NOT EXISTS vienti_tili_kirja ON Vienti(tili, pvm, id, tosite, debetsnt, kreditsnt, selite)",
+
+        # Lines of a voucher in order, and voucher totals by account range
+        "CREATE INDEX IF NOT EXISTS vienti_tosite_rivi ON Vienti(tosite, rivi)",
+        "CREATE INDEX IF NOT EXISTS vienti_tosite_tili ON Vienti(tosite, tili, debetsnt, kreditsnt)",
+
+        # Superseded: each is a prefix of one of the indexes above
+        "DROP INDEX IF EXISTS tosite_tyyppi_pvm",
+        "DROP INDEX IF EXISTS tosite_tyyppi",
+        "DROP INDEX IF EXISTS tosite_pvm",
+        "DROP INDEX IF EXISTS vienti_tili_pvm",
+        "DROP INDEX IF EXISTS vienti_tili",
+        "DROP INDEX IF EXISTS vienti_tosite",
+
+        # A handful of statuses: the planner picked it and sorted every match of a
+        # status filter, where walking a list index in order stops after one page
+        "DROP INDEX IF EXISTS tosite_tila",
+    ]),
+
+    (8, "Closed fiscal period snapshots (TilikausiSaldo)", [
+        # Movements of each account over a closed fiscal period (tilikausi = Tilikausi.alkaa),
+        # written once when the period is closed
+        """
+        CREATE TABLE IF NOT EXISTS TilikausiSaldo (
+            tilikausi DATE NOT NULL,
+            tili INTEGER NOT NULL,
+            debetsnt BIGINT NOT NULL DEFAULT 0,
+            kreditsnt BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (tilikausi, tili)
+        ) WITHOUT ROWID
+        """,
+
+        # Ledger lines dated on or before TilitPaatetty can no longer change,
+        # so the snapshots of the closed periods stay true
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_paatetty_insert BEFORE INSERT ON Vienti
+        WHEN NEW.pvm <= (SELECT arvo FROM Asetus WHERE avain = 'TilitPaatetty')
+        BEGIN
+            SELECT RAISE(ABORT, 'The fiscal period of this date is closed');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_paatetty_update BEFORE UPDATE ON Vienti
+        WHEN OLD.pvm <= (SELECT arvo FROM Asetus WHERE avain = 'TilitPaatetty')
+          OR NEW.pvm <= (SELECT arvo FROM Asetus WHERE avain = 'TilitPaatetty')
+        BEGIN
+            SELECT RAISE(ABORT, 'The fiscal period of this date is closed');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_paatetty_delete BEFORE DELETE ON Vienti
+        WHEN OLD.pvm <= (SELECT arvo FROM Asetus WHERE avain = 'TilitPaatetty')
+        BEGIN
+            SELECT RAISE(ABORT, 'The fiscal period of this date is closed');
+        END
+        """,
+    ]),
+
+    (9, "Monthly balances per allocation (KohdennusSaldo)", [
+        # Debits, credits and line counts per account, allocation (0 = Yleinen when
+        # unallocated) and month, kept in step with Vienti by triggers
+        """
+        CREATE TABLE IF NOT EXISTS KohdennusSaldo (
+            tili INTEGER NOT NULL,
+            kohdennus INTEGER NOT NULL,
+            kausi VARCHAR(7) NOT NULL,
+            debetsnt BIGINT NOT NULL DEFAULT 0,
+            kreditsnt BIGINT NOT NULL DEFAULT 0,
+            rivit INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (tili, kohdennus, kausi)
+        ) WITHOUT ROWID
+        """,
+        ALLOCATION_BALANCE_BACKFILL,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_kohdennussaldo_insert AFTER INSERT ON Vienti
+        BEGIN
+            INSERT INTO KohdennusSaldo (tili, kohdennus, kausi, debetsnt, kreditsnt, rivit)
+            VALUES (NEW.tili, COALESCE(NEW.kohdennus, 0), COALESCE(substr(NEW.pvm, 1, 7), ''),
+                    COALESCE(NEW.debetsnt, 0), COALESCE(NEW.kreditsnt, 0), 1)
+            ON CONFLICT (tili, kohdennus, kausi) DO UPDATE SET
+                debetsnt = debetsnt + excluded.debetsnt,
+                kreditsnt = kreditsnt + excluded.kreditsnt,
+                rivit = rivit + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_kohdennussaldo_delete AFTER DELETE ON Vienti
+        BEGIN
+            UPDATE KohdennusSaldo SET
+                debetsnt = debetsnt - COALESCE(OLD.debetsnt, 0),
+                kreditsnt = kreditsnt - COALESCE(OLD.kreditsnt, 0),
+                rivit = rivit - 1
+            WHERE tili = OLD.tili AND kohdennus = COALESCE(OLD.kohdennus, 0)
+              AND kausi = COALESCE(substr(OLD.pvm, 1, 7), '');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_kohdennussaldo_update
+        AFTER UPDATE OF tili, kohdennus, pvm, debetsnt, kreditsnt ON Vienti
+        BEGIN
+            UPDATE KohdennusSaldo SET
+                debetsnt = debetsnt - COALESCE(OLD.debetsnt, 0),
+                kreditsnt = kreditsnt - COALESCE(OLD.kreditsnt, 0),
+                rivit = rivit - 1
+            WHERE tili = OLD.tili AND kohdennus = COALESCE(OLD.kohdennus, 0)
+              AND kausi = COALESCE(substr(OLD.pvm, 1, 7), '');
+            INSERT INTO KohdennusSaldo (tili, kohdennus, kausi, debetsnt, kreditsnt, rivit)
+            VALUES (NEW.tili, COALESCE(NEW.kohdennus, 0), COALESCE(substr(NEW.pvm, 1, 7), ''),
+                    COALESCE(NEW.debetsnt, 0), COALESCE(NEW.kreditsnt, 0), 1)
+            ON CONFLICT (tili, kohdennus, kausi) DO UPDATE SET
+                debetsnt = debetsnt + excluded.debetsnt,
+                kreditsnt = kreditsnt + excluded.kreditsnt,
+                rivit = rivit + 1;
+        END
+        """,
+    ]),
+    (10, "Open receivable items (Reskontra)", [
+        # Settlements of an invoice are found through eraid
+        "CREATE INDEX IF NOT EXISTS vienti_eraid ON Vienti(eraid) WHERE eraid IS NOT NULL",
+        # Debits, credits and line counts of the receivable account per item,
+        # kept in step with Vienti by triggers; the item is open while they differ
+        """
+        CREATE TABLE IF NOT EXISTS Reskontra (
+            eraid INTEGER PRIMARY KEY NOT NULL,
+            debetsnt BIGINT NOT NULL DEFAULT 0,
+            kreditsnt BIGINT NOT NULL DEFAULT 0,
+            rivit INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS reskontra_avoimet ON Reskontra(eraid) WHERE debetsnt <> kreditsnt",
+        RECEIVABLE_ITEM_BACKFILL,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_reskontra_insert AFTER INSERT ON Vienti
+        WHEN NEW.tili = 1700 AND COALESCE(NEW.eraid, NEW.tosite) IS NOT NULL
+        BEGIN
+            INSERT INTO Reskontra (eraid, debetsnt, kreditsnt, rivit)
+            VALUES (COALESCE(NEW.eraid, NEW.tosite), COALESCE(NEW.debetsnt, 0), COALESCE(NEW.kreditsnt, 0), 1)
+            ON CONFLICT (eraid) DO UPDATE SET
+                debetsnt = debetsnt + excluded.debetsnt,
+                kreditsnt = kreditsnt + excluded.kreditsnt,
+                rivit = rivit + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_reskontra_delete AFTER DELETE ON Vienti
+        WHEN OLD.tili = 1700
+        BEGIN
+            UPDATE Reskontra SET
+                debetsnt = debetsnt - COALESCE(OLD.debetsnt, 0),
+                kreditsnt = kreditsnt - COALESCE(OLD.kreditsnt, 0),
+                rivit = rivit - 1
+            WHERE eraid = COALESCE(OLD.eraid, OLD.tosite);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_reskontra_update
+        AFTER UPDATE OF tili, eraid, tosite, debetsnt, kreditsnt ON Vienti
+        WHEN OLD.tili = 1700 OR NEW.tili = 1700
+        BEGIN
+            UPDATE Reskontra SET
+                debetsnt = debetsnt - COALESCE(OLD.debetsnt, 0),
+                kreditsnt = kreditsnt - COALESCE(OLD.kreditsnt, 0),
+                rivit = rivit - 1
+            WHERE OLD.tili = 1700 AND eraid = COALESCE(OLD.eraid, OLD.tosite);
+            INSERT INTO Reskontra (eraid, debetsnt, kreditsnt, rivit)
+            SELECT COALESCE(NEW.eraid, NEW.tosite), COALESCE(NEW.debetsnt, 0), COALESCE(NEW.kreditsnt, 0), 1
+            WHERE NEW.tili = 1700 AND COALESCE(NEW.eraid, NEW.tosite) IS NOT NULL
+            ON CONFLICT (eraid) DO UPDATE SET
+                debetsnt = debetsnt + excluded.debetsnt,
+                kreditsnt = kreditsnt + excluded.kreditsnt,
+                rivit = rivit + 1;
+        END
+        """,
+    ]),
+    (11, "Invoice number sequence compared as a number", [
+        # Migration 6 compared the stored text with an integer, which made the
+        # sequence MAX(tunniste) + 1 whatever it held; compare both as numbers
+        """
+        INSERT INTO Asetus (avain, arvo)
+        SELECT 'LaskuSeuraavaId', COALESCE(MAX(tunniste), 0) + 1 FROM Tosite
+        WHERE tyyppi = 1 AND sarja IS NULL
+        ON CONFLICT (avain) DO UPDATE SET arvo = MAX(CAST(arvo AS INTEGER), CAST(excluded.arvo AS INTEGER))
+        """,
+    ]),
+    (12, "Open items limited to sales invoices and their settlements", [
+        # Migration 10 tracked every receivable line; replace its triggers and
+        # rebuild the items from the sales invoices
+        "DROP TRIGGER IF EXISTS vienti_reskontra_insert",
+        "DROP TRIGGER IF EXISTS vienti_reskontra_delete",
+        "DROP TRIGGER IF EXISTS vienti_reskontra_update",
+        "DROP TRIGGER IF EXISTS tosite_reskontra_tyyppi",
+        "DELETE FROM Reskontra",
+        OPEN_ITEM_BACKFILL,
+        # Only lines of sales invoices and the settlements carrying their eraid
+        # are items; other receivable lines (opening balances, journal vouchers)
+        # are left out
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_reskontra_insert AFTER INSERT ON Vienti
+        WHEN NEW.tili = 1700
+         AND EXISTS (SELECT 1 FROM Tosite WHERE id = COALESCE(NEW.eraid, NEW.tosite) AND tyyppi = 1)
+        BEGIN
+            INSERT INTO Reskontra (eraid, debetsnt, kreditsnt, rivit)
+            VALUES (COALESCE(NEW.eraid, NEW.tosite), COALESCE(NEW.debetsnt, 0), COALESCE(NEW.kreditsnt, 0), 1)
+            ON CONFLICT (eraid) DO UPDATE SET
+                debetsnt = debetsnt + excluded.debetsnt,
+                kreditsnt = kreditsnt + excluded.kreditsnt,
+                rivit = rivit + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_reskontra_delete AFTER DELETE ON Vienti
+        WHEN OLD.tili = 1700
+         AND EXISTS (SELECT 1 FROM Tosite WHERE id = COALESCE(OLD.eraid, OLD.tosite) AND tyyppi = 1)
+        BEGIN
+            UPDATE Reskontra SET
+                debetsnt = debetsnt - COALESCE(OLD.debetsnt, 0),
+                kreditsnt = kreditsnt - COALESCE(OLD.kreditsnt, 0),
+                rivit = rivit - 1
+            WHERE eraid = COALESCE(OLD.eraid, OLD.tosite);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_reskontra_update
+        AFTER UPDATE OF tili, eraid, tosite, debetsnt, kreditsnt ON Vienti
+        WHEN OLD.tili = 1700 OR NEW.tili = 1700
+        BEGIN
+            UPDATE Reskontra SET
+                debetsnt = debetsnt - COALESCE(OLD.debetsnt, 0),
+                kreditsnt = kreditsnt - COALESCE(OLD.kreditsnt, 0),
+                rivit = rivit - 1
+            WHERE OLD.tili = 1700 AND eraid = COALESCE(OLD.eraid, OLD.tosite)
+              AND EXISTS (SELECT 1 FROM Tosite WHERE id = COALESCE(OLD.eraid, OLD.tosite) AND tyyppi = 1);
+            INSERT INTO Reskontra (eraid, debetsnt, kreditsnt, rivit)
+            SELECT COALESCE(NEW.eraid, NEW.tosite), COALESCE(NEW.debetsnt, 0), COALESCE(NEW.kreditsnt, 0), 1
+            WHERE NEW.tili = 1700
+              AND EXISTS (SELECT 1 FROM Tosite WHERE id = COALESCE(NEW.eraid, NEW.tosite) AND tyyppi = 1)
+            ON CONFLICT (eraid) DO UPDATE SET
+                debetsnt = debetsnt + excluded.debetsnt,
+                kreditsnt = kreditsnt + excluded.kreditsnt,
+                rivit = rivit + 1;
+        END
+        """,
+        # A voucher that becomes or stops being a sales invoice gains or loses its item
+        """
+        CREATE TRIGGER IF NOT EXISTS tosite_reskontra_tyyppi AFTER UPDATE OF tyyppi ON Tosite
+        WHEN (OLD.tyyppi IS 1) <> (NEW.tyyppi IS 1)
+        BEGIN
+            DELETE FROM Reskontra WHERE eraid = NEW.id;
+            INSERT INTO Reskontra (eraid, debetsnt, kreditsnt, rivit)
+            SELECT NEW.id, SUM(COALESCE(debetsnt, 0)), SUM(COALESCE(kreditsnt, 0)), COUNT(*)
+            FROM Vienti
+            WHERE NEW.tyyppi = 1 AND tili = 1700
+              AND (eraid = NEW.id OR (eraid IS NULL AND tosite = NEW.id))
+            HAVING COUNT(*) > 0;
+        END
+        """,
+    ]),
+    (13, "Ledger change counter (ViennitVersio)", [
+        # Bumped by every change to the Vienti columns of the columnar extracts,
+        # so a cached extract is reloaded only when the ledger has changed
+        """
+        INSERT INTO Asetus (avain, arvo) VALUES ('ViennitVersio', '0')
+        ON CONFLICT (avain) DO NOTHING
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_versio_insert AFTER INSERT ON Vienti
+        BEGIN
+            UPDATE Asetus SET arvo = CAST(arvo AS INTEGER) + 1 WHERE avain = 'ViennitVersio';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_versio_delete AFTER DELETE ON Vienti
+        BEGIN
+            UPDATE Asetus SET arvo = CAST(arvo AS INTEGER) + 1 WHERE avain = 'ViennitVersio';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS vienti_versio_update AFTER UPDATE OF id, tili, pvm, kohdennus, debetsnt, kreditsnt ON Vienti
+        BEGIN
+            UPDATE Asetus SET arvo = CAST(arvo AS INTEGER) + 1 WHERE avain = 'ViennitVersio';
+        END
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def get_version(conn):
+    """Schema version of a client database; 0 if it has never been migrated"""
+    row = conn.execute("SELECT arvo FROM Asetus WHERE avain = ?", (VERSION_KEY,)).fetchone()
+    try:
+        return int(row[0]) if row else 0
+    except (TypeError, ValueError):
+        return 0
+
+def set_version(conn, version):
+    """Record the schema version inside the current transaction"""
+    conn.execute("""
+        INSERT INTO Asetus (avain, arvo) VALUES (?, ?)
+        ON CONFLICT (avain) DO UPDATE SET arvo = excluded.arvo, muokattu = CURRENT_TIMESTAMP
+    """, (VERSION_KEY, str(version)))
+
+def migrate(conn, target=LATEST_VERSION):
+    """
+    Apply the migrations a client database is missing, up to the target version.
+
+    Each migration runs in its own write transaction together with the version
+    update, so a failure leaves the database at the last complete version, and
+    no ledger row slips in between a backfill and its triggers. An up to date
+    database costs a single read.
+
+    Returns:
+        list: Versions applied by this call
+    """
+    if get_version(conn) >= target:
+        return []
+
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version > target:
+            break
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another connection may have got here first
+            if get_version(conn) >= version:
+                conn.rollback()
+                continue
+
+            for statement in statements:
+                conn.execute(statement)
+            set_version(conn, version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        applied.append(version)
+
+    return applied
+
+def migrate_file(path, target=LATEST_VERSION):
+    """
+    Migrate one database file on its own connection.
+
+    Returns:
+        tuple: (version before, versions applied)
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        return get_version(conn), migrate(conn, target)
+    finally:
+        conn.close()
+
+def main(argv=None):
+    """Bring client databases up to the latest schema version"""
+    parser = argparse.ArgumentParser(description="Apply schema migrations to client databases")
+    parser.add_argument('databases', nargs='*', help="Database filenames (default: all in the database directory)")
+    parser.add_argument('--directory', default=DATABASE_DIR)
+    parser.add_argument('--target', type=int, default=LATEST_VERSION, help="Version to migrate to (default: latest)")
+    parser.add_argument('--workers', type=int, default=MIGRATION_WORKERS, help="Databases migrated in parallel")
+    parser.add_argument('--status', action='store_true', help="Only show the schema version of each database")
+    args = parser.parse_intermixed_args(argv)
+
+    filenames = args.databases or sorted(name for name in os.listdir(args.directory) if name.endswith('.db'))
+    failed = False
+
+    if args.status:
+        for filename in filenames:
+            conn = sqlite3.connect(os.path.join(args.directory, filename))
+            try:
+                version = get_version(conn)
+                print(f"{filename}: version {version}/{LATEST_VERSION}" + (" (pending)" if version < LATEST_VERSION else ""))
+            except sqlite3.Error as e:
+                failed = True
+                print(f"{filename}: error: {e}")
+            finally:
+                conn.close()
+        return 1 if failed else 0
+
+    # Every database has its own file and lock, so they migrate independently
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = [(filename, executor.submit(migrate_file, os.path.join(args.directory, filename), args.target))
+                   for filename in filenames]
+
+        for filename, future in futures:
+            try:
+                before, applied = future.result()
+                if applied:
+                    print(f"{filename}: {before} -> {applied[-1]}")
+                else:
+                    print(f"{filename}: up to date ({before})")
+            except sqlite3.Error as e:
+                failed = True
+                print(f"{filename}: error: {e}")
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
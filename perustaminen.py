@@ -0,0 +1,202 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tietokanta import DATABASE_DIR
+from tuonti import parse_date
+from user_database import AccountingDatabaseCreator
+
+ONBOARDING_FORMATS = ('csv', 'json', 'jsonl')
+
+# client_info keys taken from the input as text
+TEXT_FIELDS = (
+    'name', 'business_id', 'street_address', 'postal_code', 'city', 'domicile',
+    'email', 'phone', 'website', 'iban', 'company_form', 'chart_scope'
+)
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on', 'kyllä', 'k')
+
+def detect_format(name, default='csv'):
+    """Guess the input format from a filename"""
+    if name and name.lower().endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if name and name.lower().endswith('.json'):
+        return 'json'
+    if name and name.lower().endswith('.csv'):
+        return 'csv'
+    return default
+
+def read_records(stream, fmt):
+    """
+    Yield (line number, record dict) pairs from a text stream.
+
+    CSV input has one client per row, with the fiscal period in the
+    fiscal_name, fiscal_start and fiscal_end columns as in the /create form.
+    JSON input is an array of client objects, JSON lines one object per line;
+    both may give the fiscal period as a 'fiscal_period' object.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, {key.strip(): value for key, value in row.items() if key}
+        return
+
+    if fmt == 'json':
+        try:
+            records = json.load(stream)
+        except ValueError as e:
+            yield 1, {'_error': f"invalid JSON: {e}"}
+            return
+        if not isinstance(records, list):
+            yield 1, {'_error': "expected a JSON array of client objects"}
+            return
+        for index, record in enumerate(records, start=1):
+            yield index, record if isinstance(record, dict) else {'_error': "expected a JSON object"}
+        return
+
+    for line_number, text in enumerate(stream, start=1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError as e:
+            yield line_number, {'_error': f"invalid JSON: {e}"}
+            continue
+        yield line_number, record if isinstance(record, dict) else {'_error': "expected a JSON object"}
+
+def build_client_info(record):
+    """
+    Validate one input record into the client_info dict of AccountingDatabaseCreator.
+
+    Raises:
+        ValueError: If the record is not valid
+    """
+    if '_error' in record:
+        raise ValueError(record['_error'])
+
+    client_info = {}
+    for field in TEXT_FIELDS:
+        value = record.get(field)
+        if value is not None and str(value).strip():
+            client_info[field] = str(value).strip()
+
+    if 'name' not in client_info:
+        raise ValueError("name: value is required")
+
+    scope = client_info.get('chart_scope')
+    if scope and scope not in AccountingDatabaseCreator.CHART_SCOPES:
+        raise ValueError(f"chart_scope: '{scope}' is not one of {', '.join(AccountingDatabaseCreator.CHART_SCOPES)}")
+
+    vat_registered = record.get('vat_registered')
+    client_info['vat_registered'] = (vat_registered is True
+                                     or str(vat_registered or '').strip().lower() in TRUE_VALUES)
+
+    fiscal_period = record.get('fiscal_period')
+    if not isinstance(fiscal_period, dict):
+        fiscal_period = {
+            'name': record.get('fiscal_name'),
+            'start_date': record.get('fiscal_start'),
+            'end_date': record.get('fiscal_end')
+        }
+    if fiscal_period.get('start_date') or fiscal_period.get('end_date'):
+        start_date = parse_date(fiscal_period.get('start_date'), 'fiscal_start')
+        end_date = parse_date(fiscal_period.get('end_date'), 'fiscal_end')
+        if end_date < start_date:
+            raise ValueError("fiscal_end: the fiscal period ends before it starts")
+        client_info['fiscal_period'] = {
+            'name': fiscal_period.get('name') or 'Fiscal Period',
+            'start_date': start_date,
+            'end_date': end_date
+        }
+
+    return client_info
+
+def create_client(client_info, directory):
+    """
+    Create one client database. Runs in a worker process; the chart scope
+    templates are built once per worker and reused.
+
+    Returns:
+        tuple: (database filename, seconds taken)
+    """
+    started = time.perf_counter()
+    db_path = AccountingDatabaseCreator().create_database(client_info, directory)
+    return os.path.basename(db_path), time.perf_counter() - started
+
+def onboard_clients(records, directory=DATABASE_DIR, workers=None):
+    """
+    Create the databases of valid records in parallel.
+
+    Returns:
+        dict: 'created' as [(line, name, filename, seconds)], 'errors' as
+              [(line, name, message)], and 'seconds' for the whole batch
+    """
+    started = time.perf_counter()
+    report = {'created': [], 'errors': []}
+
+    clients = []
+    for line_number, record in records:
+        try:
+            clients.append((line_number, build_client_info(record)))
+        except ValueError as e:
+            report['errors'].append((line_number, record.get('name') or '-', str(e)))
+
+    if clients:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(create_client, client_info, directory): (line_number, client_info['name'])
+                       for line_number, client_info in clients}
+
+            for future in as_completed(futures):
+                line_number, name = futures[future]
+                try:
+                    filename, seconds = future.result()
+                    report['created'].append((line_number, name, filename, seconds))
+                except Exception as e:
+                    report['errors'].append((line_number, name, str(e)))
+
+    report['created'].sort()
+    report['errors'].sort()
+    report['seconds'] = time.perf_counter() - started
+    return report
+
+def main(argv=None):
+    """Create client databases in bulk from CSV or JSON"""
+    parser = argparse.ArgumentParser(description="Create client databases in bulk")
+    parser.add_argument('input', help="CSV, JSON or JSON lines file of clients, '-' for standard input")
+    parser.add_argument('--format', choices=ONBOARDING_FORMATS, help="Input format (default: from the file extension)")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--directory', default=DATABASE_DIR)
+    parser.add_argument('--verbose', action='store_true', help="List every created database")
+    args = parser.parse_intermixed_args(argv)
+
+    fmt = args.format or detect_format(args.input)
+    if args.input == '-':
+        stream = open(sys.stdin.fileno(), encoding='utf-8-sig', newline='', closefd=False)
+    else:
+        stream = open(args.input, encoding='utf-8-sig', newline='')
+    with stream:
+        records = list(read_records(stream, fmt))
+
+    report = onboard_clients(records, args.directory, args.workers)
+
+    if args.verbose:
+        for line_number, name, filename, seconds in report['created']:
+            print(f"line {line_number} ({name}): {filename} in {seconds * 1000:.1f} ms")
+    for line_number, name, error in report['errors']:
+        print(f"line {line_number} ({name}): {error}")
+
+    created = len(report['created'])
+    summary = f"created {created} databases in {report['seconds']:.2f} s"
+    if created:
+        timings = [seconds for _, _, _, seconds in report['created']]
+        summary += (f" (per database {min(timings) * 1000:.1f} / {sum(timings) / created * 1000:.1f}"
+                    f" / {max(timings) * 1000:.1f} ms min / avg / max)")
+    print(f"{summary}, {len(report['errors'])} failed")
+
+    return 1 if report['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
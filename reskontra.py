@@ -0,0 +1,151 @@
+import os
+import datetime
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from tietokanta import get_db
+from viennit import INVOICE_RECEIVABLE_ACCOUNT
+from tili import format_cents, parse_iso_date
+
+# Create a Blueprint for the open items (reskontra) routes
+reskontra_bp = Blueprint('reskontra', __name__, template_folder='templates')
+
+# Ageing buckets as (last day past due, name); the last bucket has no limit
+AGEING_BUCKETS = (
+    (0, "Erääntymättä"),
+    (30, "1–30 päivää"),
+    (60, "31–60 päivää"),
+    (90, "61–90 päivää"),
+    (None, "Yli 90 päivää"),
+)
+
+def _bucket_expression():
+    """SQL CASE giving the ageing bucket of an item from its due date and :paiva"""
+    overdue = "julianday(:paiva) - julianday(t.erapvm)"
+    limits = " ".join(f"WHEN {overdue} <= {limit} THEN {i}"
+                      for i, (limit, name) in enumerate(AGEING_BUCKETS) if limit is not None)
+    # Items without a (valid) due date are not yet due
+    return f"CASE WHEN julianday(t.erapvm) IS NULL THEN 0 {limits} ELSE {len(AGEING_BUCKETS) - 1} END"
+
+# Open items with their invoice and customer; Reskontra holds the receivable
+# debits and credits of each sales invoice, so an open item is one where they differ
+OPEN_ITEMS_QUERY = f"""
+    SELECT r.eraid, t.tunniste, t.sarja, t.pvm, t.erapvm, t.kumppani, k.nimi AS kumppani_nimi,
+           r.debetsnt - r.kreditsnt AS avoinna,
+           MAX(CAST(julianday(:paiva) - julianday(t.erapvm) AS INTEGER), 0) AS paivat,
+           {_bucket_expression()} AS luokka
+    FROM Reskontra r
+    JOIN Tosite t ON t.id = r.eraid
+    LEFT JOIN Kumppani k ON k.id = t.kumppani
+    WHERE r.debetsnt <> r.kreditsnt
+"""
+
+def get_outstanding(conn, invoice_id):
+    """Outstanding receivable of an invoice in cents (negative when overpaid)"""
+    row = conn.execute("SELECT debetsnt - kreditsnt FROM Reskontra WHERE eraid = ?", (invoice_id,)).fetchone()
+    return row[0] if row else 0
+
+def get_settlements(conn, invoice_id):
+    """
+    Payments and other receivable lines referring to an invoice through eraid.
+
+    Returns:
+        list: Rows of (tosite, pvm, selite, debetsnt, kreditsnt) in date order
+    """
+    return conn.execute("""
+        SELECT tosite, pvm, selite, COALESCE(debetsnt, 0), COALESCE(kreditsnt, 0)
+        FROM Vienti
+        WHERE eraid = ? AND tili = ?
+        ORDER BY pvm, id
+    """, (invoice_id, INVOICE_RECEIVABLE_ACCOUNT)).fetchall()
+
+def get_open_items(conn, today, partner=None):
+    """
+    Open receivable items on a date.
+
+    Args:
+        conn: Connection to a client database
+        today (str): Date the items are aged on, 'YYYY-MM-DD'
+        partner (int): Only the items of this customer
+
+    Returns:
+        list: Dicts with eraid, tunniste, sarja, pvm, erapvm, kumppani,
+              kumppani_nimi, avoinna (cents), paivat (days past due) and
+              luokka (index into AGEING_BUCKETS), by due date
+    """
+    query = OPEN_ITEMS_QUERY
+    params = {'paiva': today}
+    if partner is not None:
+        query += " AND t.kumppani = :kumppani"
+        params['kumppani'] = partner
+    return [dict(row) for row in conn.execute(query + " ORDER BY t.erapvm, r.eraid", params)]
+
+def get_ageing(conn, today):
+    """
+    Outstanding receivables per customer in the ageing buckets, aggregated in SQL.
+
+    Returns:
+        tuple: (customer rows, totals); each a dict with kumppani, nimi,
+               erat (open items), avoinna and luokat (cents per bucket)
+    """
+    buckets = ", ".join(f"SUM(CASE WHEN luokka = {i} THEN avoinna ELSE 0 END)"
+                        for i in range(len(AGEING_BUCKETS)))
+    cursor = conn.execute(f"""
+        SELECT kumppani, kumppani_nimi, COUNT(*), SUM(avoinna), {buckets}
+        FROM ({OPEN_ITEMS_QUERY})
+        GROUP BY kumppani
+        ORDER BY SUM(avoinna) DESC, kumppani
+    """, {'paiva': today})
+
+    rows = []
+    totals = {'kumppani': None, 'nimi': "Yhteensä", 'erat': 0, 'avoinna': 0, 'luokat': [0] * len(AGEING_BUCKETS)}
+    for kumppani, nimi, count, outstanding, *amounts in cursor:
+        rows.append({'kumppani': kumppani, 'nimi': nimi or "Tuntematon", 'erat': count,
+                     'avoinna': outstanding, 'luokat': amounts})
+        totals['erat'] += count
+        totals['avoinna'] += outstanding
+        totals['luokat'] = [total + amount for total, amount in zip(totals['luokat'], amounts)]
+    return rows, totals
+
+@reskontra_bp.route('/db/<filename>/receivables/ageing')
+def ageing_report(filename):
+    """Receivables ageing on a date (?paiva), as a page or as JSON with ?format=json"""
+    db_path = os.path.join('databases', filename)
+
+    if not os.path.exists(db_path):
+        if request.args.get('format') == 'json':
+            return jsonify({"error": "Database file not found"}), 404
+        flash("Tietokantaa ei löydy", "error")
+        return redirect(url_for('index'))
+
+    conn = get_db(filename)
+    today = parse_iso_date(request.args.get('paiva')) or datetime.date.today().isoformat()
+    rows, totals = get_ageing(conn, today)
+
+    if request.args.get('format') == 'json':
+        result = {"paiva": today, "luokat": [name for limit, name in AGEING_BUCKETS],
+                  "asiakkaat": rows, "yhteensa": totals}
+        # The open items themselves with ?erat=1, optionally of one customer
+        if request.args.get('erat') == '1':
+            result["erat"] = get_open_items(conn, today, request.args.get('kumppani', type=int))
+        return jsonify(result)
+
+    for row in rows + [totals]:
+        row['avoinna_formatted'] = ('-' if row['avoinna'] < 0 else '') + format_cents(row['avoinna'])
+        row['luokat_formatted'] = [('-' if amount < 0 else '') + format_cents(amount) for amount in row['luokat']]
+
+    # Get client name
+    client_name = ""
+    row = conn.execute("SELECT arvo FROM Asetus WHERE avain='Nimi'").fetchone()
+    if row:
+        client_name = row[0]
+
+    return render_template('invoices/ageing.html',
+                           filename=filename,
+                           client_name=client_name,
+                           today=today,
+                           buckets=[name for limit, name in AGEING_BUCKETS],
+                           rows=rows,
+                           totals=totals)
+
+def register_blueprint(app):
+    """Register the blueprint with the main Flask app"""
+    app.register_blueprint(reskontra_bp)
@@ -0,0 +1,460 @@
+import os
+import sys
+import json
+import sqlite3
+import argparse
+import calendar
+import datetime
+from tietokanta import DATABASE_DIR, ensure_schema, connect
+from migraatiot import BALANCE_BACKFILL, ALLOCATION_BALANCE_BACKFILL, OPEN_ITEM_BACKFILL
+from viennit import INVOICE_RECEIVABLE_ACCOUNT
+
+# Asetus key of the last date of the closed fiscal periods
+CLOSED_UNTIL_KEY = 'TilitPaatetty'
+
+# Account types of the balance sheet; the others belong to the income statement
+BALANCE_SHEET_TYPES = ('A', 'B', 'C')
+
+def get_account_balances(conn, start_period=None, end_period=None):
+    """
+    Get account balances (debit - credit, in cents) from the Saldo table.
+
+    Args:
+        conn: Connection to a client database
+        start_period (str): First month to include, 'YYYY-MM'
+        end_period (str): Last month to include, 'YYYY-MM'
+
+    Returns:
+        dict: Account number -> balance in cents
+    """
+    conditions = []
+    params = []
+    if start_period:
+        conditions.append("kausi >= ?")
+        params.append(start_period)
+    if end_period:
+        conditions.append("kausi <= ?")
+        params.append(end_period)
+
+    sql = "SELECT tili, SUM(debetsnt) - SUM(kreditsnt) FROM Saldo"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " GROUP BY tili"
+
+    return {account: balance for account, balance in conn.execute(sql, params)}
+
+def get_balance_before(conn, account_number, date, row_id):
+    """
+    Get the balance (debit - credit, in cents) of an account from the
+    transactions ordered before (date, row_id). Whole months come from
+    Saldo; only the month of the key itself is read from Vienti.
+    """
+    month = (date or '')[:7]
+
+    stored = conn.execute("""
+        SELECT COALESCE(SUM(debetsnt) - SUM(kreditsnt), 0) FROM Saldo
+        WHERE tili = ? AND kausi < ?
+    """, (account_number, month)).fetchone()[0]
+
+    partial = conn.execute("""
+        SELECT COALESCE(SUM(debetsnt), 0) - COALESCE(SUM(kreditsnt), 0) FROM Vienti
+        WHERE tili = ? AND pvm >= ? AND (pvm, id) < (?, ?)
+    """, (account_number, month, date, row_id)).fetchone()[0]
+
+    return stored + partial
+
+def _shift_date(date, days):
+    return (datetime.date.fromisoformat(date) + datetime.timedelta(days=days)).isoformat()
+
+def _add_movements(totals, rows):
+    for account, debit, credit in rows:
+        entry = totals.setdefault(account, [0, 0])
+        entry[0] += debit or 0
+        entry[1] += credit or 0
+
+def _ledger_movements(conn, totals, start, end):
+    """
+    Add the movements dated from start to end (inclusive, None for open-ended)
+    to totals. Whole months come from Saldo; only the days of a partial first
+    or last month are read from Vienti.
+    """
+    if start and end and start > end:
+        return
+
+    full_start = start[:7] if start else None
+    full_end = end[:7] if end else None
+
+    if start and start[8:] != '01':
+        year, month = int(start[:4]), int(start[5:7])
+        month_end = f"{start[:7]}-{calendar.monthrange(year, month)[1]:02d}"
+        head_end = min(month_end, end) if end else month_end
+        _add_movements(totals, conn.execute("""
+            SELECT tili, SUM(debetsnt), SUM(kreditsnt) FROM Vienti
+            WHERE pvm BETWEEN ? AND ? GROUP BY tili
+        """, (start, head_end)))
+        if head_end == end:
+            return
+        full_start = _shift_date(month_end, 1)[:7]
+
+    if end:
+        year, month = int(end[:4]), int(end[5:7])
+        if int(end[8:]) != calendar.monthrange(year, month)[1]:
+            tail_start = max(f"{end[:7]}-01", start) if start else f"{end[:7]}-01"
+            _add_movements(totals, conn.execute("""
+                SELECT tili, SUM(debetsnt), SUM(kreditsnt) FROM Vienti
+                WHERE pvm BETWEEN ? AND ? GROUP BY tili
+            """, (tail_start, end)))
+            full_end = _shift_date(f"{end[:7]}-01", -1)[:7]
+
+    if full_start and full_end and full_start > full_end:
+        return
+
+    conditions = []
+    params = []
+    if full_start:
+        conditions.append("kausi >= ?")
+        params.append(full_start)
+    if full_end:
+        conditions.append("kausi <= ?")
+        params.append(full_end)
+    sql = "SELECT tili, SUM(debetsnt), SUM(kreditsnt) FROM Saldo"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    _add_movements(totals, conn.execute(sql + " GROUP BY tili", params))
+
+def get_fiscal_periods(conn):
+    """
+    Fiscal periods (Tilikausi), newest first.
+
+    Returns:
+        list: Dicts with alkaa, loppuu, nimi and suljettu (closed, with a snapshot)
+    """
+    row = conn.execute("SELECT arvo FROM Asetus WHERE avain = ?", (CLOSED_UNTIL_KEY,)).fetchone()
+    closed_until = row[0] if row and row[0] else ''
+
+    periods = []
+    for start, end, text in conn.execute("SELECT alkaa, loppuu, json FROM Tilikausi ORDER BY alkaa DESC"):
+        try:
+            data = json.loads(text) if text else {}
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        periods.append({
+            'alkaa': start,
+            'loppuu': end,
+            'nimi': data.get('nimi') or f"{start} – {end}",
+            'suljettu': bool(data.get('suljettu')) and end <= closed_until
+        })
+    return periods
+
+def get_period_movements(conn, start=None, end=None):
+    """
+    Debits and credits (in cents) of every account from start to end,
+    ISO dates inclusive; None leaves that end open.
+
+    Closed fiscal periods inside the range are read from their snapshots in
+    TilikausiSaldo, so their ledger lines are never read again.
+
+    Returns:
+        dict: Account number -> [debit, credit]
+    """
+    totals = {}
+    cursor = start
+
+    closed = sorted((period for period in get_fiscal_periods(conn) if period['suljettu']
+                     and (start is None or period['alkaa'] >= start)
+                     and (end is None or period['loppuu'] <= end)),
+                    key=lambda period: period['alkaa'])
+
+    for period in closed:
+        _ledger_movements(conn, totals, cursor, _shift_date(period['alkaa'], -1))
+        _add_movements(totals, conn.execute(
+            "SELECT tili, debetsnt, kreditsnt FROM TilikausiSaldo WHERE tilikausi = ?", (period['alkaa'],)))
+        cursor = _shift_date(period['loppuu'], 1)
+
+    _ledger_movements(conn, totals, cursor, end)
+    return totals
+
+def get_period_balances(conn, accounts, start=None, end=None):
+    """
+    Balances (debit - credit, in cents) for reports over a period: balance
+    sheet accounts as of the end date, income statement accounts for the
+    movements from start to end.
+
+    Args:
+        accounts: Account dicts with numero and tyyppi
+
+    Returns:
+        dict: Account number -> balance in cents
+    """
+    cumulative = get_period_movements(conn, None, end)
+    movements = get_period_movements(conn, start, end) if start else cumulative
+
+    balances = {}
+    for account in accounts:
+        source = cumulative if account['tyyppi'] in BALANCE_SHEET_TYPES else movements
+        debit, credit = source.get(account['numero'], (0, 0))
+        balances[account['numero']] = debit - credit
+    return balances
+
+def get_trial_balance(conn, accounts, start=None, end=None):
+    """
+    Trial balance (raakatase) from start to end: for every account with
+    movements, the opening balance, debits, credits and closing balance in
+    cents. Income statement accounts open at zero.
+
+    Args:
+        accounts: Account dicts with numero, nimi and tyyppi, in report order
+
+    Returns:
+        list: Row dicts for the accounts with an opening balance or movements
+    """
+    opening = get_period_movements(conn, None, _shift_date(start, -1)) if start else {}
+    movements = get_period_movements(conn, start, end)
+
+    rows = []
+    for account in accounts:
+        debit, credit = movements.get(account['numero'], (0, 0))
+        opening_balance = 0
+        if account['tyyppi'] in BALANCE_SHEET_TYPES:
+            opening_debit, opening_credit = opening.get(account['numero'], (0, 0))
+            opening_balance = opening_debit - opening_credit
+        if not (opening_balance or debit or credit):
+            continue
+        rows.append({
+            'numero': account['numero'],
+            'nimi': account['nimi'],
+            'tyyppi': account['tyyppi'],
+            'alkusaldo': opening_balance,
+            'debet': debit,
+            'kredit': credit,
+            'loppusaldo': opening_balance + debit - credit
+        })
+    return rows
+
+def close_fiscal_period(conn, start):
+    """
+    Close a fiscal period: snapshot its account movements into TilikausiSaldo
+    and lock its ledger lines by moving TilitPaatetty to its last day.
+    Periods are closed in order.
+
+    Raises:
+        ValueError: If the period does not exist, is already closed, or an
+                    earlier period is still open
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT alkaa, loppuu FROM Tilikausi WHERE alkaa = ?", (start,)).fetchone()
+        if not row:
+            raise ValueError("Fiscal period not found")
+        end = row[1]
+
+        closed_until = conn.execute("SELECT arvo FROM Asetus WHERE avain = ?", (CLOSED_UNTIL_KEY,)).fetchone()
+        closed_until = closed_until[0] if closed_until and closed_until[0] else ''
+        if end <= closed_until:
+            raise ValueError("Fiscal period is already closed")
+        if conn.execute("SELECT 1 FROM Tilikausi WHERE alkaa < ? AND loppuu > ?", (start, closed_until)).fetchone():
+            raise ValueError("Close the earlier fiscal periods first")
+
+        conn.execute("DELETE FROM TilikausiSaldo WHERE tilikausi = ?", (start,))
+        conn.execute("""
+            INSERT INTO TilikausiSaldo (tilikausi, tili, debetsnt, kreditsnt)
+            SELECT ?, tili, SUM(COALESCE(debetsnt, 0)), SUM(COALESCE(kreditsnt, 0)) FROM Vienti
+            WHERE pvm BETWEEN ? AND ?
+            GROUP BY tili
+        """, (start, start, end))
+        conn.execute("""
+            UPDATE Tilikausi
+            SET json = json_set(CASE WHEN json_valid(json) THEN json ELSE '{}' END, '$.suljettu', datetime('now'))
+            WHERE alkaa = ?
+        """, (start,))
+        conn.execute("""
+            INSERT INTO Asetus (avain, arvo) VALUES (?, ?)
+            ON CONFLICT (avain) DO UPDATE SET arvo = excluded.arvo, muokattu = CURRENT_TIMESTAMP
+        """, (CLOSED_UNTIL_KEY, end))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def get_monthly_totals(conn, start_period=None, end_period=None, account=None):
+    """
+    Debits, credits and line counts per account, allocation and month
+    from the KohdennusSaldo table.
+
+    Args:
+        conn: Connection to a client database
+        start_period (str): First month to include, 'YYYY-MM'
+        end_period (str): Last month to include, 'YYYY-MM'
+        account (int): Only this account
+
+    Returns:
+        list: Rows of (tili, kohdennus, kausi, debetsnt, kreditsnt, rivit)
+              ordered by account, allocation and month
+    """
+    conditions = ["rivit > 0"]
+    params = []
+    if account is not None:
+        conditions.append("tili = ?")
+        params.append(account)
+    if start_period:
+        conditions.append("kausi >= ?")
+        params.append(start_period)
+    if end_period:
+        conditions.append("kausi <= ?")
+        params.append(end_period)
+
+    return conn.execute(f"""
+        SELECT tili, kohdennus, kausi, debetsnt, kreditsnt, rivit FROM KohdennusSaldo
+        WHERE {" AND ".join(conditions)}
+        ORDER BY tili, kohdennus, kausi
+    """, params).fetchall()
+
+def rebuild_balances(conn):
+    """Recompute the Saldo, KohdennusSaldo and Reskontra tables from the ledger"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM Saldo")
+        conn.execute(BALANCE_BACKFILL)
+        conn.execute("DELETE FROM KohdennusSaldo")
+        conn.execute(ALLOCATION_BALANCE_BACKFILL)
+        conn.execute("DELETE FROM Reskontra")
+        conn.execute(OPEN_ITEM_BACKFILL)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def verify_balances(conn):
+    """
+    Compare the Saldo table with the ledger.
+
+    Returns:
+        list: (tili, kausi, stored debit, stored credit, ledger debit, ledger credit)
+              for every month that differs
+    """
+    cursor = conn.execute("""
+        WITH ledger AS (
+            SELECT tili, COALESCE(substr(pvm, 1, 7), '') AS kausi,
+                   SUM(COALESCE(debetsnt, 0)) AS debetsnt, SUM(COALESCE(kreditsnt, 0)) AS kreditsnt
+            FROM Vienti
+            GROUP BY 1, 2
+        ),
+        keys AS (
+            SELECT tili, kausi FROM ledger
+            UNION
+            SELECT tili, kausi FROM Saldo
+        )
+        SELECT k.tili, k.kausi,
+               COALESCE(s.debetsnt, 0), COALESCE(s.kreditsnt, 0),
+               COALESCE(l.debetsnt, 0), COALESCE(l.kreditsnt, 0)
+        FROM keys k
+        LEFT JOIN Saldo s ON s.tili = k.tili AND s.kausi = k.kausi
+        LEFT JOIN ledger l ON l.tili = k.tili AND l.kausi = k.kausi
+        WHERE COALESCE(s.debetsnt, 0) != COALESCE(l.debetsnt, 0)
+           OR COALESCE(s.kreditsnt, 0) != COALESCE(l.kreditsnt, 0)
+        ORDER BY k.tili, k.kausi
+    """)
+    return cursor.fetchall()
+
+def verify_allocation_balances(conn):
+    """
+    Compare the KohdennusSaldo table with the ledger.
+
+    Returns:
+        list: (tili, kohdennus, kausi) of every month that differs
+    """
+    cursor = conn.execute("""
+        WITH ledger AS (
+            SELECT tili, COALESCE(kohdennus, 0) AS kohdennus, COALESCE(substr(pvm, 1, 7), '') AS kausi,
+                   SUM(COALESCE(debetsnt, 0)) AS debetsnt, SUM(COALESCE(kreditsnt, 0)) AS kreditsnt,
+                   COUNT(*) AS rivit
+            FROM Vienti
+            GROUP BY 1, 2, 3
+        ),
+        stored AS (
+            SELECT tili, kohdennus, kausi, debetsnt, kreditsnt, rivit FROM KohdennusSaldo WHERE rivit != 0
+        )
+        SELECT tili, kohdennus, kausi FROM (
+            SELECT * FROM ledger EXCEPT SELECT * FROM stored
+            UNION
+            SELECT * FROM stored EXCEPT SELECT * FROM ledger
+        )
+        ORDER BY 1, 2, 3
+    """)
+    return cursor.fetchall()
+
+def verify_open_items(conn):
+    """
+    Compare the Reskontra table with the receivable lines of sales invoices.
+
+    Returns:
+        list: eraid of every item that differs
+    """
+    cursor = conn.execute("""
+        WITH ledger AS (
+            SELECT t.id AS eraid,
+                   SUM(COALESCE(v.debetsnt, 0)) AS debetsnt, SUM(COALESCE(v.kreditsnt, 0)) AS kreditsnt,
+                   COUNT(*) AS rivit
+            FROM Vienti v
+            JOIN Tosite t ON t.id = COALESCE(v.eraid, v.tosite)
+            WHERE v.tili = ? AND t.tyyppi = 1
+            GROUP BY 1
+        ),
+        stored AS (
+            SELECT eraid, debetsnt, kreditsnt, rivit FROM Reskontra WHERE rivit != 0
+        )
+        SELECT eraid FROM (
+            SELECT * FROM ledger EXCEPT SELECT * FROM stored
+            UNION
+            SELECT * FROM stored EXCEPT SELECT * FROM ledger
+        )
+        ORDER BY 1
+    """, (INVOICE_RECEIVABLE_ACCOUNT,))
+    return [row[0] for row in cursor.fetchall()]
+
+def main(argv=None):
+    """Rebuild or verify the stored balances of client databases"""
+    parser = argparse.ArgumentParser(description="Rebuild or verify the Saldo, KohdennusSaldo and Reskontra tables of client databases")
+    parser.add_argument('command', choices=['rebuild', 'verify'])
+    parser.add_argument('databases', nargs='*', help="Database filenames (default: all in the database directory)")
+    parser.add_argument('--directory', default=DATABASE_DIR)
+    args = parser.parse_intermixed_args(argv)
+
+    filenames = args.databases or sorted(name for name in os.listdir(args.directory) if name.endswith('.db'))
+    failed = False
+
+    for filename in filenames:
+        conn = connect(os.path.join(args.directory, filename))
+        try:
+            ensure_schema(conn)
+            if args.command == 'rebuild':
+                rebuild_balances(conn)
+                print(f"{filename}: rebuilt")
+            else:
+                differences = verify_balances(conn)
+                allocation_differences = verify_allocation_balances(conn)
+                item_differences = verify_open_items(conn)
+                if differences or allocation_differences or item_differences:
+                    failed = True
+                    print(f"{filename}: {len(differences) + len(allocation_differences)} months, "
+                          f"{len(item_differences)} open items differ")
+                    for tili, kausi, debit, credit, ledger_debit, ledger_credit in differences:
+                        print(f"  {tili} {kausi or '-'}: stored {debit}/{credit}, ledger {ledger_debit}/{ledger_credit}")
+                    for tili, kohdennus, kausi in allocation_differences:
+                        print(f"  {tili} allocation {kohdennus} {kausi or '-'}: stored per allocation differs")
+                    for eraid in item_differences:
+                        print(f"  open item {eraid}: stored receivable differs")
+                else:
+                    print(f"{filename}: ok")
+        except sqlite3.Error as e:
+            failed = True
+            print(f"{filename}: error: {e}")
+        finally:
+            conn.close()
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
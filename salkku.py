@@ -0,0 +1,263 @@
+import io
+import os
+import sys
+import csv
+import json
+import sqlite3
+import argparse
+import datetime
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from flask import Blueprint, request, jsonify, Response
+from tietokanta import DATABASE_DIR
+from viennit import INVOICE_RECEIVABLE_ACCOUNT
+
+# Create a Blueprint for the portfolio report routes
+salkku_bp = Blueprint('salkku', __name__, template_folder='templates')
+
+# Figures of each client, kept next to the databases
+REPORT_CACHE_FILE = '.salkkuraportti.sqlite'
+
+# VAT accounts (alv-velat), as suggested for the VAT codes in tosite
+VAT_ACCOUNTS = (2920, 2949)
+
+# Fewer changed clients than this are read in the calling process
+PARALLEL_THRESHOLD = 8
+
+# Columns of the report, in CSV order
+REPORT_COLUMNS = (
+    'tiedosto', 'nimi', 'saatavat_snt', 'avoimet_laskut', 'eraantyneet_laskut',
+    'eraantyneet_snt', 'alv_snt', 'virhe'
+)
+
+# Columns summed for the whole portfolio
+TOTAL_COLUMNS = ('saatavat_snt', 'avoimet_laskut', 'eraantyneet_laskut', 'eraantyneet_snt', 'alv_snt')
+
+def _account_balance(conn, low, high, use_balances):
+    """Debits minus credits of an account range, from Saldo when it has been built"""
+    table = 'Saldo' if use_balances else 'Vienti'
+    return conn.execute(f"""
+        SELECT COALESCE(SUM(debetsnt), 0) - COALESCE(SUM(kreditsnt), 0) FROM {table}
+        WHERE tili BETWEEN ? AND ?
+    """, (low, high)).fetchone()[0]
+
+def read_client_figures(path, today):
+    """
+    Read the report figures of one client database, read-only.
+    Runs in a worker process.
+
+    Returns:
+        dict: One report row; 'virhe' holds the error if the file could not be read
+    """
+    filename = os.path.basename(path)
+    figures = dict.fromkeys(REPORT_COLUMNS)
+    figures.update(tiedosto=filename, nimi=filename)
+
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=30)
+        try:
+            row = conn.execute("SELECT arvo FROM Asetus WHERE avain = 'Nimi'").fetchone()
+            if row and row[0]:
+                figures['nimi'] = row[0]
+
+            # Databases not migrated yet have no Saldo table
+            use_balances = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Saldo'"
+            ).fetchone() is not None
+
+            figures['saatavat_snt'] = _account_balance(
+                conn, INVOICE_RECEIVABLE_ACCOUNT, INVOICE_RECEIVABLE_ACCOUNT, use_balances)
+            figures['alv_snt'] = -_account_balance(conn, *VAT_ACCOUNTS, use_balances)
+
+            # Outstanding per invoice from Reskontra, counting partial payments;
+            # without it, summed from the receivable lines in the same shape
+            has_open_items = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Reskontra'"
+            ).fetchone() is not None
+            open_items = "Reskontra" if has_open_items else """(
+                SELECT COALESCE(eraid, tosite) AS eraid, SUM(COALESCE(debetsnt, 0)) AS debetsnt,
+                       SUM(COALESCE(kreditsnt, 0)) AS kreditsnt
+                FROM Vienti WHERE tili = :saatavat
+                GROUP BY COALESCE(eraid, tosite)
+            )"""
+
+            # Open as in the invoice list: not paid (4), credited (5) or voided (6)
+            open_count, overdue_count, overdue_cents = conn.execute(f"""
+                SELECT COUNT(*),
+                       COALESCE(SUM(t.erapvm < :paiva), 0),
+                       COALESCE(SUM(CASE WHEN t.erapvm < :paiva THEN r.debetsnt - r.kreditsnt END), 0)
+                FROM Tosite t
+                LEFT JOIN {open_items} r ON r.eraid = t.id
+                WHERE t.tyyppi = 1 AND t.tila NOT IN (4, 5, 6)
+            """, {'paiva': today, 'saatavat': INVOICE_RECEIVABLE_ACCOUNT}).fetchone()
+            figures.update(avoimet_laskut=open_count, eraantyneet_laskut=overdue_count,
+                           eraantyneet_snt=overdue_cents)
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        figures['virhe'] = str(e)
+
+    return figures
+
+class ReportCache:
+    """
+    Persistent cache of the report figures of each client database.
+    An entry is valid for the day it was read, as long as the file's inode,
+    size and modification time (including its write-ahead log) are unchanged.
+    """
+
+    def __init__(self, directory=DATABASE_DIR, cache_file=REPORT_CACHE_FILE):
+        self.directory = directory
+        self.cache_path = os.path.join(directory, cache_file)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.cache_path, timeout=30)
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS Raportti (
+            tiedosto TEXT PRIMARY KEY NOT NULL,
+            muokattu_ns INTEGER,
+            koko INTEGER,
+            inode INTEGER,
+            paiva TEXT,
+            tiedot TEXT
+        )
+        ''')
+        return conn
+
+    def _signature(self, entry):
+        """(mtime, size, inode) of a client database"""
+        stat = entry.stat()
+        modified_ns = stat.st_mtime_ns
+        try:
+            wal = os.stat(entry.path + '-wal')
+            # Readers create an empty log; only one with frames holds changes
+            if wal.st_size:
+                modified_ns = max(modified_ns, wal.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        return modified_ns, stat.st_size, stat.st_ino
+
+    def report(self, today=None, workers=1):
+        """
+        Figures of every client database, reading only the changed ones.
+
+        Args:
+            today (str): Invoices due before this date are overdue
+            workers (int): Processes reading the changed files; 1 reads them
+                in the calling process, None starts one per CPU. Only the
+                command line uses a process pool.
+
+        Returns:
+            list: Report rows sorted by client name
+        """
+        today = today or datetime.date.today().isoformat()
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = self._connect()
+            try:
+                cached = {row[0]: row[1:] for row in conn.execute(
+                    "SELECT tiedosto, muokattu_ns, koko, inode, paiva, tiedot FROM Raportti")}
+
+                rows = []
+                stale = []  # (filename, signature)
+                with os.scandir(self.directory) as it:
+                    for entry in it:
+                        if not entry.name.endswith('.db') or not entry.is_file():
+                            continue
+                        signature = self._signature(entry)
+                        hit = cached.pop(entry.name, None)
+                        if hit and hit[:3] == signature and hit[3] == today:
+                            rows.append(json.loads(hit[4]))
+                        else:
+                            stale.append((entry.name, signature))
+
+                paths = [os.path.join(self.directory, filename) for filename, _ in stale]
+                if len(paths) < PARALLEL_THRESHOLD or workers == 1:
+                    fresh = [read_client_figures(path, today) for path in paths]
+                else:
+                    # Every client is its own file, so they are read independently
+                    with ProcessPoolExecutor(max_workers=workers) as executor:
+                        fresh = list(executor.map(read_client_figures, paths, [today] * len(paths),
+                                                  chunksize=max(1, len(paths) // 64)))
+
+                rows.extend(fresh)
+                conn.executemany("""
+                    INSERT OR REPLACE INTO Raportti (tiedosto, muokattu_ns, koko, inode, paiva, tiedot)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, [(filename, *signature, today, json.dumps(figures))
+                      for (filename, signature), figures in zip(stale, fresh) if not figures['virhe']])
+                # Left in the cache: files that no longer exist
+                conn.executemany("DELETE FROM Raportti WHERE tiedosto = ?", [(f,) for f in cached])
+                conn.commit()
+            finally:
+                conn.close()
+
+        rows.sort(key=lambda row: ((row['nimi'] or '').lower(), row['tiedosto']))
+        return rows
+
+cache = ReportCache()
+
+def portfolio_totals(rows):
+    """Sum the figures of the clients read without errors"""
+    totals = dict.fromkeys(TOTAL_COLUMNS, 0)
+    for row in rows:
+        if not row['virhe']:
+            for column in TOTAL_COLUMNS:
+                totals[column] += row[column] or 0
+    totals['asiakkaat'] = len(rows)
+    totals['virheet'] = sum(1 for row in rows if row['virhe'])
+    return totals
+
+def write_csv(rows, stream):
+    """Write the report rows as CSV"""
+    writer = csv.DictWriter(stream, fieldnames=REPORT_COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+@salkku_bp.route('/portfolio/report')
+def portfolio_report():
+    """Figures of all clients as JSON, or as CSV with ?format=csv"""
+    today = datetime.date.today().isoformat()
+    # Read serially in the request worker; a process pool belongs to the
+    # command line, which also refreshes the shared cache file
+    rows = cache.report(today, workers=1)
+
+    if request.args.get('format') == 'csv':
+        output = io.StringIO()
+        write_csv(rows, output)
+        return Response(output.getvalue(), mimetype='text/csv', headers={
+            'Content-Disposition': f'attachment; filename=salkku_{today}.csv'
+        })
+
+    return jsonify({"paiva": today, "asiakkaat": rows, "yhteensa": portfolio_totals(rows)})
+
+def register_blueprint(app):
+    """Register the blueprint with the main Flask app"""
+    app.register_blueprint(salkku_bp)
+
+def main(argv=None):
+    """Print the portfolio report of all client databases"""
+    parser = argparse.ArgumentParser(description="Receivables, overdue invoices and VAT payable across all clients")
+    parser.add_argument('--format', choices=('json', 'csv'), default='json')
+    parser.add_argument('--date', type=datetime.date.fromisoformat,
+                        help="Invoices due before this date (YYYY-MM-DD) are overdue (default: today)")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--directory', default=DATABASE_DIR)
+    args = parser.parse_intermixed_args(argv)
+
+    today = (args.date or datetime.date.today()).isoformat()
+    rows = ReportCache(args.directory).report(today, args.workers)
+
+    if args.format == 'csv':
+        write_csv(rows, sys.stdout)
+    else:
+        json.dump({"paiva": today, "asiakkaat": rows, "yhteensa": portfolio_totals(rows)},
+                  sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+    return 1 if any(row['virhe'] for row in rows) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
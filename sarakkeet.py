@@ -0,0 +1,366 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+from collections import OrderedDict
+from tietokanta import DATABASE_DIR, ensure_schema, connect
+from saldot import get_account_balances, get_monthly_totals
+
+# NumPy is optional; without it reports take the SQL path
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Ledger extracts kept in memory, most recently used first
+MAX_CACHED_EXTRACTS = 4
+
+# Asetus key of the ledger change counter, bumped by triggers on every change
+# to the extracted Vienti columns (migration 13)
+VERSION_KEY = 'ViennitVersio'
+
+EXTRACT_QUERY = """
+    SELECT id, COALESCE(tili, 0), COALESCE(CAST(replace(pvm, '-', '') AS INTEGER), 0),
+           COALESCE(kohdennus, 0), COALESCE(debetsnt, 0), COALESCE(kreditsnt, 0)
+    FROM Vienti
+"""
+
+def available():
+    """Whether NumPy is installed"""
+    return np is not None
+
+def get_version(conn):
+    """Ledger change counter of a client database; None if it is not kept"""
+    row = conn.execute("SELECT arvo FROM Asetus WHERE avain = ?", (VERSION_KEY,)).fetchone()
+    try:
+        return int(row[0]) if row else None
+    except (TypeError, ValueError):
+        return None
+
+def date_number(date):
+    """ISO date as the YYYYMMDD integer used in extracts"""
+    return int(date.replace('-', ''))
+
+def _run_starts(keys):
+    """Indexes where a run of equal keys starts; the key arrays are sorted together"""
+    change = np.zeros(len(keys[0]), dtype=bool)
+    change[0] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(change)
+
+def _group_sums(keys, values):
+    """
+    Sum the values over runs of equal keys.
+
+    Returns:
+        tuple: (list of key arrays, list of summed value arrays, row counts)
+    """
+    if not len(keys[0]):
+        return [key[:0] for key in keys], [value[:0] for value in values], np.zeros(0, dtype=np.int64)
+    starts = _run_starts(keys)
+    counts = np.diff(np.append(starts, len(keys[0])))
+    return [key[starts] for key in keys], [np.add.reduceat(value, starts) for value in values], counts
+
+class LedgerExtract:
+    """
+    Columnar copy of the Vienti table as typed NumPy arrays, sorted by
+    (tili, pvm, id): the ledger order of each account. Dates are YYYYMMDD
+    integers (0 when missing) and amounts are integer cents, so the results
+    are exact and match the SQL reports.
+    """
+
+    def __init__(self, conn):
+        dtype = np.dtype([('id', 'i8'), ('tili', 'i4'), ('pvm', 'i4'),
+                          ('kohdennus', 'i4'), ('debetsnt', 'i8'), ('kreditsnt', 'i8')])
+
+        # One read transaction, so the version, the count and the rows agree
+        own_transaction = not conn.in_transaction
+        if own_transaction:
+            conn.execute("BEGIN")
+        try:
+            self.version = get_version(conn)
+            count = conn.execute("SELECT COUNT(*) FROM Vienti").fetchone()[0]
+            cursor = conn.cursor()
+            cursor.row_factory = None  # Plain tuples, whatever the connection uses
+            rows = np.fromiter(cursor.execute(EXTRACT_QUERY), dtype=dtype, count=count)
+        finally:
+            if own_transaction:
+                conn.rollback()
+
+        rows = rows[np.lexsort((rows['id'], rows['pvm'], rows['tili']))]
+        self.id = np.ascontiguousarray(rows['id'])
+        self.tili = np.ascontiguousarray(rows['tili'])
+        self.pvm = np.ascontiguousarray(rows['pvm'])
+        self.kohdennus = np.ascontiguousarray(rows['kohdennus'])
+        self.debetsnt = np.ascontiguousarray(rows['debetsnt'])
+        self.kreditsnt = np.ascontiguousarray(rows['kreditsnt'])
+
+        # Running debit - credit over the whole extract, and the line ids in
+        # order with their positions; built on first use
+        self._cumulative = None
+        self._id_order = None
+
+    def __len__(self):
+        return len(self.id)
+
+    def date_mask(self, start=None, end=None):
+        """Lines dated from start to end (ISO dates, inclusive); None when unbounded"""
+        if not start and not end:
+            return None
+        mask = self.pvm > 0  # Undated lines fall outside every date range, as in SQL
+        if start:
+            mask &= self.pvm >= date_number(start)
+        if end:
+            mask &= self.pvm <= date_number(end)
+        return mask
+
+    def account_totals(self, start=None, end=None):
+        """
+        Debits and credits (in cents) of every account from start to end.
+
+        Returns:
+            dict: Account number -> (debit, credit)
+        """
+        mask = self.date_mask(start, end)
+        tili, debit, credit = self.tili, self.debetsnt, self.kreditsnt
+        if mask is not None:
+            tili, debit, credit = tili[mask], debit[mask], credit[mask]
+
+        (accounts,), (debits, credits), _ = _group_sums([tili], [debit, credit])
+        return {int(a): (int(d), int(c)) for a, d, c in zip(accounts, debits, credits)}
+
+    def monthly_totals(self, account=None):
+        """
+        Debits, credits and line counts per account, allocation and month,
+        in the row format of saldot.get_monthly_totals.
+
+        Returns:
+            list: (tili, kohdennus, kausi, debetsnt, kreditsnt, rivit) tuples
+        """
+        tili, kohdennus, month = self.tili, self.kohdennus, self.pvm // 100
+        debit, credit = self.debetsnt, self.kreditsnt
+        if account is not None:
+            low, high = np.searchsorted(tili, [account, account + 1])
+            tili, kohdennus, month = tili[low:high], kohdennus[low:high], month[low:high]
+            debit, credit = debit[low:high], credit[low:high]
+
+        # Already sorted by account and date, so by month within an account
+        order = np.lexsort((month, kohdennus, tili))
+        keys, sums, counts = _group_sums([tili[order], kohdennus[order], month[order]],
+                                         [debit[order], credit[order]])
+
+        return [(int(t), int(k), f"{m // 100:04d}-{m % 100:02d}" if m else '', int(d), int(c), int(n))
+                for t, k, m, d, c, n in zip(*keys, *sums, counts)]
+
+    def _cumulative_sums(self):
+        if self._cumulative is None:
+            self._cumulative = np.cumsum(self.debetsnt - self.kreditsnt)
+        return self._cumulative
+
+    def running_balances(self, account=None):
+        """
+        Balance (debit - credit, in cents) of an account after each of its
+        lines, or of every account after each line when account is None.
+
+        Returns:
+            tuple: (line ids, dates as YYYYMMDD, balances), in ledger order
+        """
+        cumulative = self._cumulative_sums()
+        if account is not None:
+            low, high = np.searchsorted(self.tili, [account, account + 1])
+            base = cumulative[low - 1] if low else 0
+            return self.id[low:high], self.pvm[low:high], cumulative[low:high] - base
+
+        if not len(self):
+            return self.id, self.pvm, cumulative
+        # Subtract the running sum before the first line of each account
+        starts = _run_starts([self.tili])
+        before = np.concatenate(([0], cumulative[starts[1:] - 1]))
+        counts = np.diff(np.append(starts, len(self)))
+        return self.id, self.pvm, cumulative - np.repeat(before, counts)
+
+    def balances_after(self, account, ids):
+        """
+        Balance (debit - credit, in cents) of an account after each of the
+        given lines.
+
+        Returns:
+            dict: Line id -> balance, or None if a line is not on the account in this extract
+        """
+        if self._id_order is None:
+            order = np.argsort(self.id, kind='stable')
+            self._id_order = (self.id[order], order)
+        sorted_ids, order = self._id_order
+
+        ids = np.asarray(ids, dtype=np.int64)
+        found = np.searchsorted(sorted_ids, ids)
+        if len(ids) and (found.max() >= len(sorted_ids) or (sorted_ids[found] != ids).any()):
+            return None
+        positions = order[found]
+
+        low, high = np.searchsorted(self.tili, [account, account + 1])
+        if len(ids) and (positions.min() < low or positions.max() >= high):
+            return None
+        cumulative = self._cumulative_sums()
+        base = cumulative[low - 1] if low else 0
+        return {int(line): int(balance) for line, balance in zip(ids, cumulative[positions] - base)}
+
+    def cash_flow(self, low, high, start=None, end=None):
+        """
+        Money in (debits) and out (credits) of an account range per month.
+
+        Returns:
+            list: Dicts with kausi, sisaan, ulos and netto in cents, by month
+        """
+        first, last = np.searchsorted(self.tili, [low, high + 1])
+        month = self.pvm[first:last] // 100
+        debit, credit = self.debetsnt[first:last], self.kreditsnt[first:last]
+
+        mask = self.date_mask(start, end)
+        if mask is not None:
+            mask = mask[first:last]
+            month, debit, credit = month[mask], debit[mask], credit[mask]
+
+        order = np.argsort(month, kind='stable')
+        (months,), (debits, credits), _ = _group_sums([month[order]], [debit[order], credit[order]])
+        return [{'kausi': f"{m // 100:04d}-{m % 100:02d}" if m else '',
+                 'sisaan': int(d), 'ulos': int(c), 'netto': int(d - c)}
+                for m, d, c in zip(months, debits, credits)]
+
+def type_totals(balances, account_types, absolute=()):
+    """
+    Account balances summed by account type code.
+
+    Args:
+        balances: Account number -> balance in cents
+        account_types: Account number -> type code ('A'...'E')
+        absolute: Type codes whose accounts are summed as absolute balances
+
+    Returns:
+        dict: Type code -> total in cents, for the codes present
+    """
+    if not balances:
+        return {}
+    amounts = np.fromiter(balances.values(), dtype=np.int64, count=len(balances))
+    codes, groups = np.unique([account_types.get(number) or '' for number in balances], return_inverse=True)
+    amounts = np.where(np.isin(codes[groups], list(absolute)), np.abs(amounts), amounts)
+
+    totals = np.zeros(len(codes), dtype=np.int64)
+    np.add.at(totals, groups, amounts)
+    return {str(code): int(total) for code, total in zip(codes, totals)}
+
+class ExtractCache:
+    """
+    In-process cache of ledger extracts per client database, keyed by the
+    ledger change counter. A reader pays one primary key lookup; the Vienti
+    table is read again only after it has changed, not after writes to
+    vouchers, settings or other tables.
+    """
+
+    def __init__(self, max_entries=MAX_CACHED_EXTRACTS):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # filename -> LedgerExtract
+
+    def get(self, conn, filename):
+        """Ledger extract of a client database, loaded if the ledger has changed"""
+        version = get_version(conn)
+        with self._lock:
+            extract = self._entries.get(filename)
+            if extract and version is not None and extract.version == version:
+                self._entries.move_to_end(filename)
+                return extract
+
+        extract = LedgerExtract(conn)
+        with self._lock:
+            self._entries[filename] = extract
+            self._entries.move_to_end(filename)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return extract
+
+cache = ExtractCache()
+
+def get_extract(conn, filename):
+    """Columnar ledger extract of a client database; NumPy must be available"""
+    return cache.get(conn, filename)
+
+def verify_extract(conn):
+    """
+    Compare the extract computations with the SQL path.
+
+    Returns:
+        list: Names of the computations that differ
+    """
+    extract = LedgerExtract(conn)
+    differences = []
+
+    sql_balances = {account: balance for account, balance in get_account_balances(conn).items() if balance}
+    extract_balances = {account: debit - credit for account, (debit, credit) in extract.account_totals().items()
+                        if debit - credit}
+    if sql_balances != extract_balances:
+        differences.append('account balances')
+
+    if [tuple(row) for row in get_monthly_totals(conn)] != extract.monthly_totals():
+        differences.append('monthly totals')
+
+    sql_running = dict(conn.execute("""
+        SELECT id, SUM(COALESCE(debetsnt, 0) - COALESCE(kreditsnt, 0))
+               OVER (PARTITION BY COALESCE(tili, 0) ORDER BY pvm, id)
+        FROM Vienti
+    """).fetchall())
+    ids, _, balances = extract.running_balances()
+    if sql_running != dict(zip(ids.tolist(), balances.tolist())):
+        differences.append('running balances')
+
+    account_types = dict(conn.execute("SELECT numero, tyyppi FROM Tili").fetchall())
+    sql_types = {}
+    for account, balance in sql_balances.items():
+        code = account_types.get(account) or ''
+        sql_types[code] = sql_types.get(code, 0) + balance
+    if sql_types != type_totals(extract_balances, account_types):
+        differences.append('type totals')
+
+    return differences
+
+def main(argv=None):
+    """Time ledger extracts of client databases and check them against the SQL reports"""
+    parser = argparse.ArgumentParser(description="Check columnar ledger extracts against the SQL reports")
+    parser.add_argument('databases', nargs='*', help="Database filenames (default: all in the database directory)")
+    parser.add_argument('--directory', default=DATABASE_DIR)
+    args = parser.parse_intermixed_args(argv)
+
+    if not available():
+        print("NumPy is not installed")
+        return 1
+
+    filenames = args.databases or sorted(name for name in os.listdir(args.directory) if name.endswith('.db'))
+    failed = False
+
+    for filename in filenames:
+        conn = connect(os.path.join(args.directory, filename))
+        try:
+            ensure_schema(conn)
+            started = time.perf_counter()
+            lines = len(LedgerExtract(conn))
+            seconds = time.perf_counter() - started
+
+            differences = verify_extract(conn)
+            if differences:
+                failed = True
+                print(f"{filename}: {lines} lines in {seconds * 1000:.0f} ms, differs: {', '.join(differences)}")
+            else:
+                print(f"{filename}: {lines} lines in {seconds * 1000:.0f} ms, ok")
+        except sqlite3.Error as e:
+            failed = True
+            print(f"{filename}: error: {e}")
+        finally:
+            conn.close()
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
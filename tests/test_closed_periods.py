@@ -0,0 +1,58 @@
+"""
+Closing a fiscal period snapshots its balances and moves TilitPaatetty to
+its last day; the triggers of migration 8 then refuse every write to the
+ledger lines dated in it.
+"""
+import sqlite3
+import pytest
+from saldot import close_fiscal_period, CLOSED_UNTIL_KEY
+
+def add_voucher(conn, date, cents, debit_account=1000, credit_account=3000):
+    """Insert a balanced two-line voucher, returning its id"""
+    voucher_id = conn.execute("INSERT INTO Tosite (pvm, tyyppi) VALUES (?, 7)", (date,)).lastrowid
+    conn.executemany("INSERT INTO Vienti (tosite, rivi, pvm, tili, debetsnt, kreditsnt) VALUES (?, ?, ?, ?, ?, ?)", [
+        (voucher_id, 1, date, debit_account, cents, 0),
+        (voucher_id, 2, date, credit_account, 0, cents),
+    ])
+    conn.commit()
+    return voucher_id
+
+@pytest.fixture
+def conn(open_connection):
+    conn = open_connection()
+    add_voucher(conn, '2024-06-30', 12345)
+    close_fiscal_period(conn, '2024-01-01')
+    return conn
+
+def test_closing_records_the_period_end_and_snapshot(conn):
+    assert conn.execute("SELECT arvo FROM Asetus WHERE avain = ?", (CLOSED_UNTIL_KEY,)).fetchone()[0] == '2024-12-31'
+    snapshot = {row['tili']: (row['debetsnt'], row['kreditsnt'])
+                for row in conn.execute("SELECT tili, debetsnt, kreditsnt FROM TilikausiSaldo WHERE tilikausi = '2024-01-01'")}
+    assert snapshot == {1000: (12345, 0), 3000: (0, 12345)}
+
+def test_insert_into_closed_period_is_refused(conn):
+    with pytest.raises(sqlite3.IntegrityError, match="closed"):
+        add_voucher(conn, '2024-12-31', 100)
+    conn.rollback()
+    assert conn.execute("SELECT COUNT(*) FROM Vienti WHERE pvm = '2024-12-31'").fetchone()[0] == 0
+
+    # The day after the period is open
+    add_voucher(conn, '2025-01-01', 100)
+
+def test_update_and_delete_in_closed_period_are_refused(conn):
+    with pytest.raises(sqlite3.IntegrityError, match="closed"):
+        conn.execute("UPDATE Vienti SET debetsnt = 1 WHERE pvm = '2024-06-30' AND tili = 1000")
+    with pytest.raises(sqlite3.IntegrityError, match="closed"):
+        conn.execute("DELETE FROM Vienti WHERE pvm = '2024-06-30'")
+    conn.rollback()
+    assert conn.execute("SELECT COUNT(*) FROM Vienti WHERE pvm = '2024-06-30'").fetchone()[0] == 2
+
+def test_line_cannot_be_moved_into_closed_period(conn):
+    voucher_id = add_voucher(conn, '2025-02-01', 100)
+    with pytest.raises(sqlite3.IntegrityError, match="closed"):
+        conn.execute("UPDATE Vienti SET pvm = '2024-12-01' WHERE tosite = ?", (voucher_id,))
+    conn.rollback()
+
+def test_period_cannot_be_closed_twice(conn):
+    with pytest.raises(ValueError, match="already closed"):
+        close_fiscal_period(conn, '2024-01-01')
@@ -0,0 +1,82 @@
+"""
+Invoice numbers are taken from the per-series Asetus sequence inside the
+invoice's BEGIN IMMEDIATE transaction: concurrent writers get distinct,
+consecutive numbers, and a rolled back invoice gives its number back.
+"""
+import sqlite3
+import threading
+import pytest
+from laskut import allocate_invoice_number
+
+INVOICES_PER_WRITER = 25
+
+def create_invoice(conn, series=None):
+    """Number and insert one invoice in its own write transaction"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        number = allocate_invoice_number(conn, series)
+        conn.execute("INSERT INTO Tosite (pvm, tyyppi, tunniste, sarja) VALUES ('2024-05-01', 1, ?, ?)",
+                     (number, series))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return number
+
+def test_sequence_starts_from_the_configured_number(open_connection):
+    conn = open_connection()
+    assert [create_invoice(conn) for _ in range(3)] == [100, 101, 102]
+
+def test_two_connections_get_distinct_consecutive_numbers(open_connection):
+    connections = [open_connection(), open_connection()]
+    numbers = [[], []]
+    errors = []
+    barrier = threading.Barrier(len(connections))
+
+    def write(index):
+        try:
+            barrier.wait()
+            for _ in range(INVOICES_PER_WRITER):
+                numbers[index].append(create_invoice(connections[index]))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(len(connections))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    # Each writer sees its own numbers in order, and together they leave no gaps
+    for own in numbers:
+        assert own == sorted(own)
+    assert sorted(numbers[0] + numbers[1]) == list(range(100, 100 + 2 * INVOICES_PER_WRITER))
+
+    stored = [row[0] for row in connections[0].execute("SELECT tunniste FROM Tosite WHERE tyyppi = 1")]
+    assert len(stored) == len(set(stored)) == 2 * INVOICES_PER_WRITER
+
+def test_second_writer_waits_and_rollback_returns_the_number(open_connection):
+    first, second = open_connection(), open_connection()
+    second.execute("PRAGMA busy_timeout = 0")
+
+    first.execute("BEGIN IMMEDIATE")
+    assert allocate_invoice_number(first) == 100
+
+    # The sequence is read under the write lock, so the second writer cannot
+    # take a number until the first one has finished
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        second.execute("BEGIN IMMEDIATE")
+
+    first.rollback()
+    assert create_invoice(second) == 100
+
+def test_series_have_their_own_sequences(open_connection):
+    conn = open_connection()
+    conn.execute("INSERT INTO Tosite (pvm, tyyppi, tunniste, sarja) VALUES ('2024-01-01', 1, 41, 'A')")
+    conn.commit()
+
+    assert create_invoice(conn, 'A') == 42
+    assert create_invoice(conn) == 100
+    assert create_invoice(conn, 'B') == 1
+    assert create_invoice(conn, 'A') == 43
@@ -0,0 +1,61 @@
+"""
+Payments of an invoice settle its open item in Reskontra through eraid:
+a partial payment leaves the rest open, the last one marks the invoice
+paid, and a payment larger than the outstanding amount is refused.
+"""
+import pytest
+from reskontra import get_outstanding, get_open_items, get_settlements
+
+@pytest.fixture
+def invoice(client, database):
+    """Id of a new invoice of 2 x 10.00 € + VAT 24 % = 24.80 €"""
+    response = client.post(f'/db/{database}/invoices/new', data={
+        'kumppani': '1', 'pvm': '2025-04-02', 'otsikko': 'Test invoice',
+        'tuote_0': 'Widget', 'maara_0': '2', 'hinta_0': '10', 'alv_percent_0': '24', 'tili_0': '3000'
+    })
+    assert response.status_code == 302
+    return int(response.headers['Location'].rsplit('/', 1)[1])
+
+def pay(client, database, invoice, amount=None):
+    data = {'payment_date': '2025-04-10', 'payment_account': '1100'}
+    if amount is not None:
+        data['payment_amount'] = amount
+    response = client.post(f'/db/{database}/invoices/{invoice}/mark-paid', data=data)
+    assert response.status_code == 302
+
+def invoice_state(conn, invoice):
+    """(tila, outstanding cents, number of payments)"""
+    status = conn.execute("SELECT tila FROM Tosite WHERE id = ?", (invoice,)).fetchone()[0]
+    return status, get_outstanding(conn, invoice), len(get_settlements(conn, invoice))
+
+def test_partial_then_full_payment(client, database, invoice, open_connection):
+    conn = open_connection()
+    assert get_outstanding(conn, invoice) == 2480
+    assert [item['eraid'] for item in get_open_items(conn, '2025-05-01')] == [invoice]
+
+    pay(client, database, invoice, '10,00')
+    assert invoice_state(conn, invoice) == (3, 1480, 1)  # Partially paid
+
+    # Without an amount the rest is paid
+    pay(client, database, invoice)
+    assert invoice_state(conn, invoice) == (4, 0, 2)  # Paid
+    assert get_open_items(conn, '2025-05-01') == []
+
+def test_overpayment_is_refused(client, database, invoice, open_connection):
+    conn = open_connection()
+    pay(client, database, invoice, '20,00')
+    before = invoice_state(conn, invoice)
+    vouchers = conn.execute("SELECT COUNT(*) FROM Tosite").fetchone()[0]
+
+    pay(client, database, invoice, '4,81')
+    assert invoice_state(conn, invoice) == before == (3, 480, 1)
+    assert conn.execute("SELECT COUNT(*) FROM Tosite").fetchone()[0] == vouchers
+
+    pay(client, database, invoice, '4,80')
+    assert invoice_state(conn, invoice) == (4, 0, 2)
+
+def test_paid_invoice_takes_no_more_payments(client, database, invoice, open_connection):
+    conn = open_connection()
+    pay(client, database, invoice)
+    pay(client, database, invoice, '1,00')
+    assert invoice_state(conn, invoice) == (4, 0, 1)
@@ -0,0 +1,103 @@
+"""
+Query plan regression tests for the covering indexes of migration 7:
+voucher lists, account ledgers, the balance before a ledger page and the
+lines of a voucher must seek their index without a temporary sort.
+"""
+import random
+import sqlite3
+import pytest
+from user_database import AccountingDatabaseCreator
+from tietokanta import fetch_page
+from saldot import get_balance_before
+
+VOUCHERS = 20000
+
+class RecordingConnection:
+    """Connection wrapper keeping the statements run through execute()"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = []
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, params))
+        return self.conn.execute(sql, params)
+
+@pytest.fixture(scope='module')
+def conn(tmp_path_factory):
+    path = AccountingDatabaseCreator().create_database(
+        {'name': 'Plan Test', 'chart_scope': 'basic'}, str(tmp_path_factory.mktemp('databases')))
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+
+    accounts = [row[0] for row in conn.execute("SELECT numero FROM Tili")]
+    rng = random.Random(7)
+    vouchers, lines = [], []
+    for voucher_id in range(1, VOUCHERS + 1):
+        date = f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        cents = rng.randint(100, 100000)
+        vouchers.append((voucher_id, date, rng.randint(1, 10), rng.randint(0, 2), f"Tosite {voucher_id}"))
+        lines.append((voucher_id, 1, date, rng.choice(accounts), cents, 0))
+        lines.append((voucher_id, 2, date, rng.choice(accounts), 0, cents))
+    conn.executemany("INSERT INTO Tosite (id, pvm, tyyppi, tila, otsikko) VALUES (?, ?, ?, ?, ?)", vouchers)
+    conn.executemany("""
+        INSERT INTO Vienti (tosite, rivi, pvm, tili, debetsnt, kreditsnt) VALUES (?, ?, ?, ?, ?, ?)
+    """, lines)
+    conn.commit()
+    conn.execute("ANALYZE")
+    yield conn
+    conn.close()
+
+def query_plan(conn, sql, params):
+    return "\n".join(row['detail'] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+
+def assert_index_seek(conn, statement, index):
+    plan = query_plan(conn, *statement)
+    assert f"INDEX {index}" in plan, plan
+    assert "USE TEMP B-TREE" not in plan, plan
+
+def recorded_page(conn, *args, **kwargs):
+    recording = RecordingConnection(conn)
+    fetch_page(recording, *args, **kwargs)
+    return recording.statements[-1]
+
+@pytest.mark.parametrize('after', [None, ('2024-06-15', 10000)])
+def test_voucher_list(conn, after):
+    statement = recorded_page(conn, "SELECT id, pvm, tyyppi, tila, otsikko FROM Tosite", [], [], after=after)
+    assert_index_seek(conn, statement, 'tosite_pvm_lista')
+
+@pytest.mark.parametrize('after', [None, ('2024-06-15', 10000)])
+def test_voucher_list_by_type(conn, after):
+    statement = recorded_page(conn, "SELECT id, pvm, tyyppi, tila, otsikko FROM Tosite",
+                              ["tyyppi = ?"], [4], after=after)
+    assert_index_seek(conn, statement, 'tosite_tyyppi_lista')
+
+@pytest.mark.parametrize('after', [None, ('2024-06-15', 10000)])
+def test_account_ledger(conn, after):
+    account = conn.execute("SELECT tili FROM Vienti LIMIT 1").fetchone()[0]
+    statement = recorded_page(
+        conn,
+        """
+        SELECT v.id, v.tosite, v.pvm, v.selite, v.debetsnt, v.kreditsnt,
+               t.otsikko as voucher_title, t.tyyppi as voucher_type
+        FROM Vienti v
+        JOIN Tosite t ON v.tosite = t.id
+        """,
+        ["v.tili = ?"], [account], after=after, order=('v.pvm', 'v.id'))
+    assert_index_seek(conn, statement, 'vienti_tili_kirja')
+
+def test_balance_before(conn):
+    account = conn.execute("SELECT tili FROM Vienti LIMIT 1").fetchone()[0]
+    recording = RecordingConnection(conn)
+    get_balance_before(recording, account, '2024-06-15', 10000)
+    ledger_statement = next(s for s in recording.statements if 'FROM Vienti' in s[0])
+    assert_index_seek(conn, ledger_statement, 'vienti_tili_kirja')
+
+def test_voucher_lines(conn):
+    statement = ("""
+        SELECT id, rivi, tili, kohdennus, selite, debetsnt, kreditsnt, alvprosentti, alvkoodi
+        FROM Vienti
+        WHERE tosite = ?
+        ORDER BY rivi
+    """, (VOUCHERS // 2,))
+    assert_index_seek(conn, statement, 'vienti_tosite_rivi')
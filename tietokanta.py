@@ -0,0 +1,321 @@
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+from flask import g
+import migraatiot
+
+# Directory holding the client database files
+DATABASE_DIR = 'databases'
+
+# Pool limits per client database
+MAX_CONNECTIONS = 8    # Connections checked out at the same time
+MAX_IDLE = 2           # Idle connections kept open for reuse
+IDLE_TIMEOUT = 300     # Seconds before an idle connection is closed
+ACQUIRE_TIMEOUT = 30   # Seconds to wait for a free connection
+
+# PRAGMAs applied once when a connection is opened. journal_mode is stored in
+# the database file; the others apply to the connection only.
+CONNECTION_PRAGMAS = {
+    'journal_mode': 'WAL',     # Readers do not block the writer, nor the writer readers
+    'synchronous': 'NORMAL',   # Durable with WAL; fsync at checkpoints instead of every commit
+    'busy_timeout': 5000,      # Milliseconds to wait for a lock before "database is locked"
+    'cache_size': -8000,       # 8MB page cache, kept warm between requests
+    'mmap_size': 268435456,    # Read through up to 256MB of memory-mapped file
+    'temp_store': 'MEMORY',    # Sorts and temporary indexes stay off disk
+}
+
+# Deployment overrides, e.g. KP_SQLITE_PRAGMAS="mmap_size=0;synchronous=FULL"
+PRAGMA_ENVIRONMENT = 'KP_SQLITE_PRAGMAS'
+
+PRAGMA_NAME = re.compile(r'^[a-z_]+$')
+PRAGMA_VALUE = re.compile(r'^-?[A-Za-z0-9_]+$')
+
+# Rows shown per page in paginated lists
+PAGE_SIZE = 50
+
+def load_pragmas(overrides=None, environ=os.environ):
+    """
+    Connection PRAGMAs: the defaults, then the environment overrides, then
+    the given overrides. A value of None drops a PRAGMA.
+    """
+    pragmas = dict(CONNECTION_PRAGMAS)
+
+    for item in environ.get(PRAGMA_ENVIRONMENT, '').split(';'):
+        if item.strip():
+            name, _, value = item.partition('=')
+            pragmas[name.strip().lower()] = value.strip()
+
+    pragmas.update(overrides or {})
+
+    for name, value in list(pragmas.items()):
+        if value is None or value == '':
+            del pragmas[name]
+        elif not PRAGMA_NAME.match(name) or not PRAGMA_VALUE.match(str(value)):
+            raise ValueError(f"Invalid PRAGMA setting: {name}={value}")
+
+    return pragmas
+
+def apply_pragmas(conn, pragmas):
+    """Apply connection PRAGMAs"""
+    for name, value in pragmas.items():
+        try:
+            conn.execute(f"PRAGMA {name} = {value}")
+        except sqlite3.OperationalError:
+            # Changing the journal mode needs a moment without other connections;
+            # it is retried on the next connection
+            if name != 'journal_mode':
+                raise
+
+def connect(path, pragmas=None, **kwargs):
+    """Open a client database with the connection PRAGMAs applied"""
+    conn = sqlite3.connect(path, **kwargs)
+    apply_pragmas(conn, load_pragmas() if pragmas is None else pragmas)
+    return conn
+
+def ensure_schema(conn):
+    """Apply the schema migrations missing from a client database"""
+    migraatiot.migrate(conn)
+
+class ConnectionPool:
+    """
+    Pool of SQLite connections keyed by client database filename.
+    Connections are opened lazily, configured once and reused between requests.
+    """
+
+    def __init__(self, directory=DATABASE_DIR, max_connections=MAX_CONNECTIONS,
+                 max_idle=MAX_IDLE, idle_timeout=IDLE_TIMEOUT):
+        self.directory = directory
+        self.max_connections = max_connections
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.pragmas = load_pragmas()
+        self._lock = threading.Lock()
+        self._idle = {}        # filename -> list of (connection, released_at)
+        self._slots = {}       # filename -> semaphore limiting checked out connections
+        self._updated = set()  # filenames whose schema has been migrated by this process
+
+    def _open(self, filename):
+        """Open and configure a new connection"""
+        conn = connect(os.path.join(self.directory, filename), self.pragmas, check_same_thread=False)
+        conn.row_factory = sqlite3.Row  # Allows accessing columns by name
+
+        if filename not in self._updated:
+            ensure_schema(conn)
+            self._updated.add(filename)
+
+        return conn
+
+    def _slot(self, filename):
+        with self._lock:
+            slot = self._slots.get(filename)
+            if slot is None:
+                slot = self._slots[filename] = threading.BoundedSemaphore(self.max_connections)
+            return slot
+
+    def acquire(self, filename, timeout=ACQUIRE_TIMEOUT):
+        """Get a connection to the given client database"""
+        if not self._slot(filename).acquire(timeout=timeout):
+            raise sqlite3.OperationalError(f"No free connection to {filename}")
+
+        self.evict_idle()
+
+        with self._lock:
+            idle = self._idle.get(filename)
+            if idle:
+                conn, _ = idle.pop()
+                return conn
+
+        try:
+            return self._open(filename)
+        except Exception:
+            self._slot(filename).release()
+            raise
+
+    def release(self, filename, conn):
+        """Return a connection to the pool"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+
+            with self._lock:
+                idle = self._idle.setdefault(filename, [])
+                if len(idle) < self.max_idle:
+                    idle.append((conn, time.monotonic()))
+                    conn = None
+
+            if conn is not None:
+                conn.close()
+        finally:
+            self._slot(filename).release()
+
+    def evict_idle(self):
+        """Close connections that have been idle longer than the timeout"""
+        expired = []
+        limit = time.monotonic() - self.idle_timeout
+
+        with self._lock:
+            for filename in list(self._idle):
+                idle = self._idle[filename]
+                expired.extend(conn for conn, released_at in idle if released_at < limit)
+                idle[:] = [(conn, released_at) for conn, released_at in idle if released_at >= limit]
+                if not idle:
+                    del self._idle[filename]
+
+        for conn in expired:
+            conn.close()
+
+    def configure(self, overrides=None):
+        """Set the PRAGMA overrides for connections opened from now on"""
+        self.pragmas = load_pragmas(overrides)
+        self.close_all()
+
+    def close_all(self, filename=None):
+        """Close idle connections for one database, or for all of them"""
+        with self._lock:
+            if filename is None:
+                idle = [item for items in self._idle.values() for item in items]
+                self._idle.clear()
+            else:
+                idle = self._idle.pop(filename, [])
+
+        for conn, _ in idle:
+            conn.close()
+
+pool = ConnectionPool()
+
+def get_db(filename):
+    """Get the pooled connection to a client database for the current request"""
+    if '_client_connections' not in g:
+        g._client_connections = {}
+
+    conn = g._client_connections.get(filename)
+    if conn is None:
+        conn = g._client_connections[filename] = pool.acquire(filename)
+    return conn
+
+def parse_page_key(value):
+    """Parse a 'pvm,id' page key from the query string"""
+    if not value or ',' not in value:
+        return None
+    date, row_id = value.rsplit(',', 1)
+    try:
+        return (date, int(row_id))
+    except ValueError:
+        return None
+
+def fetch_page(conn, query, conditions, params, after=None, before=None,
+               order=('pvm', 'id'), page_size=PAGE_SIZE):
+    """
+    Fetch one page of rows ordered newest first by the (date, id) key.
+    Pages are found by seeking past the key of the previous page, so every
+    page costs the same however deep into the list it is.
+
+    Returns:
+        tuple: (rows, next_key, prev_key)
+    """
+    date_column, id_column = order
+    conditions = list(conditions)
+    params = list(params)
+    backwards = before is not None and after is None
+
+    if after:
+        conditions.append(f"({date_column}, {id_column}) < (?, ?)")
+        params.extend(after)
+    elif before:
+        conditions.append(f"({date_column}, {id_column}) > (?, ?)")
+        params.extend(before)
+
+    sql = query
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    direction = "ASC" if backwards else "DESC"
+    sql += f" ORDER BY {date_column} {direction}, {id_column} {direction} LIMIT ?"
+    params.append(page_size + 1)
+
+    rows = conn.execute(sql, params).fetchall()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+
+    def key(row):
+        return f"{row[date_column.split('.')[-1]]},{row[id_column.split('.')[-1]]}"
+
+    next_key = prev_key = None
+    if rows:
+        if has_more or backwards:
+            next_key = key(rows[-1])
+        if (has_more and backwards) or (after and not backwards):
+            prev_key = key(rows[0])
+
+    return rows, next_key, prev_key
+
+def release_connections(exception=None):
+    """Return the connections used by the current request to the pool"""
+    connections = g.pop('_client_connections', {})
+    for filename, conn in connections.items():
+        pool.release(filename, conn)
+
+def checkpoint(filename):
+    """Copy the write-ahead log into the database file, so the file alone is complete"""
+    conn = pool.acquire(filename)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        pool.release(filename, conn)
+
+def init_app(app):
+    """
+    Release pooled connections at the end of every request, and take PRAGMA
+    overrides from the SQLITE_PRAGMAS setting of the app config
+    """
+    if app.config.get('SQLITE_PRAGMAS'):
+        pool.configure(app.config['SQLITE_PRAGMAS'])
+    app.teardown_appcontext(release_connections)
+
+def convert_journal_mode(path, mode='WAL'):
+    """
+    Switch an existing database file to the given journal mode.
+
+    Returns:
+        str: The journal mode in effect afterwards
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        return conn.execute(f"PRAGMA journal_mode = {mode}").fetchone()[0]
+    finally:
+        conn.close()
+
+def main(argv=None):
+    """Convert client databases to the configured journal mode"""
+    parser = argparse.ArgumentParser(description="Convert client databases to WAL (or another journal mode)")
+    parser.add_argument('databases', nargs='*', help="Database filenames (default: all in the database directory)")
+    parser.add_argument('--mode', default=None, help="Journal mode (default: the configured one)")
+    parser.add_argument('--directory', default=DATABASE_DIR)
+    args = parser.parse_intermixed_args(argv)
+
+    mode = args.mode or load_pragmas().get('journal_mode', 'WAL')
+    if not PRAGMA_VALUE.match(mode):
+        parser.error(f"invalid journal mode: {mode}")
+
+    filenames = args.databases or sorted(name for name in os.listdir(args.directory) if name.endswith('.db'))
+    failed = False
+
+    for filename in filenames:
+        try:
+            result = convert_journal_mode(os.path.join(args.directory, filename), mode)
+            if result.lower() != mode.lower():
+                failed = True
+            print(f"{filename}: {result}")
+        except sqlite3.Error as e:
+            failed = True
+            print(f"{filename}: error: {e}")
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
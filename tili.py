@@ -1,68 +1,68 @@
 import os
+import io
+import csv
 import json
 import sqlite3
 import datetime
 from pathlib import Path
-from flask import Flask, Blueprint, render_template, request, redirect, url_for, flash, abort, g, jsonify
+from flask import Flask, Blueprint, render_template, request, redirect, url_for, flash, abort, g, jsonify, Response, stream_with_context
+from tietokanta import get_db, fetch_page, parse_page_key
+from saldot import (get_account_balances, get_balance_before, get_fiscal_periods, get_period_balances,
+                    get_trial_balance, close_fiscal_period, get_monthly_totals)
+from viitetiedot import get_reference_data
+import sarakkeet
 
 # Create a Blueprint for account routes
 tili_bp = Blueprint('tili', __name__, template_folder='templates')
 
-def get_db_connection(db_path):
-    """Create a connection to the specified database file"""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row  # Allows accessing columns by name
-    return conn
+# Rows written per chunk when streaming CSV exports
+CSV_CHUNK_ROWS = 1000
+
+# Cash and bank accounts, the default range of the cash flow report
+CASH_ACCOUNTS = (1900, 1999)
+
+# Liability, equity and income accounts, whose balances are normally credits
+CREDIT_NORMAL_TYPES = ('B', 'C', 'D')
 
 @tili_bp.route('/db/<filename>/balances')
 def list_balances(filename):
-    """List all account balances in a database"""
+    """List account balances in a database, for a fiscal period or date range if given"""
     db_path = os.path.join('databases', filename)
     
     if not os.path.exists(db_path):
         flash("Database file not found", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
-    # Get all accounts
-    cursor.execute("""
-        SELECT numero, tyyppi, json FROM Tili
-        ORDER BY numero
-    """)
-    
+    # Get all accounts from the shared reference data
     accounts = []
-    for row in cursor.fetchall():
-        json_data = json.loads(row['json']) if row['json'] else {}
+    for row in get_reference_data(conn, filename).accounts:
         account = {
             'numero': row['numero'],
-            'nimi': json_data.get('nimi', f"Account {row['numero']}"),
+            'nimi': row['nimi'] or f"Account {row['numero']}",
             'tyyppi': row['tyyppi'],
             'tyyppi_nimi': get_account_type_name(row['tyyppi']),
             'balance': 0  # Will be calculated below
         }
         accounts.append(account)
     
-    # Calculate balance for each account
-    cursor.execute("""
-        SELECT tili, SUM(debetsnt) as total_debit, SUM(kreditsnt) as total_credit 
-        FROM Vienti 
-        GROUP BY tili
-    """)
-    
-    balances = {}
-    for row in cursor.fetchall():
-        account_number = row['tili']
-        debit = row['total_debit'] or 0
-        credit = row['total_credit'] or 0
-        balance_cents = debit - credit
-        balances[account_number] = balance_cents
+    periods = get_fiscal_periods(conn)
+    start, end, selected_period = get_report_period(periods)
+    
+    if start or end:
+        # Balance sheet as of the end date, income statement for the period
+        balances = get_period_balances(conn, accounts, start, end)
+    else:
+        # Balance for each account from the maintained monthly balances
+        balances = get_account_balances(conn)
     
     # Update account balances and filter out zero balances
     non_zero_accounts = []
     for account in accounts:
         balance_cents = balances.get(account['numero'], 0)
+        account['balance_cents'] = balance_cents
         account['balance'] = balance_cents / 100  # Convert cents to euros
         account['balance_formatted'] = f"{abs(account['balance']):.2f}"
         
@@ -80,8 +80,6 @@ def list_balances(filename):
     except:
         pass
     
-    conn.close()
-    
     # Calculate summary totals by account type
     account_type_totals = calculate_totals_by_type(non_zero_accounts)
     
@@ -93,7 +91,52 @@ def list_balances(filename):
                            filename=filename, 
                            client_name=client_name,
                            account_type_totals=account_type_totals['formatted'],
-                           summary_totals=summary_totals['formatted'])
+                           summary_totals=summary_totals['formatted'],
+                           periods=periods,
+                           selected_period=selected_period,
+                           start=start,
+                           end=end)
+
+@tili_bp.route('/db/<filename>/trial-balance')
+def trial_balance(filename):
+    """Trial balance for a fiscal period or date range, as JSON"""
+    db_path = os.path.join('databases', filename)
+    
+    if not os.path.exists(db_path):
+        return jsonify({"error": "Database file not found"}), 404
+    
+    conn = get_db(filename)
+    accounts = get_reference_data(conn, filename).accounts
+    start, end, _ = get_report_period(get_fiscal_periods(conn))
+    
+    rows = get_trial_balance(conn, accounts, start, end)
+    totals = {
+        'debet': sum(row['debet'] for row in rows),
+        'kredit': sum(row['kredit'] for row in rows),
+        'tulos': -sum(row['loppusaldo'] for row in rows if row['tyyppi'] in ('D', 'E'))
+    }
+    
+    return jsonify({"alkaen": start, "asti": end, "tilit": rows, "yhteensa": totals})
+
+@tili_bp.route('/db/<filename>/fiscal-periods/<start>/close', methods=['POST'])
+def close_period(filename, start):
+    """Close a fiscal period, freezing its balances"""
+    db_path = os.path.join('databases', filename)
+    
+    if not os.path.exists(db_path):
+        flash("Database file not found", "error")
+        return redirect(url_for('index'))
+    
+    conn = get_db(filename)
+    try:
+        close_fiscal_period(conn, start)
+        flash("Tilikausi päätetty", "success")
+    except ValueError as e:
+        flash(str(e), "error")
+    except sqlite3.Error as e:
+        flash(f"Error closing fiscal period: {str(e)}", "error")
+    
+    return redirect(url_for('tili.list_balances', filename=filename, tilikausi=start))
 
 @tili_bp.route('/db/<filename>/account/<int:account_number>/transactions')
 def account_transactions(filename, account_number):
@@ -104,7 +147,7 @@ def account_transactions(filename, account_number):
         flash("Database file not found", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
     # Get account details
@@ -115,7 +158,6 @@ def account_transactions(filename, account_number):
     
     account_row = cursor.fetchone()
     if not account_row:
-        conn.close()
         flash("Account not found", "error")
         return redirect(url_for('tili.list_balances', filename=filename))
     
@@ -128,20 +170,51 @@ def account_transactions(filename, account_number):
         'tyyppi_nimi': get_account_type_name(account_row['tyyppi'])
     }
     
-    # Get all transactions for this account
-    cursor.execute("""
-        SELECT v.id, v.tosite, v.pvm, v.selite, v.debetsnt, v.kreditsnt, 
-               t.otsikko as voucher_title, t.tyyppi as voucher_type
-        FROM Vienti v
-        JOIN Tosite t ON v.tosite = t.id
-        WHERE v.tili = ?
-        ORDER BY v.pvm DESC, v.tosite DESC
-    """, (account_number,))
+    # One read transaction, so the page and the ledger extract agree
+    conn.execute("BEGIN")
+    try:
+        # Get one page of transactions for this account, newest first
+        rows, next_key, prev_key = fetch_page(
+            conn,
+            """
+            SELECT v.id, v.tosite, v.pvm, v.selite, v.debetsnt, v.kreditsnt, 
+                   t.otsikko as voucher_title, t.tyyppi as voucher_type
+            FROM Vienti v
+            JOIN Tosite t ON v.tosite = t.id
+            """,
+            ["v.tili = ?"], [account_number],
+            after=parse_page_key(request.args.get('after')),
+            before=parse_page_key(request.args.get('before')),
+            order=('v.pvm', 'v.id')
+        )
+        
+        # Running balances in cents of the lines on the page, from the
+        # cumulative sums of the columnar extract
+        balances = None
+        if rows and sarakkeet.available():
+            balances = sarakkeet.get_extract(conn, filename).balances_after(
+                account_number, [row['id'] for row in rows])
+        
+        # Without it, start from the balance before the oldest row on the
+        # page and walk forward once
+        balance = 0
+        if rows and balances is None:
+            oldest = rows[-1]
+            balance = get_balance_before(conn, account_number, oldest['pvm'], oldest['id'])
+    finally:
+        conn.rollback()
+    
+    # Assets and Expenses are increased by debits, the other types by credits
+    sign = 1 if account['tyyppi'] in ['A', 'E'] else -1
     
     transactions = []
-    for row in cursor.fetchall():
-        debit_amount = row['debetsnt'] / 100 if row['debetsnt'] else 0
-        credit_amount = row['kreditsnt'] / 100 if row['kreditsnt'] else 0
+    for row in reversed(rows):
+        debit_cents = row['debetsnt'] or 0
+        credit_cents = row['kreditsnt'] or 0
+        if balances is not None:
+            balance = balances[row['id']]
+        else:
+            balance += debit_cents - credit_cents
         
         transactions.append({
             'id': row['id'],
@@ -150,31 +223,16 @@ def account_transactions(filename, account_number):
             'voucher_type': row['voucher_type'],
             'date': row['pvm'],
             'description': row['selite'],
-            'debit': debit_amount,
-            'credit': credit_amount,
-            'debit_formatted': f"{debit_amount:.2f}" if debit_amount > 0 else "-",
-            'credit_formatted': f"{credit_amount:.2f}" if credit_amount > 0 else "-"
+            'debit': debit_cents,
+            'credit': credit_cents,
+            'debit_formatted': format_cents(debit_cents) if debit_cents > 0 else "-",
+            'credit_formatted': format_cents(credit_cents) if credit_cents > 0 else "-",
+            'balance': sign * balance,
+            'balance_formatted': format_cents(balance),
+            'is_debit': balance > 0
         })
     
-    # Calculate running balance
-    running_balances = []
-    balance = 0
-    
-    # Account type determines whether debits increase or decrease the balance
-    if account['tyyppi'] in ['A', 'E']:  # Assets and Expenses are increased by debits
-        for t in reversed(transactions):
-            balance += t['debit'] - t['credit']
-            running_balances.insert(0, balance)
-    else:  # Liabilities, Equity, and Income are increased by credits
-        for t in reversed(transactions):
-            balance += t['credit'] - t['debit']
-            running_balances.insert(0, balance)
-    
-    # Add running balance to transactions
-    for i, t in enumerate(transactions):
-        t['balance'] = running_balances[i]
-        t['balance_formatted'] = f"{abs(t['balance']):.2f}"
-        t['is_debit'] = t['balance'] > 0 if account['tyyppi'] in ['A', 'E'] else t['balance'] < 0
+    transactions.reverse()
     
     # Get client name
     client_name = ""
@@ -186,13 +244,177 @@ def account_transactions(filename, account_number):
     except:
         pass
     
-    conn.close()
-    
     return render_template('accounts/account_transactions.html', 
                            account=account,
                            transactions=transactions,
                            filename=filename,
-                           client_name=client_name)
+                           client_name=client_name,
+                           next_key=next_key,
+                           prev_key=prev_key)
+
+@tili_bp.route('/db/<filename>/account/<int:account_number>/monthly')
+def account_monthly(filename, account_number):
+    """Monthly totals of an account and the change from the previous month, as JSON"""
+    db_path = os.path.join('databases', filename)
+    
+    if not os.path.exists(db_path):
+        return jsonify({"error": "Database file not found"}), 404
+    
+    conn = get_db(filename)
+    allocation = request.args.get('kohdennus', type=int)
+    
+    # Months 'YYYY-MM' from the maintained per-allocation monthly totals
+    months = {}
+    for tili, kohdennus, kausi, debit, credit, count in get_monthly_totals(
+            conn, request.args.get('alkaen'), request.args.get('asti'), account_number):
+        if allocation is not None and kohdennus != allocation:
+            continue
+        month = months.setdefault(kausi, {'kausi': kausi, 'debet': 0, 'kredit': 0, 'rivit': 0})
+        month['debet'] += debit
+        month['kredit'] += credit
+        month['rivit'] += count
+    
+    rows = [months[kausi] for kausi in sorted(months)]
+    previous = None
+    for row in rows:
+        row['saldo'] = row['debet'] - row['kredit']
+        row['muutos'] = row['saldo'] - previous['saldo'] if previous else None
+        previous = row
+    
+    return jsonify({"tili": account_number, "kohdennus": allocation, "kuukaudet": rows})
+
+@tili_bp.route('/db/<filename>/cash-flow')
+def cash_flow(filename):
+    """Money in and out of an account range (?tilit=1900-1999) per month, as JSON"""
+    db_path = os.path.join('databases', filename)
+    
+    if not os.path.exists(db_path):
+        return jsonify({"error": "Database file not found"}), 404
+    
+    try:
+        low, high = (int(part) for part in request.args.get('tilit', '%d-%d' % CASH_ACCOUNTS).split('-'))
+    except ValueError:
+        return jsonify({"error": "Account range must be given as low-high"}), 400
+    start = parse_iso_date(request.args.get('alkaen'))
+    end = parse_iso_date(request.args.get('asti'))
+    
+    conn = get_db(filename)
+    if sarakkeet.available():
+        # Columnar extract of the ledger, reused until the database changes
+        months = sarakkeet.get_extract(conn, filename).cash_flow(low, high, start, end)
+    else:
+        conditions = ["tili BETWEEN ? AND ?"]
+        params = [low, high]
+        if start:
+            conditions.append("pvm >= ?")
+            params.append(start)
+        if end:
+            conditions.append("pvm <= ?")
+            params.append(end)
+        months = [{'kausi': kausi, 'sisaan': debit, 'ulos': credit, 'netto': debit - credit}
+                  for kausi, debit, credit in conn.execute(f"""
+                      SELECT COALESCE(substr(pvm, 1, 7), ''), COALESCE(SUM(debetsnt), 0), COALESCE(SUM(kreditsnt), 0)
+                      FROM Vienti WHERE {" AND ".join(conditions)}
+                      GROUP BY 1 ORDER BY 1
+                  """, params)]
+    
+    return jsonify({"tilit": [low, high], "alkaen": start, "asti": end, "kuukaudet": months,
+                    "netto": sum(month['netto'] for month in months)})
+
+@tili_bp.route('/db/<filename>/account/<int:account_number>/transactions.csv')
+def export_account_transactions(filename, account_number):
+    """Stream the full transaction history of an account as CSV"""
+    db_path = os.path.join('databases', filename)
+    
+    if not os.path.exists(db_path):
+        flash("Database file not found", "error")
+        return redirect(url_for('index'))
+    
+    conn = get_db(filename)
+    
+    account_row = conn.execute("SELECT tyyppi FROM Tili WHERE numero = ?", (account_number,)).fetchone()
+    if not account_row:
+        flash("Account not found", "error")
+        return redirect(url_for('tili.list_balances', filename=filename))
+    
+    sign = 1 if account_row['tyyppi'] in ['A', 'E'] else -1
+    
+    def generate():
+        # Own read-only connection: the pooled one is returned when the request
+        # ends, before the response has been streamed
+        path = os.path.abspath(db_path)
+        stream_conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        stream_conn.row_factory = sqlite3.Row
+        try:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(['pvm', 'tosite', 'otsikko', 'selite', 'debet', 'kredit', 'saldo'])
+            
+            # Oldest first, so the running balance is a single forward pass
+            cursor = stream_conn.execute("""
+                SELECT v.id, v.tosite, v.pvm, v.selite, v.debetsnt, v.kreditsnt, t.otsikko
+                FROM Vienti v
+                JOIN Tosite t ON v.tosite = t.id
+                WHERE v.tili = ?
+                ORDER BY v.pvm, v.id
+            """, (account_number,))
+            
+            balance = 0
+            while True:
+                rows = cursor.fetchmany(CSV_CHUNK_ROWS)
+                if not rows:
+                    break
+                
+                for row in rows:
+                    debit_cents = row['debetsnt'] or 0
+                    credit_cents = row['kreditsnt'] or 0
+                    balance += sign * (debit_cents - credit_cents)
+                    writer.writerow([
+                        row['pvm'], row['tosite'], row['otsikko'], row['selite'],
+                        format_cents(debit_cents), format_cents(credit_cents),
+                        ('-' if balance < 0 else '') + format_cents(balance)
+                    ])
+                
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            
+            yield buffer.getvalue()
+        finally:
+            stream_conn.close()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={"Content-Disposition": f"attachment; filename=tili_{account_number}.csv"}
+    )
+
+def format_cents(cents):
+    """Format an amount in cents as unsigned euros, e.g. 123456 -> '1234.56'"""
+    cents = abs(cents)
+    return f"{cents // 100}.{cents % 100:02d}"
+
+def parse_iso_date(value):
+    """Parse an ISO date from the query string, returning it as a string or None"""
+    try:
+        return datetime.date.fromisoformat(value.strip()).isoformat() if value and value.strip() else None
+    except ValueError:
+        return None
+
+def get_report_period(periods):
+    """
+    Read the report period from the query string: a fiscal period by its
+    start date (tilikausi), or a date range (alkaen, asti).
+
+    Returns:
+        tuple: (start, end, selected fiscal period or None)
+    """
+    period_start = request.args.get('tilikausi', '')
+    if period_start:
+        for period in periods:
+            if period['alkaa'] == period_start:
+                return period['alkaa'], period['loppuu'], period
+    return parse_iso_date(request.args.get('alkaen')), parse_iso_date(request.args.get('asti')), None
 
 def get_account_type_name(type_code):
     """Return human-readable name for account type code"""
@@ -206,7 +428,7 @@ def get_account_type_name(type_code):
     return account_types.get(type_code, 'Other')
 
 def calculate_totals_by_type(accounts):
-    """Calculate total balances by account type"""
+    """Calculate total balances (in cents) by account type"""
     totals = {
         'Asset': 0,
         'Liability': 0,
@@ -216,35 +438,29 @@ def calculate_totals_by_type(accounts):
         'Other': 0
     }
     
-    for account in accounts:
-        account_type = account['tyyppi_nimi']
-        # Handle different account types with their natural balances
-        # Assets and Expenses normally have debit balances (positive)
-        # Liabilities, Equity, and Income normally have credit balances (negative)
-        if account_type in ['Asset', 'Expense']:
-            totals[account_type] += account['balance']
-        elif account_type in ['Liability', 'Equity', 'Income']:
-            totals[account_type] += abs(account['balance'])  # Use absolute value for credit-normal accounts
-        else:
-            totals[account_type] += account['balance']
-    
-    # Create formatted version of the totals for display
-    formatted_totals = {}
-    for key, value in totals.items():
-        if value == 0:
-            # Show a small indicator value instead of 0.00 for empty accounts
-            formatted_totals[key] = "0.00"
-        else:
-            formatted_totals[key] = f"{abs(value):.2f}"
+    # Assets and Expenses normally have debit balances (positive); Liabilities,
+    # Equity and Income credit balances (negative), totalled as absolute values
+    balances = {account['numero']: account['balance_cents'] for account in accounts}
+    account_types = {account['numero']: account['tyyppi'] for account in accounts}
+    if sarakkeet.available():
+        code_totals = sarakkeet.type_totals(balances, account_types, absolute=CREDIT_NORMAL_TYPES)
+    else:
+        code_totals = {}
+        for number, balance in balances.items():
+            code = account_types[number] or ''
+            code_totals[code] = code_totals.get(code, 0) + (abs(balance) if code in CREDIT_NORMAL_TYPES else balance)
+    
+    for code, total in code_totals.items():
+        totals[get_account_type_name(code)] += total
     
     # Return both raw values and formatted values
     return {
         'raw': totals,
-        'formatted': formatted_totals
+        'formatted': {key: format_cents(value) for key, value in totals.items()}
     }
 
 def calculate_summary_totals(type_totals):
-    """Calculate summary totals for balance sheet and income statement"""
+    """Calculate summary totals (in cents) for balance sheet and income statement"""
     raw = type_totals['raw']
     
     summary = {
@@ -257,17 +473,9 @@ def calculate_summary_totals(type_totals):
         'net_income': raw['Income'] - raw['Expense']
     }
     
-    # Format for display
-    formatted = {}
-    for key, value in summary.items():
-        if value == 0:
-            formatted[key] = "0.00"
-        else:
-            formatted[key] = f"{abs(value):.2f}"
-    
     return {
         'raw': summary,
-        'formatted': formatted
+        'formatted': {key: format_cents(value) for key, value in summary.items()}
     }
 
 def register_blueprint(app):
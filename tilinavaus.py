@@ -4,16 +4,12 @@ import sqlite3
 import datetime
 from pathlib import Path
 from flask import Flask, Blueprint, render_template, request, redirect, url_for, flash, abort, g, jsonify
+from tietokanta import get_db
+from viitetiedot import get_reference_data
 
 # Create a Blueprint for opening balance routes
 tilinavaus_bp = Blueprint('tilinavaus', __name__, template_folder='templates')
 
-def get_db_connection(db_path):
-    """Create a connection to the specified database file"""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row  # Allows accessing columns by name
-    return conn
-
 @tilinavaus_bp.route('/db/<filename>/opening_balances', methods=['GET', 'POST'])
 def manage_opening_balances(filename):
     """View and manage opening balances for accounts"""
@@ -23,7 +19,7 @@ def manage_opening_balances(filename):
         flash("Database file not found", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
     # Check if there's an existing opening balance voucher
@@ -76,21 +72,17 @@ def manage_opening_balances(filename):
         if abs(debit_total - credit_total) > 0.01:
             flash(f"Error: Debits ({debit_total:.2f}) must equal credits ({credit_total:.2f})", "error")
         else:
-            # If an opening balance already exists, delete it first
-            if opening_balance_exists and opening_balance_id:
-                try:
-                    cursor.execute("DELETE FROM Tosite WHERE id = ?", (opening_balance_id,))
-                    # Transactions are automatically deleted due to CASCADE constraint
-                except Exception as e:
-                    conn.rollback()
-                    flash(f"Error deleting existing opening balances: {str(e)}", "error")
-                    return redirect(url_for('tilinavaus.manage_opening_balances', filename=filename))
-            
-            # Create a new opening balance voucher
+            # Replace the opening balance voucher in a single transaction
             try:
                 # Begin transaction
                 conn.execute('BEGIN')
                 
+                # If an opening balance already exists, delete it first, transactions included
+                # (ON DELETE CASCADE is not enforced, and the Saldo triggers need the row deletes)
+                if opening_balance_exists and opening_balance_id:
+                    cursor.execute("DELETE FROM Vienti WHERE tosite = ?", (opening_balance_id,))
+                    cursor.execute("DELETE FROM Tosite WHERE id = ?", (opening_balance_id,))
+                
                 # Insert voucher
                 cursor.execute("""
                     INSERT INTO Tosite (pvm, tyyppi, tila, otsikko)
@@ -131,18 +123,12 @@ def manage_opening_balances(filename):
                 flash(f"Error saving opening balances: {str(e)}", "error")
     
     # GET request - display form with accounts and existing balances
-    # Get all accounts
-    cursor.execute("""
-        SELECT numero, tyyppi, json FROM Tili
-        ORDER BY numero
-    """)
-    
+    # Get all accounts from the shared reference data
     accounts = []
-    for row in cursor.fetchall():
-        json_data = json.loads(row['json']) if row['json'] else {}
+    for row in get_reference_data(conn, filename).accounts:
         account = {
             'numero': row['numero'],
-            'nimi': json_data.get('nimi', f"Account {row['numero']}"),
+            'nimi': row['nimi'] or f"Account {row['numero']}",
             'tyyppi': row['tyyppi'],
             'tyyppi_nimi': get_account_type_name(row['tyyppi']),
             'debit': 0,
@@ -197,8 +183,6 @@ def manage_opening_balances(filename):
     except:
         pass
     
-    conn.close()
-    
     # Get today's date for the form
     today = datetime.date.today().isoformat()
     
@@ -206,13 +190,10 @@ def manage_opening_balances(filename):
     opening_balance_date = today
     if opening_balance_exists and opening_balance_id:
         try:
-            conn = get_db_connection(db_path)
-            cursor = conn.cursor()
             cursor.execute("SELECT pvm FROM Tosite WHERE id = ?", (opening_balance_id,))
             result = cursor.fetchone()
             if result and result['pvm']:
                 opening_balance_date = result['pvm']
-            conn.close()
         except:
             pass
     
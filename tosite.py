@@ -6,6 +6,13 @@ import hashlib
 from pathlib import Path
 from flask import Flask, Blueprint, render_template, request, redirect, url_for, flash, abort, g, jsonify, send_file, Response
 from werkzeug.utils import secure_filename
+from tietokanta import get_db, fetch_page, parse_page_key
+import asiakasluettelo
+import liitteet
+from viitetiedot import get_reference_data
+from haku import build_match_query, voucher_match_condition
+from viennit import build_voucher_lines, insert_lines
+from tuonti import import_vouchers, detect_format, open_text, IMPORT_FORMATS, IMPORT_CHUNK_SIZE
 
 # Create a Blueprint for voucher routes
 tosite_bp = Blueprint('tosite', __name__, template_folder='templates')
@@ -53,136 +60,78 @@ VOUCHER_STATUSES = {
 ALLOWED_EXTENSIONS = {'pdf', 'jpg', 'jpeg', 'png', 'csv', 'txt', 'xls', 'xlsx', 'doc', 'docx'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 
-def get_db_connection(db_path):
-    """Create a connection to the specified database file"""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row  # Allows accessing columns by name
-    return conn
-
 def get_client_databases():
     """Get list of all client databases"""
-    databases = []
-    db_dir = Path("databases")
-    
-    if db_dir.exists():
-        for file in db_dir.glob("*.db"):
-            # Get creation time
-            created = datetime.datetime.fromtimestamp(file.stat().st_ctime)
-            # Get client name from filename
-            name = file.stem.split('_')[0].replace('_', ' ').title()
-            
-            # Try to get actual name from database
-            try:
-                conn = get_db_connection(file)
-                cursor = conn.cursor()
-                cursor.execute("SELECT arvo FROM Asetus WHERE avain='Nimi'")
-                result = cursor.fetchone()
-                if result:
-                    name = result[0]
-                conn.close()
-            except:
-                pass
-                
-            databases.append({
-                'filename': file.name,
-                'name': name,
-                'created': created.strftime('%Y-%m-%d %H:%M'),
-                'size': f"{file.stat().st_size / 1024:.1f} KB"
-            })
-    
-    return databases
+    return asiakasluettelo.catalog.list_clients()
 
-def get_accounts(db_path):
+def get_accounts(filename):
     """Get all accounts from database"""
-    conn = get_db_connection(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT numero, json FROM Tili
-        ORDER BY numero
-    """)
-    
-    accounts = []
-    for row in cursor.fetchall():
-        json_data = json.loads(row['json']) if row['json'] else {}
-        accounts.append({
-            'numero': row['numero'],
-            'nimi': json_data.get('nimi', f"Account {row['numero']}")
-        })
-    
-    conn.close()
-    return accounts
+    reference = get_reference_data(get_db(filename), filename)
+    return [{'numero': account['numero'], 'nimi': account['nimi'] or f"Account {account['numero']}"}
+            for account in reference.accounts]
 
-def get_partners(db_path):
-    """Get all partners from database"""
-    conn = get_db_connection(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, nimi FROM Kumppani
-        ORDER BY nimi
-    """)
-    
-    partners = []
-    for row in cursor.fetchall():
-        partners.append({
-            'id': row['id'],
-            'nimi': row['nimi']
-        })
-    
-    conn.close()
-    return partners
-
-def get_allocations(db_path):
+def get_allocations(filename):
     """Get all allocations from database"""
-    conn = get_db_connection(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, json FROM Kohdennus
-        ORDER BY id
-    """)
-    
-    allocations = []
-    for row in cursor.fetchall():
-        json_data = json.loads(row['json']) if row['json'] else {}
-        name = json_data.get('nimi', {}).get('fi', f"Allocation {row['id']}")
-        allocations.append({
-            'id': row['id'],
-            'nimi': name
-        })
-    
-    conn.close()
-    return allocations
+    reference = get_reference_data(get_db(filename), filename)
+    return [{'id': allocation['id'], 'nimi': allocation['nimi'] or f"Allocation {allocation['id']}"}
+            for allocation in reference.allocations]
 
 def allowed_file(filename):
     """Check if a file has an allowed extension"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def generate_file_hash(file_data):
-    """Generate SHA-256 hash for a file"""
-    return hashlib.sha256(file_data).hexdigest()
-
 @tosite_bp.route('/db/<filename>/vouchers')
 def list_vouchers(filename):
-    """List all vouchers in a database"""
+    """List vouchers in a database, one page at a time"""
     db_path = os.path.join('databases', filename)
     
     if not os.path.exists(db_path):
         flash("Database file not found", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
-    # Get all vouchers
-    cursor.execute("""
-        SELECT id, pvm, tyyppi, tila, otsikko FROM Tosite
-        ORDER BY pvm DESC, id DESC
-    """)
+    # Read filters from the query string
+    filters = {
+        'alkaen': request.args.get('alkaen', '').strip(),
+        'asti': request.args.get('asti', '').strip(),
+        'tyyppi': request.args.get('tyyppi', type=int),
+        'tila': request.args.get('tila', type=int),
+        'haku': request.args.get('haku', '').strip()
+    }
+    
+    conditions = []
+    params = []
+    if filters['tyyppi'] is not None:
+        conditions.append("tyyppi = ?")
+        params.append(filters['tyyppi'])
+    if filters['alkaen']:
+        conditions.append("pvm >= ?")
+        params.append(filters['alkaen'])
+    if filters['asti']:
+        conditions.append("pvm <= ?")
+        params.append(filters['asti'])
+    if filters['tila'] is not None:
+        conditions.append("tila = ?")
+        params.append(filters['tila'])
+    match_query = build_match_query(filters['haku'])
+    if match_query:
+        # Titles, partner names and line descriptions through the full-text index
+        conditions.append(voucher_match_condition())
+        params.extend([match_query, match_query])
+    
+    # Get one page of vouchers
+    rows, next_key, prev_key = fetch_page(
+        conn,
+        "SELECT id, pvm, tyyppi, tila, otsikko FROM Tosite",
+        conditions, params,
+        after=parse_page_key(request.args.get('after')),
+        before=parse_page_key(request.args.get('before'))
+    )
     
     vouchers = []
-    for row in cursor.fetchall():
+    for row in rows:
         voucher_type = VOUCHER_TYPES.get(row['tyyppi'], "Muu")
         status = VOUCHER_STATUSES.get(row['tila'], "Tuntematon")
         
@@ -194,25 +143,29 @@ def list_vouchers(filename):
             'otsikko': row['otsikko'] or "Untitled"
         })
     
-    conn.close()
-    
     # Get client name
     client_name = ""
     try:
-        conn = get_db_connection(db_path)
-        cursor = conn.cursor()
         cursor.execute("SELECT arvo FROM Asetus WHERE avain='Nimi'")
         result = cursor.fetchone()
         if result:
             client_name = result[0]
-        conn.close()
     except:
         pass
     
+    # Keep the active filters in the paging links
+    filter_args = {key: value for key, value in filters.items() if value not in ('', None)}
+    
     return render_template('vouchers/list.html', 
                           vouchers=vouchers, 
                           filename=filename, 
-                          client_name=client_name)
+                          client_name=client_name,
+                          filters=filters,
+                          filter_args=filter_args,
+                          next_key=next_key,
+                          prev_key=prev_key,
+                          voucher_types=VOUCHER_TYPES,
+                          voucher_statuses=VOUCHER_STATUSES)
 
 @tosite_bp.route('/db/<filename>/vouchers/new', methods=['GET', 'POST'])
 def new_voucher(filename):
@@ -246,10 +199,13 @@ def new_voucher(filename):
             json_data['kommentti'] = comments
         
         # Create voucher in database
-        conn = get_db_connection(db_path)
+        conn = get_db(filename)
         cursor = conn.cursor()
         
         try:
+            # Validate every line before writing anything
+            lines = build_voucher_lines(request.form, voucher_date)
+            
             # Begin transaction
             conn.execute('BEGIN')
             
@@ -262,52 +218,8 @@ def new_voucher(filename):
             
             voucher_id = cursor.lastrowid
             
-            # Process line items (transactions)
-            row_index = 1
-            for i in range(50):  # Arbitrary limit for form input fields
-                account_key = f'tili_{i}'
-                if account_key not in request.form or not request.form.get(account_key):
-                    continue  # Skip if no account selected
-                
-                account = int(request.form.get(account_key))
-                explanation = request.form.get(f'selite_{i}', '')
-                debit = request.form.get(f'debit_{i}', '')
-                credit = request.form.get(f'credit_{i}', '')
-                
-                # Convert amount to cents
-                debit_cents = int(float(debit) * 100) if debit and debit.strip() else 0
-                credit_cents = int(float(credit) * 100) if credit and credit.strip() else 0
-                
-                # Get allocation if provided
-                allocation = request.form.get(f'kohdennus_{i}')
-                if allocation and allocation.strip():
-                    allocation = int(allocation)
-                else:
-                    allocation = 0  # Default allocation
-                
-                # Get VAT if provided
-                vat_percent = request.form.get(f'alv_percent_{i}')
-                vat_code = request.form.get(f'alv_code_{i}')
-                
-                if vat_percent and vat_percent.strip():
-                    vat_percent = float(vat_percent)
-                else:
-                    vat_percent = None
-                
-                if vat_code and vat_code.strip():
-                    vat_code = int(vat_code)
-                else:
-                    vat_code = None
-                
-                # Insert transaction
-                cursor.execute("""
-                    INSERT INTO Vienti (rivi, tosite, pvm, tili, kohdennus, selite, 
-                                      debetsnt, kreditsnt, alvprosentti, alvkoodi)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (row_index, voucher_id, voucher_date, account, allocation, explanation,
-                      debit_cents, credit_cents, vat_percent, vat_code))
-                
-                row_index += 1
+            # Insert all transactions at once
+            insert_lines(cursor, voucher_id, lines)
             
             # Handle file attachments
             if 'attachment' in request.files:
@@ -316,27 +228,22 @@ def new_voucher(filename):
                 for i, file in enumerate(files):
                     if file and file.filename and allowed_file(file.filename):
                         filename_secure = secure_filename(file.filename)
-                        file_data = file.read()
                         
-                        # Check file size
-                        if len(file_data) > MAX_FILE_SIZE:
+                        # Stream the upload to disk, hashing and checking its size on the way
+                        try:
+                            staged = liitteet.store.stage(filename, file.stream, MAX_FILE_SIZE)
+                        except liitteet.FileTooLarge:
                             flash(f"File {filename_secure} is too large (max 10MB allowed)", "error")
                             continue
                         
                         # Determine file type
                         file_type = file.content_type or 'application/octet-stream'
                         
-                        # Generate hash
-                        file_hash = generate_file_hash(file_data)
-                        
                         # Role name - 'original' for first attachment, numbered for others
                         role_name = "original" if i == 0 else f"attachment{i}"
                         
-                        # Store in database
-                        cursor.execute("""
-                            INSERT INTO Liite (tosite, nimi, roolinimi, tyyppi, sha, data)
-                            VALUES (?, ?, ?, ?, ?, ?)
-                        """, (voucher_id, filename_secure, role_name, file_type, file_hash, file_data))
+                        # Store metadata in database and the content in the attachment store
+                        liitteet.store.add(cursor, filename, voucher_id, filename_secure, role_name, file_type, staged)
             
             # Commit transaction
             conn.commit()
@@ -346,13 +253,10 @@ def new_voucher(filename):
         except Exception as e:
             conn.rollback()
             flash(f"Error creating voucher: {str(e)}", "error")
-        finally:
-            conn.close()
     
     # Get data for form fields
-    accounts = get_accounts(db_path)
-    partners = get_partners(db_path)
-    allocations = get_allocations(db_path)
+    accounts = get_accounts(filename)
+    allocations = get_allocations(filename)
     
     return render_template('vouchers/new.html',
                           filename=filename,
@@ -360,10 +264,41 @@ def new_voucher(filename):
                           voucher_statuses=VOUCHER_STATUSES,
                           vat_codes=VAT_CODES,
                           accounts=accounts,
-                          partners=partners,
                           allocations=allocations,
                           today=datetime.date.today().isoformat())
 
+@tosite_bp.route('/db/<filename>/vouchers/import', methods=['POST'])
+def import_voucher_file(filename):
+    """
+    Bulk import vouchers from CSV or JSON lines, sent either as a 'file'
+    upload or as the request body. Returns a JSON report with per-row errors.
+    """
+    db_path = os.path.join('databases', filename)
+    
+    if not os.path.exists(db_path):
+        return jsonify({"error": "Database file not found"}), 404
+    
+    upload = request.files.get('file')
+    if upload:
+        stream = upload.stream
+        fmt = request.args.get('format') or detect_format(upload.filename)
+    else:
+        stream = request.stream
+        content_type = request.mimetype or ''
+        fmt = request.args.get('format') or ('jsonl' if 'json' in content_type else 'csv')
+    
+    if fmt not in IMPORT_FORMATS:
+        return jsonify({"error": f"Unknown import format: {fmt}"}), 400
+    
+    chunk_size = request.args.get('chunk_size', IMPORT_CHUNK_SIZE, type=int)
+    dry_run = request.args.get('dry_run') in ('1', 'true')
+    
+    conn = get_db(filename)
+    report = import_vouchers(conn, open_text(stream), fmt, max(chunk_size, 1), dry_run)
+    
+    status = 400 if report['errors'] and not report['vouchers'] else 200
+    return jsonify(report), status
+
 @tosite_bp.route('/db/<filename>/vouchers/<int:voucher_id>')
 def view_voucher(filename, voucher_id):
     """View a specific voucher"""
@@ -373,7 +308,7 @@ def view_voucher(filename, voucher_id):
         flash("Database file not found", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
     # Get voucher details
@@ -386,7 +321,6 @@ def view_voucher(filename, voucher_id):
     voucher = cursor.fetchone()
     
     if not voucher:
-        conn.close()
         flash("Voucher not found", "error")
         return redirect(url_for('tosite.list_vouchers', filename=filename))
     
@@ -416,35 +350,22 @@ def view_voucher(filename, voucher_id):
     total_debit = 0
     total_credit = 0
     
-    for row in cursor.fetchall():
+    rows = cursor.fetchall()
+    
+    # Account and allocation names from the shared reference data
+    reference = get_reference_data(conn, filename)
+    account_names = reference.account_names
+    allocation_names = reference.allocation_names
+    
+    for row in rows:
         debit_amount = row['debetsnt'] / 100 if row['debetsnt'] else 0
         credit_amount = row['kreditsnt'] / 100 if row['kreditsnt'] else 0
         
         total_debit += debit_amount
         total_credit += credit_amount
         
-        # Get account details
-        account_name = ""
-        cursor.execute("SELECT json FROM Tili WHERE numero = ?", (row['tili'],))
-        account_result = cursor.fetchone()
-        if account_result and account_result['json']:
-            try:
-                account_data = json.loads(account_result['json'])
-                account_name = account_data.get('nimi', '')
-            except:
-                pass
-        
-        # Get allocation details
-        allocation_name = ""
-        if row['kohdennus']:
-            cursor.execute("SELECT json FROM Kohdennus WHERE id = ?", (row['kohdennus'],))
-            allocation_result = cursor.fetchone()
-            if allocation_result and allocation_result['json']:
-                try:
-                    allocation_data = json.loads(allocation_result['json'])
-                    allocation_name = allocation_data.get('nimi', {}).get('fi', '')
-                except:
-                    pass
+        account_name = account_names.get(row['tili'], "")
+        allocation_name = allocation_names.get(row['kohdennus'], "") if row['kohdennus'] else ""
         
         transactions.append({
             'id': row['id'],
@@ -480,8 +401,6 @@ def view_voucher(filename, voucher_id):
     # Check if voucher is balanced
     is_balanced = abs(total_debit - total_credit) < 0.01
     
-    conn.close()
-    
     return render_template('vouchers/view.html',
                           filename=filename,
                           voucher=voucher,
@@ -504,12 +423,12 @@ def view_attachment(filename, voucher_id, attachment_id):
         flash("Database file not found", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
     # Get attachment details
     cursor.execute("""
-        SELECT nimi, tyyppi, data 
+        SELECT id, nimi, tyyppi, sha, data IS NOT NULL AS tietokannassa
         FROM Liite 
         WHERE id = ? AND tosite = ?
     """, (attachment_id, voucher_id))
@@ -517,22 +436,14 @@ def view_attachment(filename, voucher_id, attachment_id):
     attachment = cursor.fetchone()
     
     if not attachment:
-        conn.close()
         flash("Attachment not found", "error")
         return redirect(url_for('tosite.view_voucher', filename=filename, voucher_id=voucher_id))
     
-    file_data = attachment['data']
-    file_type = attachment['tyyppi']
-    file_name = attachment['nimi']
-    
-    conn.close()
-    
-    # Send the file to the client
-    return Response(
-        file_data,
-        mimetype=file_type,
-        headers={"Content-Disposition": f"inline; filename={file_name}"}
-    )
+    # Stream the file to the client
+    response = liitteet.send_attachment(filename, attachment)
+    if response is None:
+        abort(404)
+    return response
 
 @tosite_bp.route('/db/<filename>/vouchers/<int:voucher_id>/delete', methods=['POST'])
 def delete_voucher(filename, voucher_id):
@@ -543,18 +454,22 @@ def delete_voucher(filename, voucher_id):
         flash("Database file not found", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     
     try:
-        # Delete voucher - transactions will be deleted automatically due to CASCADE constraint
+        # Foreign keys are not enforced on these connections, so the ON DELETE CASCADE
+        # does not fire; delete the transactions and attachments explicitly
+        conn.execute("DELETE FROM Vienti WHERE tosite = ?", (voucher_id,))
+        conn.execute("DELETE FROM Liite WHERE tosite = ?", (voucher_id,))
         conn.execute("DELETE FROM Tosite WHERE id = ?", (voucher_id,))
         conn.commit()
+        
+        # Remove attachment files no other voucher refers to
+        liitteet.store.collect(conn, filename)
         flash("Voucher deleted successfully", "success")
     except Exception as e:
         conn.rollback()
         flash(f"Error deleting voucher: {str(e)}", "error")
-    finally:
-        conn.close()
     
     return redirect(url_for('tosite.list_vouchers', filename=filename))
 
@@ -580,7 +495,7 @@ def vat_account_suggestion(filename, vat_code):
     # Check if account exists in this database
     db_path = os.path.join('databases', filename)
     if os.path.exists(db_path):
-        conn = get_db_connection(db_path)
+        conn = get_db(filename)
         cursor = conn.cursor()
         
         cursor.execute("SELECT numero FROM Tili WHERE numero = ?", (suggested_account,))
@@ -590,8 +505,6 @@ def vat_account_suggestion(filename, vat_code):
             result = cursor.fetchone()
             if result:
                 suggested_account = result['numero']
-        
-        conn.close()
     
     return jsonify({"account": suggested_account})
 
@@ -604,7 +517,7 @@ def confirm_voucher(filename, voucher_id):
         flash("Database file not found", "error")
         return redirect(url_for('index'))
     
-    conn = get_db_connection(db_path)
+    conn = get_db(filename)
     cursor = conn.cursor()
     
     # Check if voucher exists and is in Draft status
@@ -612,13 +525,11 @@ def confirm_voucher(filename, voucher_id):
     voucher = cursor.fetchone()
     
     if not voucher:
-        conn.close()
         flash("Voucher not found", "error")
         return redirect(url_for('tosite.list_vouchers', filename=filename))
     
     # Check if the voucher is in draft status (0)
     if voucher['tila'] != 0:
-        conn.close()
         flash("Only draft vouchers can be confirmed", "warning")
         return redirect(url_for('tosite.view_voucher', filename=filename, voucher_id=voucher_id))
     
@@ -635,7 +546,6 @@ def confirm_voucher(filename, voucher_id):
     
     # If the difference is more than 1 cent, it's unbalanced
     if abs(total_debit - total_credit) > 1:
-        conn.close()
         flash("Voucher cannot be confirmed because it is unbalanced", "error")
         return redirect(url_for('tosite.view_voucher', filename=filename, voucher_id=voucher_id))
     
@@ -648,7 +558,6 @@ def confirm_voucher(filename, voucher_id):
         conn.rollback()
         flash(f"Error confirming voucher: {str(e)}", "error")
     
-    conn.close()
     return redirect(url_for('tosite.view_voucher', filename=filename, voucher_id=voucher_id))
 
 def register_blueprint(app):
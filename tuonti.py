@@ -0,0 +1,344 @@
+import io
+import os
+import sys
+import csv
+import json
+import sqlite3
+import argparse
+import datetime
+from tietokanta import DATABASE_DIR, ensure_schema, connect
+from viennit import VIENTI_INSERT, parse_cents, to_decimal
+from saldot import CLOSED_UNTIL_KEY
+
+# Vouchers written per transaction
+IMPORT_CHUNK_SIZE = 500
+
+# Difference between debits and credits tolerated in a voucher, as in confirm_voucher
+BALANCE_TOLERANCE = 1
+
+IMPORT_FORMATS = ('csv', 'jsonl')
+
+TOSITE_INSERT = """
+    INSERT INTO Tosite (pvm, tyyppi, tila, otsikko, kumppani, laskupvm, erapvm, viite, json)
+    VALUES (:pvm, :tyyppi, :tila, :otsikko, :kumppani, :laskupvm, :erapvm, :viite, :json)
+"""
+
+def detect_format(name, default='csv'):
+    """Guess the import format from a filename"""
+    if name and name.lower().endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    if name and name.lower().endswith('.csv'):
+        return 'csv'
+    return default
+
+def read_rows(stream, fmt):
+    """
+    Yield (line number, row dict) pairs from a text stream.
+
+    CSV input has one ledger line per row. JSON lines input has either one
+    ledger line per object, or a whole voucher with its lines in 'viennit'.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, {key.strip(): value for key, value in row.items() if key}
+        return
+
+    for line_number, text in enumerate(stream, start=1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError as e:
+            yield line_number, {'_error': f"invalid JSON: {e}"}
+            continue
+        if not isinstance(row, dict):
+            yield line_number, {'_error': "expected a JSON object"}
+            continue
+
+        lines = row.pop('viennit', None)
+        if lines is None:
+            yield line_number, row
+        else:
+            for line in lines:
+                if isinstance(line, dict):
+                    yield line_number, dict(row, **line)
+                else:
+                    yield line_number, {'_error': "expected a JSON object in 'viennit'"}
+
+def group_vouchers(rows):
+    """Group consecutive rows sharing the same 'tosite' key into vouchers"""
+    key = None
+    group = []
+    for line_number, row in rows:
+        row_key = row.get('tosite')
+        if row_key is not None:
+            row_key = str(row_key).strip() or None
+        if group and (row_key is None or row_key != key):
+            yield key, group
+            group = []
+        key = row_key
+        group.append((line_number, row))
+    if group:
+        yield key, group
+
+def parse_date(value, field):
+    """Parse an ISO date, returning it as a string"""
+    if value is None or not str(value).strip():
+        raise ValueError(f"{field}: value is required")
+    try:
+        return datetime.date.fromisoformat(str(value).strip()).isoformat()
+    except ValueError:
+        raise ValueError(f"{field}: '{value}' is not a date (YYYY-MM-DD)")
+
+def optional_date(value, field):
+    """Parse an optional ISO date"""
+    if value is None or not str(value).strip():
+        return None
+    return parse_date(value, field)
+
+def optional_integer(value, field):
+    """
+    Parse an optional integer. Unlike form values, imported values may be
+    JSON numbers or containers; only whole numbers are accepted.
+    """
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError(f"{field}: '{value}' is not an integer")
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(f"{field}: '{value}' is not an integer")
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value.strip())
+        except ValueError:
+            raise ValueError(f"{field}: '{value}' is not an integer")
+    return value
+
+def optional_text(value, field):
+    """Parse an optional text value; numbers are kept as their text"""
+    if value is None:
+        return ''
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError(f"{field}: '{value}' is not text")
+    return str(value)
+
+def build_voucher(rows, accounts, partners, closed_until=None):
+    """
+    Validate the rows of one imported voucher against the accounts and
+    partners of the database. Lines dated on or before closed_until fall
+    in a closed fiscal period and are rejected.
+
+    Returns:
+        tuple: (voucher dict, line dicts)
+
+    Raises:
+        ValueError: With (line number, message) of the first invalid row
+    """
+    first_line, first = rows[0]
+    try:
+        voucher_date = parse_date(first.get('pvm'), 'pvm')
+        voucher = {
+            'pvm': voucher_date,
+            'tyyppi': optional_integer(first.get('tyyppi'), 'tyyppi') or 7,  # Default to Memo (7)
+            'tila': optional_integer(first.get('tila'), 'tila'),
+            'otsikko': optional_text(first.get('otsikko'), 'otsikko'),
+            'kumppani': optional_integer(first.get('kumppani'), 'kumppani'),
+            'laskupvm': optional_date(first.get('laskupvm'), 'laskupvm'),
+            'erapvm': optional_date(first.get('erapvm'), 'erapvm'),
+            'viite': optional_text(first.get('viite'), 'viite'),
+            'json': None
+        }
+        if voucher['kumppani'] is not None and voucher['kumppani'] not in partners:
+            raise ValueError(f"kumppani: partner {voucher['kumppani']} does not exist")
+    except ValueError as e:
+        raise ValueError(first_line, str(e))
+
+    if voucher['tila'] is None:
+        voucher['tila'] = 100  # Balanced imports are Ready (100)
+
+    lines = []
+    for line_number, row in rows:
+        try:
+            if '_error' in row:
+                raise ValueError(row['_error'])
+
+            account = optional_integer(row.get('tili'), 'tili')
+            if account is None:
+                raise ValueError("tili: value is required")
+            if account not in accounts:
+                raise ValueError(f"tili: account {account} does not exist")
+
+            debit_cents = parse_cents(row.get('debet'), 'debet')
+            credit_cents = parse_cents(row.get('kredit'), 'kredit')
+            if debit_cents and credit_cents:
+                raise ValueError("a line cannot have both debit and credit")
+
+            vat_percent = row.get('alvprosentti')
+            if vat_percent is not None and str(vat_percent).strip():
+                vat_percent = float(to_decimal(vat_percent, 'alvprosentti'))
+            else:
+                vat_percent = None
+
+            line_date = optional_date(row.get('pvm'), 'pvm') or voucher_date
+            if closed_until and line_date <= closed_until:
+                raise ValueError(f"pvm: {line_date} is in a closed fiscal period (closed until {closed_until})")
+
+            lines.append({
+                'rivi': len(lines) + 1,
+                'pvm': line_date,
+                'tili': account,
+                'kohdennus': optional_integer(row.get('kohdennus'), 'kohdennus') or 0,  # Default allocation
+                'selite': optional_text(row.get('selite'), 'selite'),
+                'debetsnt': debit_cents,
+                'kreditsnt': credit_cents,
+                'alvprosentti': vat_percent,
+                'alvkoodi': optional_integer(row.get('alvkoodi'), 'alvkoodi')
+            })
+        except ValueError as e:
+            raise ValueError(line_number, str(e))
+
+    total_debit = sum(line['debetsnt'] for line in lines)
+    total_credit = sum(line['kreditsnt'] for line in lines)
+    if abs(total_debit - total_credit) > BALANCE_TOLERANCE:
+        raise ValueError(first_line, f"voucher is unbalanced: debit {total_debit / 100:.2f}, credit {total_credit / 100:.2f}")
+
+    return voucher, lines
+
+def write_vouchers(conn, vouchers):
+    """Write validated vouchers in one transaction, returning the number of lines written"""
+    cursor = conn.cursor()
+    params = []
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for voucher, lines in vouchers:
+            cursor.execute(TOSITE_INSERT, voucher)
+            voucher_id = cursor.lastrowid
+            params.extend(dict(line, tosite=voucher_id) for line in lines)
+
+        cursor.executemany(VIENTI_INSERT, params)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return len(params)
+
+def import_vouchers(conn, stream, fmt='csv', chunk_size=IMPORT_CHUNK_SIZE, dry_run=False):
+    """
+    Import vouchers from a CSV or JSON lines stream.
+
+    Rows are grouped into vouchers by the 'tosite' column, and the rows of a
+    voucher must be consecutive: a key seen again after other vouchers is
+    reported as an error rather than starting a second voucher. Voucher fields
+    (pvm, tyyppi, tila, otsikko, kumppani, laskupvm, erapvm, viite) come from
+    the first row of each voucher, and every row carries one ledger line
+    (tili, kohdennus, selite, debet, kredit, alvprosentti, alvkoodi) with
+    amounts in euros. Vouchers with any invalid row, or dated in a closed
+    fiscal period, are skipped and reported; the rest are written in
+    transactions of chunk_size vouchers.
+
+    Returns:
+        dict: Counts of imported vouchers and lines, and the per-row errors
+    """
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError(f"Unknown import format: {fmt}")
+
+    accounts = {row[0] for row in conn.execute("SELECT numero FROM Tili")}
+    partners = {row[0] for row in conn.execute("SELECT id FROM Kumppani")}
+    closed = conn.execute("SELECT arvo FROM Asetus WHERE avain = ?", (CLOSED_UNTIL_KEY,)).fetchone()
+    closed_until = closed[0] if closed else None
+    report = {'vouchers': 0, 'lines': 0, 'errors': []}
+    pending = []  # (voucher key, first line number, voucher, lines)
+    seen = {}  # Voucher key -> line the voucher started on
+
+    def flush():
+        if not pending:
+            return
+        try:
+            if dry_run:
+                report['lines'] += sum(len(lines) for _, _, _, lines in pending)
+            else:
+                report['lines'] += write_vouchers(conn, [(voucher, lines) for _, _, voucher, lines in pending])
+            report['vouchers'] += len(pending)
+        except sqlite3.Error:
+            # The whole chunk was rolled back; write its vouchers one at a
+            # time so the error is reported on the voucher that caused it
+            for voucher_key, first_line, voucher, lines in pending:
+                try:
+                    report['lines'] += write_vouchers(conn, [(voucher, lines)])
+                    report['vouchers'] += 1
+                except sqlite3.Error as e:
+                    report['errors'].append({'line': first_line, 'voucher': voucher_key, 'error': f"database error: {e}"})
+        pending.clear()
+
+    for voucher_key, rows in group_vouchers(read_rows(stream, fmt)):
+        if voucher_key is None:
+            for line_number, row in rows:
+                message = row.get('_error') or "tosite: voucher key is required"
+                report['errors'].append({'line': line_number, 'voucher': None, 'error': message})
+            continue
+
+        if voucher_key in seen:
+            report['errors'].append({'line': rows[0][0], 'voucher': voucher_key,
+                                     'error': f"tosite: rows of the voucher are not consecutive (it started on line {seen[voucher_key]})"})
+            continue
+        seen[voucher_key] = rows[0][0]
+
+        try:
+            voucher, lines = build_voucher(rows, accounts, partners, closed_until)
+            pending.append((voucher_key, rows[0][0], voucher, lines))
+        except ValueError as e:
+            line_number, message = e.args
+            report['errors'].append({'line': line_number, 'voucher': voucher_key, 'error': message})
+
+        if len(pending) >= chunk_size:
+            flush()
+
+    flush()
+    return report
+
+def open_text(binary_stream):
+    """Wrap an uploaded byte stream for reading text, accepting a UTF-8 BOM"""
+    return io.TextIOWrapper(binary_stream, encoding='utf-8-sig', newline='')
+
+def main(argv=None):
+    """Import vouchers into a client database from CSV or JSON lines"""
+    parser = argparse.ArgumentParser(description="Bulk import vouchers into a client database")
+    parser.add_argument('database', help="Database filename")
+    parser.add_argument('input', help="CSV or JSON lines file, '-' for standard input")
+    parser.add_argument('--format', choices=IMPORT_FORMATS, help="Input format (default: from the file extension)")
+    parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help="Vouchers per transaction")
+    parser.add_argument('--dry-run', action='store_true', help="Validate without writing")
+    parser.add_argument('--directory', default=DATABASE_DIR)
+    args = parser.parse_intermixed_args(argv)
+
+    db_path = os.path.join(args.directory, args.database)
+    if not os.path.exists(db_path):
+        print(f"{args.database}: database not found")
+        return 1
+
+    fmt = args.format or detect_format(args.input)
+    conn = connect(db_path)
+    try:
+        ensure_schema(conn)
+        if args.input == '-':
+            report = import_vouchers(conn, open_text(sys.stdin.buffer), fmt, args.chunk_size, args.dry_run)
+        else:
+            with open(args.input, encoding='utf-8-sig', newline='') as stream:
+                report = import_vouchers(conn, stream, fmt, args.chunk_size, args.dry_run)
+    finally:
+        conn.close()
+
+    for error in report['errors']:
+        print(f"line {error['line']} (voucher {error['voucher'] or '-'}): {error['error']}")
+    action = "validated" if args.dry_run else "imported"
+    print(f"{args.database}: {action} {report['vouchers']} vouchers, {report['lines']} lines, {len(report['errors'])} errors")
+
+    return 1 if report['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,8 +3,12 @@ import json
 import os
 import uuid
 import datetime
+import threading
 from pathlib import Path
 from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory
+import asiakasluettelo
+import tietokanta
+import migraatiot
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # For flash messages
@@ -13,13 +17,47 @@ class AccountingDatabaseCreator:
     """
     Creates a SQLite database for accounting purposes, inspired by Kitsas/Kitupiikki.
     Each client gets their own database file.
+    
+    New databases are copies of a template database per chart of accounts
+    scope, built once per process: schema, accounts and migrations are
+    already in place, and only the client's own rows are written.
     """
     
+    # Chart of accounts scopes; any other value gets the basic chart
+    CHART_SCOPES = ('basic', 'standard', 'extended')
+    
+    _templates = {}  # chart scope -> in-memory template database
+    _template_lock = threading.Lock()
+    
     def __init__(self):
         self.db_connection = None
         self.db_cursor = None
         self.db_path = None
     
+    @classmethod
+    def _template(cls, chart_scope):
+        """Template database of a chart scope, built on first use"""
+        template = cls._templates.get(chart_scope)
+        if template is None:
+            builder = cls()
+            builder.db_connection = sqlite3.connect(':memory:', check_same_thread=False)
+            builder.db_cursor = builder.db_connection.cursor()
+            
+            builder._create_schema()
+            builder.db_cursor.execute(
+                "INSERT INTO Asetus (avain, arvo) VALUES ('TilikarttaLaajuus', ?)",
+                (chart_scope,)
+            )
+            builder._create_default_chart_of_accounts()
+            builder.db_connection.commit()
+            
+            migraatiot.migrate(builder.db_connection)
+            builder.db_connection.execute("ANALYZE")
+            builder.db_connection.commit()
+            
+            template = cls._templates[chart_scope] = builder.db_connection
+        return template
+    
     def create_database(self, client_info, output_directory="databases"):
         """
         Create a new SQLite database for a client with the provided information.
@@ -43,12 +81,19 @@ class AccountingDatabaseCreator:
         self.db_connection = sqlite3.connect(self.db_path)
         self.db_cursor = self.db_connection.cursor()
         
+        # Copy the schema and chart of accounts from the template
+        chart_scope = client_info.get('chart_scope')
+        if chart_scope not in self.CHART_SCOPES:
+            chart_scope = 'basic'
+        with self._template_lock:
+            self._template(chart_scope).backup(self.db_connection)
+        
+        # New databases start in WAL mode with the deployment's PRAGMAs
+        tietokanta.apply_pragmas(self.db_connection, tietokanta.load_pragmas())
+        
         # Enable foreign keys
         self.db_cursor.execute("PRAGMA foreign_keys = ON")
         
-        # Create the database schema
-        self._create_schema()
-        
         # Insert client information
         self._insert_client_info(client_info)
         
@@ -56,9 +101,6 @@ class AccountingDatabaseCreator:
         if 'fiscal_period' in client_info and client_info['fiscal_period'].get('start_date') and client_info['fiscal_period'].get('end_date'):
             self._create_fiscal_period(client_info['fiscal_period'])
         
-        # Create default chart of accounts
-        self._create_default_chart_of_accounts()
-        
         # Commit changes and close connection
         self.db_connection.commit()
         self.db_connection.close()
@@ -283,20 +325,17 @@ class AccountingDatabaseCreator:
             "LaskuSeuraavaId": 100
         }
         
-        # Insert each setting
-        for key, value in settings.items():
-            if value:  # Only insert non-empty values
-                self.db_cursor.execute(
-                    "INSERT INTO Asetus (avain, arvo) VALUES (?, ?)",
-                    (key, value)
-                )
+        rows = [(key, value) for key, value in settings.items() if value]  # Only non-empty values
         
         # If bank account is provided, add it to the settings
         if 'iban' in client_info and client_info['iban']:
-            self.db_cursor.execute(
-                "INSERT INTO Asetus (avain, arvo) VALUES (?, ?)",
-                ("LaskuIbanit", client_info['iban'])
-            )
+            rows.append(("LaskuIbanit", client_info['iban']))
+        
+        # The template already has some of the keys
+        self.db_cursor.executemany("""
+            INSERT INTO Asetus (avain, arvo) VALUES (?, ?)
+            ON CONFLICT (avain) DO UPDATE SET arvo = excluded.arvo
+        """, rows)
     
     def _create_fiscal_period(self, fiscal_period):
         """Create a fiscal period entry"""
@@ -499,34 +538,7 @@ class AccountingDatabaseCreator:
 @app.route('/')
 def index():
     """Home page with list of existing databases"""
-    databases = []
-    db_dir = Path("databases")
-    
-    if db_dir.exists():
-        for file in db_dir.glob("*.db"):
-            # Get creation time
-            created = datetime.datetime.fromtimestamp(file.stat().st_ctime)
-            # Get client name from filename
-            name = file.stem.split('_')[0].replace('_', ' ').title()
-            
-            # Try to get actual name from database
-            try:
-                conn = sqlite3.connect(file)
-                cursor = conn.cursor()
-                cursor.execute("SELECT arvo FROM Asetus WHERE avain='Nimi'")
-                result = cursor.fetchone()
-                if result:
-                    name = result[0]
-                conn.close()
-            except:
-                pass
-                
-            databases.append({
-                'filename': file.name,
-                'name': name,
-                'created': created.strftime('%Y-%m-%d %H:%M'),
-                'size': f"{file.stat().st_size / 1024:.1f} KB"
-            })
+    databases = asiakasluettelo.catalog.list_clients()
     
     return render_template('index.html', databases=databases)
 
@@ -574,6 +586,9 @@ def create_database():
 @app.route('/download/<filename>')
 def download_database(filename):
     """Download a database file"""
+    # Recent commits may still be in the write-ahead log
+    if os.path.basename(filename) == filename and os.path.exists(os.path.join('databases', filename)):
+        tietokanta.checkpoint(filename)
     return send_from_directory('databases', filename, as_attachment=True)
 
 @app.route('/view/<filename>')
@@ -615,6 +630,9 @@ def view_database(filename):
     
     return render_template('view.html', filename=filename, client_info=client_info, tables=tables)
 
+# Release pooled client database connections after each request
+tietokanta.init_app(app)
+
 # Import and register the tosite blueprint
 import tosite
 tosite.register_blueprint(app)
@@ -635,5 +653,25 @@ asetukset.register_blueprint(app)
 import laskut
 laskut.register_blueprint(app)
 
+# Import and register the kumppanit blueprint
+import kumppanit
+kumppanit.register_blueprint(app)
+
+# Import and register the haku blueprint
+import haku
+haku.register_blueprint(app)
+
+# Import and register the salkku blueprint
+import salkku
+salkku.register_blueprint(app)
+
+# Import and register the budjetti blueprint
+import budjetti
+budjetti.register_blueprint(app)
+
+# Import and register the reskontra blueprint
+import reskontra
+reskontra.register_blueprint(app)
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
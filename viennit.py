@@ -0,0 +1,178 @@
+import re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+# Accounts used by the generated invoice lines
+INVOICE_VAT_ACCOUNT = 2940         # VAT payable
+INVOICE_RECEIVABLE_ACCOUNT = 1700  # Accounts receivable
+
+def to_decimal(value, field, default=None):
+    """Parse a form value as a Decimal, accepting a comma as decimal separator"""
+    if value is None or not str(value).strip():
+        if default is None:
+            raise ValueError(f"{field}: value is required")
+        return Decimal(default)
+    try:
+        number = Decimal(str(value).strip().replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f"{field}: '{value}' is not a number")
+    if not number.is_finite():
+        raise ValueError(f"{field}: '{value}' is not a number")
+    return number
+
+def to_cents(amount):
+    """Convert a Decimal amount in euros to integer cents, rounding half up"""
+    return int((amount * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def parse_cents(value, field):
+    """Parse a euro amount from a form field into cents (empty means zero)"""
+    return to_cents(to_decimal(value, field, default='0'))
+
+def optional_int(value):
+    """Parse an optional integer form value"""
+    if value is None or not str(value).strip():
+        return None
+    return int(value)
+
+def form_line_indices(form, prefix):
+    """Return the line indices present in a form, e.g. tili_0, tili_7 -> [0, 7]"""
+    pattern = re.compile(rf'^{re.escape(prefix)}_(\d+)$')
+    indices = set()
+    for key in form.keys():
+        match = pattern.match(key)
+        if match and form.get(key):
+            indices.add(int(match.group(1)))
+    return sorted(indices)
+
+def build_voucher_lines(form, voucher_date):
+    """
+    Validate and build the ledger lines of a voucher form.
+
+    Returns:
+        list: Line dicts ready for insert_lines()
+
+    Raises:
+        ValueError: If any line has invalid input
+    """
+    lines = []
+
+    for i in form_line_indices(form, 'tili'):
+        line_number = len(lines) + 1
+        try:
+            debit_cents = parse_cents(form.get(f'debit_{i}'), 'debit')
+            credit_cents = parse_cents(form.get(f'credit_{i}'), 'credit')
+            # Vienti has CHECK (debetsnt = 0 OR kreditsnt = 0); report it per line
+            # instead of failing the insert
+            if debit_cents and credit_cents:
+                raise ValueError("a line cannot have both debit and credit")
+
+            vat_percent = form.get(f'alv_percent_{i}')
+            vat_percent = float(to_decimal(vat_percent, 'VAT %')) if vat_percent and vat_percent.strip() else None
+
+            lines.append({
+                'rivi': line_number,
+                'pvm': voucher_date,
+                'tili': int(form.get(f'tili_{i}')),
+                'kohdennus': optional_int(form.get(f'kohdennus_{i}')) or 0,  # Default allocation
+                'selite': form.get(f'selite_{i}', ''),
+                'debetsnt': debit_cents,
+                'kreditsnt': credit_cents,
+                'alvprosentti': vat_percent,
+                'alvkoodi': optional_int(form.get(f'alv_code_{i}'))
+            })
+        except ValueError as e:
+            raise ValueError(f"Line {line_number}: {e}")
+
+    return lines
+
+def build_invoice_lines(form, invoice_date):
+    """
+    Validate and build the ledger lines of an invoice form: a revenue line
+    and a VAT line per product, and the receivable for the total.
+
+    Returns:
+        tuple: (lines, total_cents)
+
+    Raises:
+        ValueError: If any line has invalid input
+    """
+    lines = []
+    total_cents = 0
+
+    for line_number, i in enumerate(form_line_indices(form, 'tuote'), start=1):
+        try:
+            product = form.get(f'tuote_{i}')
+            quantity = to_decimal(form.get(f'maara_{i}'), 'quantity', default='1')
+            price = to_decimal(form.get(f'hinta_{i}'), 'price', default='0')
+            discount = to_decimal(form.get(f'alennus_{i}'), 'discount', default='0')
+            vat_percent = to_decimal(form.get(f'alv_percent_{i}'), 'VAT %', default='24')
+            account = optional_int(form.get(f'tili_{i}')) or 3000  # Default to sales account
+            allocation = optional_int(form.get(f'kohdennus_{i}')) or 0  # Default allocation
+        except ValueError as e:
+            raise ValueError(f"Line {line_number}: {e}")
+
+        # Line amount after discount, and its VAT
+        amount = quantity * price
+        if discount > 0:
+            amount = amount * (1 - discount / 100)
+        amount_cents = to_cents(amount)
+        vat_cents = to_cents(amount * vat_percent / 100)
+        total_cents += amount_cents + vat_cents
+
+        # Description for transaction
+        description = f"{product} {quantity.normalize():f} x {price:.2f}€"
+        if discount > 0:
+            description += f" (Alennus: {discount.normalize():f}%)"
+
+        # Line for the amount excluding VAT
+        lines.append({
+            'rivi': len(lines) + 1,
+            'pvm': invoice_date,
+            'tili': account,
+            'kohdennus': allocation,
+            'selite': description,
+            'debetsnt': 0,
+            'kreditsnt': amount_cents,
+            'alvprosentti': float(vat_percent),
+            'alvkoodi': None
+        })
+
+        # Line for VAT
+        if vat_percent > 0:
+            lines.append({
+                'rivi': len(lines) + 1,
+                'pvm': invoice_date,
+                'tili': INVOICE_VAT_ACCOUNT,
+                'kohdennus': allocation,
+                'selite': f"ALV {vat_percent.normalize():f}%: {description}",
+                'debetsnt': 0,
+                'kreditsnt': vat_cents,
+                'alvprosentti': 0,
+                'alvkoodi': None
+            })
+
+    # Line for accounts receivable
+    lines.append({
+        'rivi': len(lines) + 1,
+        'pvm': invoice_date,
+        'tili': INVOICE_RECEIVABLE_ACCOUNT,
+        'kohdennus': 0,
+        'selite': "Myyntisaamiset",
+        'debetsnt': total_cents,
+        'kreditsnt': 0,
+        'alvprosentti': None,
+        'alvkoodi': None
+    })
+
+    return lines, total_cents
+
+# Named-parameter insert shared by every code path that writes ledger lines
+VIENTI_INSERT = """
+    INSERT INTO Vienti (rivi, tosite, pvm, tili, kohdennus, selite,
+                      debetsnt, kreditsnt, alvprosentti, alvkoodi)
+    VALUES (:rivi, :tosite, :pvm, :tili, :kohdennus, :selite,
+            :debetsnt, :kreditsnt, :alvprosentti, :alvkoodi)
+"""
+
+def insert_lines(cursor, voucher_id, lines):
+    """Insert the ledger lines of a voucher with a single executemany"""
+    cursor.executemany(VIENTI_INSERT, [dict(line, tosite=voucher_id) for line in lines])
@@ -0,0 +1,96 @@
+import json
+import threading
+
+# Asetus key of the reference data version, bumped whenever accounts
+# or allocations change
+VERSION_KEY = 'ViitetiedotVersio'
+
+def get_version(conn):
+    """Current reference data version of a client database"""
+    row = conn.execute("SELECT arvo FROM Asetus WHERE avain = ?", (VERSION_KEY,)).fetchone()
+    try:
+        return int(row[0]) if row else 0
+    except (TypeError, ValueError):
+        return 0
+
+def bump_version(conn):
+    """
+    Mark the reference data of a client database as changed.
+    Call inside the transaction that changes Tili or Kohdennus,
+    so the new version becomes visible together with the change.
+    """
+    conn.execute("""
+        INSERT INTO Asetus (avain, arvo) VALUES (?, '1')
+        ON CONFLICT (avain) DO UPDATE SET
+            arvo = CAST(arvo AS INTEGER) + 1,
+            muokattu = CURRENT_TIMESTAMP
+    """, (VERSION_KEY,))
+
+def _decode(text):
+    if not text:
+        return {}
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+class ReferenceData:
+    """
+    Decoded accounts and allocations of one client database at one
+    version. Shared between requests, so the lists and dicts must not be modified.
+    """
+
+    def __init__(self, conn):
+        self.accounts = []
+        for numero, tyyppi, text in conn.execute("SELECT numero, tyyppi, json FROM Tili ORDER BY numero"):
+            data = _decode(text)
+            self.accounts.append({
+                'numero': numero,
+                'nimi': data.get('nimi', ''),
+                'tyyppi': tyyppi,
+                'alvprosentti': data.get('alvprosentti', ''),
+                'alvkoodi': data.get('alvkoodi', '')
+            })
+
+        self.allocations = []
+        for allocation_id, text in conn.execute("SELECT id, json FROM Kohdennus ORDER BY id"):
+            name = _decode(text).get('nimi', {})
+            self.allocations.append({
+                'id': allocation_id,
+                'nimi': name.get('fi', '') if isinstance(name, dict) else ''
+            })
+
+        self.account_numbers = frozenset(account['numero'] for account in self.accounts)
+        self.account_names = {account['numero']: account['nimi'] for account in self.accounts}
+        self.allocation_names = {allocation['id']: allocation['nimi'] for allocation in self.allocations}
+
+class ReferenceCache:
+    """
+    In-process cache of ReferenceData per client database, keyed by the
+    version stored in Asetus. A reader pays one primary key lookup per
+    request; the tables are re-read and decoded only after a version bump.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # filename -> (version, ReferenceData)
+
+    def get(self, conn, filename):
+        """Reference data of a client database, loaded if the version has changed"""
+        version = get_version(conn)
+        with self._lock:
+            entry = self._entries.get(filename)
+        if entry and entry[0] == version:
+            return entry[1]
+
+        data = ReferenceData(conn)
+        with self._lock:
+            self._entries[filename] = (version, data)
+        return data
+
+cache = ReferenceCache()
+
+def get_reference_data(conn, filename):
+    """Shared decoded accounts and allocations of a client database"""
+    return cache.get(conn, filename)